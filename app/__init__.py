@@ -9,7 +9,44 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'app.sqlite'),
-        EXPORTS_PATH=os.path.join(app.instance_path, 'exports')
+        # seconds a connection waits on another writer's lock
+        DB_TIMEOUT=30,
+        # overrides for db.DEFAULT_PRAGMAS, like {'cache_size': -256000}
+        SQLITE_PRAGMAS={},
+        # idle connections kept open for reuse by later requests
+        DB_POOL_SIZE=8,
+        EXPORTS_PATH=os.path.join(app.instance_path, 'exports'),
+        UPLOADS_PATH=os.path.join(app.instance_path, 'uploads'),
+        # 'fts' uses the full-text indexes, 'like' falls back to LIKE scans
+        SEARCH_MODE='fts',
+        # seconds a /manifest total result count is reused for the same filters
+        COUNT_CACHE_TTL=30,
+        # bulk uploads are written in transactions of this many items
+        IMPORT_BATCH_SIZE=5000,
+        # processes that render an export's prompt id ranges in parallel (1 exports serially)
+        EXPORT_WORKERS=os.cpu_count() or 1,
+        # bulk uploads and exports run in this many worker processes (see worker.py)
+        TASK_WORKERS=2,
+        # start the workers with the app, instead of with `flask worker`
+        EMBEDDED_WORKERS=True,
+        # seconds an idle worker waits before checking the queue again
+        WORKER_POLL_INTERVAL=1.0,
+        # /manifest bulk actions on more prompts than this run as a background task
+        BULK_ACTION_INLINE_LIMIT=5000,
+        # the largest random sample /manifest and /sample.json show (exports aren't limited)
+        MAX_SAMPLE_SIZE=1000,
+        # estimated Jaccard similarity at which prompts count as near duplicates
+        NEAR_DUPLICATE_THRESHOLD=0.8,
+        # processes that compute a near-duplicate task's MinHash signatures
+        NEAR_DUPLICATE_WORKERS=os.cpu_count() or 1,
+        # time every query of every request, for /debug/sql and the X-SQL-* headers
+        SQL_PROFILING=False,
+        # with SQL_PROFILING, queries slower than this many milliseconds are logged with their plan
+        SLOW_QUERY_MS=100,
+        # requests (and slow queries) kept for /debug/sql
+        SQL_PROFILE_HISTORY=50,
+        # request metrics, served with task and database metrics at /metrics
+        METRICS=True
     )
 
     if test_config is None:
@@ -28,6 +65,10 @@ def create_app(test_config=None):
         os.makedirs(os.path.join(app.instance_path, 'exports'))
     except OSError:
         pass
+    try:
+        os.makedirs(app.config['UPLOADS_PATH'])
+    except OSError:
+        pass
 
     from . import view
     app.register_blueprint(view.bp)
@@ -50,8 +91,27 @@ def create_app(test_config=None):
     from . import style
     app.register_blueprint(style.bp)
 
+    from . import stats
+    app.register_blueprint(stats.bp)
+
+    from . import profiling
+    app.register_blueprint(profiling.bp)
+    profiling.init_app(app)
+
+    from . import metrics
+    app.register_blueprint(metrics.bp)
+    metrics.init_app(app)
+
     # connect database
     from . import db
     db.init_app(app)
 
+    # synthetic data for benchmarks (flask gen-data)
+    from . import synthetic
+    synthetic.init_app(app)
+
+    # background task workers
+    from . import worker
+    worker.init_app(app)
+
     return app
@@ -1,13 +1,16 @@
 from flask import (
     Blueprint,
+    current_app,
     render_template,
     request,
     redirect
 )
 from app.db import get_db
-from app.db_wrappers import add_prompt, add_bulk, get_project_by_id, get_style_by_id, get_styles_by_project_id, get_keys_by_style_id, check_running
+from app.db_wrappers import add_prompt, add_bulk, DUPLICATE_MODES, get_project_by_id, get_style_by_id, get_styles_by_project_id
+from app.style_plans import plan_for_style
 from app.utils  import tag_string_to_list
-import json
+import os
+import uuid
 
 bp = Blueprint('add', __name__)
 
@@ -16,7 +19,7 @@ def add():
 
     db = get_db()
 
-    if request.method == "POST" and not check_running(db):
+    if request.method == "POST":
 
         project_id = request.form.get('project_id')
         style_id = request.form.get('style_id')
@@ -24,25 +27,23 @@ def add():
         # Was it a bulk upload?
         file = request.files.get('file')
         if file:
-            file_contents = file.read()
-            # Read as json
-            # btw this is probably a security vulnerability
+            # Spool the upload to disk; the background task parses it incrementally
             # Probably should check for filesize as well
-            data = json.loads(file_contents)
+            path = os.path.join(current_app.config['UPLOADS_PATH'], f"{uuid.uuid4().hex}.upload")
+            file.save(path)
             tags = request.form.get("tags")
             tags = tag_string_to_list(tags)
-            res = add_bulk(db, data, tags, project_id, style_id)
+            priority = request.form.get('priority', 0, type=int)
+            duplicates = request.form.get('duplicates') if request.form.get('duplicates') in DUPLICATE_MODES else 'skip'
+            add_bulk(db, path, tags, project_id, style_id, priority, duplicates)
             return redirect("/tasks")
         else:
-            style_keys = get_keys_by_style_id(db, style_id)
             style = get_style_by_id(db, style_id)
 
             # don't need completion key for style_keys
-            if 'completion_key' in style:
-                completion_key = style['completion_key']
-                style_keys = [x for x in style_keys if x['name'] != completion_key]
+            style_keys = plan_for_style(style).prompt_keys
 
-            keys = {x['name']: request.form.get("key." + x['name']) for x in style_keys}
+            keys = {name: request.form.get("key." + name) for name in style_keys}
             tags = request.form.get("tags")
             if tags:
                 tags = tag_string_to_list(tags)
@@ -53,19 +54,12 @@ def add():
     else:
         project_id = request.args.get('project_id')
         style_id = request.args.get('style_id')
-    
+
         error = None
-        if request.method == 'POST' and check_running(db):
-            project_id = request.form.get('project_id')
-            style_id = request.form.get('style_id')
-            error = "Cannot add new data while current task is incomplete."
 
         style = get_style_by_id(db, style_id)
         project = get_project_by_id(db, project_id)
-        style_keys = get_keys_by_style_id(db, style_id)
         # don't need completion key for style_keys
-        if 'completion_key' in style:
-            completion_key = style['completion_key']
-            style_keys = [x for x in style_keys if x['name'] != completion_key]
+        style_keys = plan_for_style(style).prompt_keys
 
         return render_template('add.html', style=style, project=project, style_keys=style_keys, error=error)
\ No newline at end of file
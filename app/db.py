@@ -3,62 +3,261 @@ import json
 import click
 from flask import current_app, g
 import os
-import shutil
+import queue
+import time
 
 
-def dict_factory(cursor, row):
-    """
-    Converts each row to a dictionary
-    """
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+# Applied to every connection; SQLITE_PRAGMAS in the app config overrides them for
+#   the app's own connections
+# WAL lets background tasks write to the database directly while requests keep
+#   reading and writing, and with WAL, synchronous = NORMAL only syncs at checkpoints
+#   (a crash can't corrupt the database, though a power cut can lose the last commits)
+# A negative cache_size is in KiB
+# busy_timeout (in milliseconds) can be set here too, otherwise the connection
+#   timeout is used
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
 
-def get_db():
-    if 'db' not in g:
+# Plain sqlite3 connections can't be weakly referenced, which the metadata cache
+#   in db_wrappers needs to keep track of what each connection has seen
+class Connection(sqlite3.Connection):
+    pass
 
-        need_to_init = not os.path.exists(current_app.config['DATABASE'])
 
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = dict_factory
+"""
 
-        if need_to_init:
-            with current_app.open_resource('schema.sql') as f:
-                g.db.executescript(f.read().decode('utf8'))
+SQL profiling
 
-    return g.db
+With SQL_PROFILING set, the app's connections are ProfiledConnections, which time
+   every statement run through them (including fetching its rows) and report it
+   to the profile attached for the current request (see profiling.py), along with
+   every statement sqlite runs (trigger bodies included) via the trace callback.
+Connections without a profile attached, and plain Connections, aren't timed at all.
+
+"""
+class ProfiledCursor(sqlite3.Cursor):
+    # The profile's record of the statement this cursor last ran
+    _query = None
+
+    def execute(self, sql, parameters=()):
+        profile = self.connection.profile
+        if profile is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._query = profile.record(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        profile = self.connection.profile
+        if profile is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # The parameters may have been a generator, so they aren't kept
+            self._query = profile.record(sql, None, time.perf_counter() - start)
+
+    # Fetching steps the statement, so that time goes to the statement too
+    def _fetch(self, fetch, *args):
+        if self._query is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._query['seconds'] += time.perf_counter() - start
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        return self._fetch(super().__next__)
+
+
+class ProfiledConnection(Connection):
+    profile = None
 
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
 
-def get_tmp_db(instance_path, old_db_path):
+    # Connection.execute would run the statement on its cursor without going
+    #   through ProfiledCursor.execute
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
 
-    # TODO: make unique for each process?
-    new_db_path = os.path.join(instance_path, "tmp.sqlite")
-    shutil.copyfile(old_db_path, new_db_path)
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
+    def attach(self, profile):
+        self.profile = profile
+        self.set_trace_callback(profile.trace if profile is not None else None)
+
+# Opens a connection to the database at path
+# timeout is how many seconds a writer waits for another writer's lock before
+#   giving up, and pragmas are applied on top of DEFAULT_PRAGMAS
+# Rows are sqlite3.Row, which reads like a dictionary (row['name'], dict(row))
+#   but is built in C rather than by a python row factory
+def connect_db(path, timeout=30, pragmas=None, check_same_thread=True, factory=Connection):
     db = sqlite3.connect(
-        new_db_path,
-        detect_types=sqlite3.PARSE_DECLTYPES
+        path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=timeout,
+        check_same_thread=check_same_thread,
+        factory=factory
     )
-    db.row_factory = dict_factory
+    db.row_factory = sqlite3.Row
+    for name, value in dict(DEFAULT_PRAGMAS, **(pragmas or {})).items():
+        db.execute(f"PRAGMA {name} = {value}")
+    return db
+
+
+"""
+
+Connection pool
+
+Requests take a connection from the pool in get_db and hand it back in close_db,
+   so connections (and their page caches) live across requests instead of being
+   opened for each one.
+There is a pool per process and database path, since sqlite connections can't be
+   shared with forked processes. Each request uses its connection from one thread
+   at a time, but requests can run on different threads, hence check_same_thread.
+The most recently returned connection is handed out first, as its cache is warmest.
+
+"""
+_pools = {}
+
+
+def _get_pool(path):
+    key = (os.getpid(), path)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = queue.LifoQueue()
+    return pool
+
+
+def _open_app_db():
+    config = current_app.config
+    path = config['DATABASE']
+    need_to_init = not os.path.exists(path)
+
+    factory = ProfiledConnection if config['SQL_PROFILING'] else Connection
+    db = connect_db(path, config['DB_TIMEOUT'], config['SQLITE_PRAGMAS'], check_same_thread=False, factory=factory)
+
+    if need_to_init:
+        run_script(db, 'schema.sql')
+        migrate(db)
+    return db
 
-    return db, new_db_path
+
+def get_db():
+    if 'db' not in g:
+        try:
+            g.db = _get_pool(current_app.config['DATABASE']).get_nowait()
+        except queue.Empty:
+            g.db = _open_app_db()
+        if 'sql_profile' in g and isinstance(g.db, ProfiledConnection):
+            g.db.attach(g.sql_profile)
+
+    return g.db
+
+
+def run_script(db, name):
+    with current_app.open_resource(name) as f:
+        db.executescript(f.read().decode('utf8'))
+
+
+"""
+
+Schema migrations
+
+Each file in migrations/ is named like 0002_indexes.sql, where the number is the
+   schema version that the file upgrades the database to. The current version
+   lives in PRAGMA user_version, so migrate() only runs the files that are newer.
+Each migration runs in its own transaction along with the version bump, so a
+   failed migration leaves the database at the previous version.
+
+"""
+def get_migrations():
+    migrations_path = os.path.join(current_app.root_path, 'migrations')
+    migrations = []
+    for name in sorted(os.listdir(migrations_path)):
+        version, _, rest = name.partition('_')
+        if not name.endswith('.sql') or not version.isdigit():
+            continue
+        migrations.append((int(version), name))
+    return migrations
+
+
+def get_schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()['user_version']
+
+
+# Returns the names of the migrations that were applied
+def migrate(db):
+    current_version = get_schema_version(db)
+    applied = []
+    for version, name in get_migrations():
+        if version <= current_version:
+            continue
+        with current_app.open_resource(os.path.join('migrations', name)) as f:
+            sql = f.read().decode('utf8')
+        try:
+            db.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {version};\nCOMMIT;")
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        applied.append(name)
+    return applied
 
 
 def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        if isinstance(db, ProfiledConnection):
+            db.attach(None)
+        # Don't hand a half finished transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        pool = _get_pool(current_app.config['DATABASE'])
+        if pool.qsize() < current_app.config['DB_POOL_SIZE']:
+            pool.put(db)
+        else:
+            db.close()
 
 def init_db():
     db = get_db()
+    run_script(db, 'schema.sql')
+    migrate(db)
+    # Counts the example data schema.sql starts with into dataset_stats
+    from app.db_wrappers import rebuild_stats
+    for row in db.execute("SELECT id FROM projects").fetchall():
+        rebuild_stats(db, row['id'])
 
-    with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+
+# Refills the full-text indexes from prompt_values and examples
+# Creates them first (via the migrations) if the database predates them
+def rebuild_fts():
+    db = get_db()
+    migrate(db)
+    db.execute("INSERT INTO prompt_values_fts (prompt_values_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO examples_fts (examples_fts) VALUES ('rebuild')")
+    db.commit()
 
 
 @click.command('init-db')
@@ -67,9 +266,28 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+
+@click.command('migrate')
+def migrate_command():
+    """Upgrade the database schema in place."""
+    db = get_db()
+    applied = migrate(db)
+    for name in applied:
+        click.echo(f'Applied {name}')
+    click.echo(f'Database is at schema version {get_schema_version(db)}.')
+
+
+@click.command('rebuild-fts')
+def rebuild_fts_command():
+    """Create and backfill the full-text search indexes."""
+    rebuild_fts()
+    click.echo('Rebuilt the full-text search indexes.')
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(rebuild_fts_command)
 
 
 class SQLiteJSONEncoder(json.JSONEncoder):
@@ -1,12 +1,24 @@
 import multiprocessing
 import json
 import os
+import random
+import struct
+import tempfile
+import functools
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+from operator import itemgetter
 from unicodedata import name
-from app.db import SQLiteJSONEncoder
 from flask import current_app, session
-from app.utils import get_named_arguments
-from app.db import get_tmp_db
-import shutil
+from app.utils import encode_cursor, decode_cursor, iter_json_records, content_hash, random_seed
+from app.style_plans import get_style_plan, plan_for_style
+from app import minhash
+from app.db import connect_db
+from app.writers import ExportWriter, ExportSplits, get_encoder, shard_names
+from app.metrics import counter
+import time
 import psutil
 
 
@@ -16,35 +28,73 @@ All functions that depend on the peculiarities of the database
 
 """
 
+# Background tasks open the live database themselves, and sqlite's file locks
+#   don't survive a fork of a process that has the same database open,
+#   so tasks run in freshly spawned interpreters instead
+task_context = multiprocessing.get_context('spawn')
+
+# TAGS
+
+# Tag texts are interned in tag_names, and tags rows refer to them by id
+#   (see migrations/0009_tag_names.sql)
+# Returns {tag: tag id} for tags, adding the ones tag_names doesn't have yet
+# Doesn't commit
+def intern_tags(db, tags):
+    names = json.dumps(list(dict.fromkeys(tags)))
+    db.execute("INSERT OR IGNORE INTO tag_names (value) SELECT value FROM json_each(?)", (names,))
+    sql = "SELECT id, value FROM tag_names WHERE value IN (SELECT value FROM json_each(?))"
+    return {row['value']: row['id'] for row in db.execute(sql, (names,))}
+
+
 # EXAMPLES
 
 def add_example(db, prompt_id, completion, tags):
     c = db.cursor()
-    c.execute("INSERT INTO examples (completion, prompt_id) VALUES (?, ?)", (completion, prompt_id))
+    stats = StatsDelta()
+    stats.remove(db, "?", (prompt_id,))
+    c.execute("INSERT INTO examples (completion, prompt_id, content_hash) VALUES (?, ?, ?)", (completion, prompt_id, content_hash([completion])))
     item_id = c.lastrowid
-    
+
     # Add tags
+    tag_ids = intern_tags(db, tags)
     for tag in tags:
-        c.execute("INSERT INTO tags (example_id, value) VALUES (?, ?)", (item_id, tag))
+        c.execute("INSERT INTO tags (example_id, tag_id) VALUES (?, ?)", (item_id, tag_ids[tag]))
+    stats.add(db, "?", (prompt_id,))
+    stats.write(db)
     db.commit()
+    _invalidate_counts()
     return item_id
 
 
 def delete_example(db, example_id):
+    row = db.execute("SELECT prompt_id FROM examples WHERE id = ?", (example_id,)).fetchone()
+    stats = StatsDelta()
+    if row is not None:
+        stats.remove(db, "?", (row['prompt_id'],))
     db.execute("DELETE FROM examples WHERE id = ?", (example_id,))
+    if row is not None:
+        stats.add(db, "?", (row['prompt_id'],))
+    stats.write(db)
     db.commit()
+    _invalidate_counts()
 
 
 def update_example(db, example_id, completion, tags):
     c = db.cursor()
+    stats = StatsDelta()
+    stats.remove(db, "SELECT prompt_id FROM examples WHERE id = ?", (example_id,))
 
     # Remove all tags
     c.execute("DELETE FROM tags WHERE example_id = ?", (example_id,))
     # Update text
-    c.execute("UPDATE examples SET completion = ? WHERE id = ?", (completion, example_id))
+    c.execute("UPDATE examples SET completion = ?, content_hash = ? WHERE id = ?", (completion, content_hash([completion]), example_id))
+    tag_ids = intern_tags(db, tags)
     for t in tags:
-        c.execute("INSERT INTO tags (example_id, value) VALUES (?, ?)", (example_id, t))
+        c.execute("INSERT INTO tags (example_id, tag_id) VALUES (?, ?)", (example_id, tag_ids[t]))
+    stats.add(db, "SELECT prompt_id FROM examples WHERE id = ?", (example_id,))
+    stats.write(db)
     db.commit()
+    _invalidate_counts()
     return example_id
 
 
@@ -56,14 +106,20 @@ def delete_prompt(db, prompt_id):
     # Remove all prompt_values
     # remove associated examples
 
+    stats = StatsDelta()
+    stats.remove(db, "?", (prompt_id,))
+    stats.write(db)
     db.execute("DELETE FROM prompts WHERE id = ?", (prompt_id,))
     db.execute("DELETE FROM tags WHERE prompt_id = ?", (prompt_id,))
     db.execute("DELETE FROM prompt_values WHERE prompt_id = ?", (prompt_id,))
     db.execute("DELETE FROM examples WHERE prompt_id = ?", (prompt_id,))
     db.commit()
+    _invalidate_counts()
 
 def update_prompt(db, prompt_id, prompt_values, tags):
     c = db.cursor()
+    stats = StatsDelta()
+    stats.remove(db, "?", (prompt_id,))
 
     # Update prompt values
     for key in prompt_values:
@@ -86,12 +142,35 @@ def update_prompt(db, prompt_id, prompt_values, tags):
         WHERE prompt_id = ?
     """
     c.execute(sql, (prompt_id,))
+    tag_ids = intern_tags(db, tags)
     for tag in tags:
-        c.execute("INSERT INTO tags (value, prompt_id) VALUES (?, ?)", (tag, prompt_id))
+        c.execute("INSERT INTO tags (tag_id, prompt_id) VALUES (?, ?)", (tag_ids[tag], prompt_id))
 
+    _update_prompt_hash(db, prompt_id)
+    stats.add(db, "?", (prompt_id,))
+    stats.write(db)
     db.commit()
+    _invalidate_counts()
     return prompt_id
 
+# Recomputes a prompt's content_hash from its stored values
+def _update_prompt_hash(db, prompt_id):
+    sql = """
+        SELECT styles.template, styles.completion_key, styles.preview_key,
+            (
+                SELECT json_group_object(v.key, v.value)
+                FROM prompt_values AS v
+                WHERE v.prompt_id = prompts.id
+            ) AS prompt_values
+        FROM prompts
+        JOIN styles ON prompts.style = styles.id
+        WHERE prompts.id = ?
+    """
+    row = db.execute(sql, (prompt_id,)).fetchone()
+    if row is not None:
+        value = plan_for_style(row).content_hash(json.loads(row['prompt_values']))
+        db.execute("UPDATE prompts SET content_hash = ? WHERE id = ?", (value, prompt_id))
+
 # Adds prompt to database and returns that prompt's id
 def add_prompt(db, **kwargs):
 
@@ -102,322 +181,1298 @@ def add_prompt(db, **kwargs):
 
     c = db.cursor()
 
-    c.execute("INSERT INTO prompts (project_id, style) VALUES (?, ?)", (project_id, style_id))
+    style = get_style_by_id(db, style_id)
+    value = plan_for_style(style).content_hash(keys) if style else None
+    c.execute("INSERT INTO prompts (project_id, style, content_hash) VALUES (?, ?, ?)", (project_id, style_id, value))
     prompt_id = c.lastrowid
 
+    tag_ids = intern_tags(db, tags)
     for t in tags:
-        c.execute("INSERT INTO tags (value, prompt_id) VALUES (?, ?)", (t, prompt_id))
+        c.execute("INSERT INTO tags (tag_id, prompt_id) VALUES (?, ?)", (tag_ids[t], prompt_id))
 
     for k in keys:
         c.execute("INSERT INTO prompt_values (prompt_id, key, value) VALUES (?, ?, ?)", (prompt_id, k, keys[k]))
 
+    stats = StatsDelta()
+    stats.prompt(project_id, style_id, keys.items(), [], tags)
+    stats.write(db)
     db.commit()
+    _invalidate_counts()
     return prompt_id
 
+"""
+
+Bulk actions on sets of prompts
+
+A selection is either a list of prompt ids, or filters (a dict of search_prompts'
+   content_arg, example_arg, tags_arg, project_id, style_id and cluster_arg) that select every
+   matching prompt.
+The selected ids are gathered into a temp table, and each action is then a single
+   statement per table joined against it, so acting on a set costs the same handful
+   of statements as acting on one prompt.
+
+Actions:
+   delete     - deletes the prompts with their values, examples and tags
+   add_tag    - tags every prompt with tag (once)
+   remove_tag - removes tag from every prompt
+   move       - moves the prompts to project_id and/or style_id
+   keep_one   - deletes the prompts that have an older near-duplicate (see
+                find_near_duplicates), keeping the oldest of each cluster
+
+"""
+BULK_ACTIONS = ('delete', 'add_tag', 'remove_tag', 'move', 'keep_one')
+
+
+def _select_prompts(db, prompt_ids=None, filters=None, search_mode="fts"):
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_selection (prompt_id INTEGER PRIMARY KEY)")
+    db.execute("DELETE FROM temp.bulk_selection")
+    if filters is not None:
+        filter_sql, args = _prompt_filter_sql(filters.get('content_arg'), filters.get('example_arg'), filters.get('tags_arg'), filters.get('project_id'), filters.get('style_id'), search_mode, cluster_arg=filters.get('cluster_arg'))
+        db.execute(f"INSERT OR IGNORE INTO temp.bulk_selection (prompt_id) SELECT prompts.id {filter_sql}", tuple(args))
+    else:
+        db.executemany("INSERT OR IGNORE INTO temp.bulk_selection (prompt_id) VALUES (?)", [(int(x),) for x in prompt_ids])
+    return db.execute("SELECT COUNT(*) AS total FROM temp.bulk_selection").fetchone()['total']
+
+
+# Applies an action to every prompt id in table (a temp table with a prompt_id column)
+# Doesn't commit
+def _apply_bulk_action(db, table, action, tag=None, project_id=None, style_id=None):
+    selection = f"SELECT prompt_id FROM {table}"
+    if action == 'keep_one':
+        # Narrows the selection down to the prompts with an older near-duplicate, to delete them
+        sql = f"""
+            DELETE FROM {table} AS selected
+            WHERE NOT EXISTS (
+                SELECT 1 FROM near_duplicates
+                JOIN near_duplicates AS older ON older.cluster_id = near_duplicates.cluster_id AND older.prompt_id < near_duplicates.prompt_id
+                WHERE near_duplicates.prompt_id = selected.prompt_id
+            )
+        """
+        db.execute(sql)
+        action = 'delete'
+
+    stats = StatsDelta()
+    stats.remove(db, selection)
+    if action == 'delete':
+        db.execute(f"DELETE FROM tags WHERE example_id IN (SELECT id FROM examples WHERE prompt_id IN ({selection}))")
+        db.execute(f"DELETE FROM tags WHERE prompt_id IN ({selection})")
+        db.execute(f"DELETE FROM prompt_values WHERE prompt_id IN ({selection})")
+        db.execute(f"DELETE FROM examples WHERE prompt_id IN ({selection})")
+        db.execute(f"DELETE FROM prompts WHERE id IN ({selection})")
+    elif action == 'add_tag':
+        tag_id = intern_tags(db, [tag])[tag]
+        sql = f"""
+            INSERT INTO tags (tag_id, prompt_id)
+            SELECT ?, selected.prompt_id FROM {table} AS selected
+            WHERE NOT EXISTS (
+                SELECT 1 FROM tags
+                WHERE tags.prompt_id = selected.prompt_id AND tags.tag_id = ?
+            )
+        """
+        db.execute(sql, (tag_id, tag_id))
+    elif action == 'remove_tag':
+        sql = f"DELETE FROM tags WHERE prompt_id IN ({selection}) AND tag_id = (SELECT id FROM tag_names WHERE value = ?)"
+        db.execute(sql, (tag,))
+    elif action == 'move':
+        sql = f"""
+            UPDATE prompts
+            SET project_id = COALESCE(?, project_id), style = COALESCE(?, style)
+            WHERE id IN ({selection})
+        """
+        db.execute(sql, (project_id, style_id))
+        if style_id:
+            # Hashes go by the style's key order, so they're recomputed when next needed
+            db.execute(f"UPDATE prompts SET content_hash = NULL WHERE id IN ({selection})")
+    else:
+        raise ValueError(f"Unknown bulk action {action}")
+    stats.add(db, selection)
+    stats.write(db)
+
+
+# Applies action to the selection in one transaction, returning how many prompts were selected
+def bulk_action(db, action, prompt_ids=None, filters=None, tag=None, project_id=None, style_id=None, search_mode="fts"):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        total = _select_prompts(db, prompt_ids, filters, search_mode)
+        _apply_bulk_action(db, "temp.bulk_selection", action, tag, project_id, style_id)
+        db.execute("DELETE FROM temp.bulk_selection")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    _invalidate_counts()
+    return total
+
+
+# Queues a bulk action for a worker, for selections too big to change in one request
+# Returns the task's id
+def queue_bulk_action(db, action, prompt_ids=None, filters=None, tag=None, project_id=None, style_id=None, search_mode="fts", priority=0):
+    payload = {
+        'action': action,
+        'prompt_ids': prompt_ids,
+        'filters': filters,
+        'tag': tag,
+        'project_id': project_id,
+        'style_id': style_id,
+        'search_mode': search_mode,
+    }
+    task_id = enqueue_task(db, "bulk_action", payload, priority)
+    session['warn_parallelism'] = True
+    return task_id
+
+
+# Applies a bulk action in chunks of chunk_size prompts, one transaction each, so
+#   that other writers only ever wait for one chunk
+# The selection is taken once at the start; cancelling stops between chunks
+def bulk_action_background(db_path, task_id, action, prompt_ids=None, filters=None, tag=None, project_id=None, style_id=None, search_mode="fts", chunk_size=5000):
+    db = connect_db(db_path)
+    progress = ProgressReporter(db_path, task_id)
+
+    try:
+        total = _select_prompts(db, prompt_ids, filters, search_mode)
+        db.commit()
+        progress.rows_total = total
+        progress.flush()
+
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_chunk (prompt_id INTEGER PRIMARY KEY)")
+        done = 0
+        last_id = -1
+        while True:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM temp.bulk_chunk")
+                sql = """
+                    INSERT INTO temp.bulk_chunk (prompt_id)
+                    SELECT prompt_id FROM temp.bulk_selection
+                    WHERE prompt_id > ?
+                    ORDER BY prompt_id
+                    LIMIT ?
+                """
+                count = db.execute(sql, (last_id, chunk_size)).rowcount
+                if count == 0:
+                    db.rollback()
+                    break
+                last_id = db.execute("SELECT MAX(prompt_id) AS last_id FROM temp.bulk_chunk").fetchone()['last_id']
+                _apply_bulk_action(db, "temp.bulk_chunk", action, tag, project_id, style_id)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            done += count
+            progress.update(rows_done=done)
+
+        progress.close()
+        finish_task(db, task_id, 'completed')
+    except TaskCancelled:
+        progress.close()
+        finish_task(db, task_id, 'cancelled')
+    except Exception as e:
+        progress.close()
+        finish_task(db, task_id, 'failed')
+        print(f"Error occurred: {e}")
+
+    db.close()
+
 # Takes data and inserts prompts and examples
-# Data is a list of dictionaries (i.e. json data)
+# path is an uploaded file holding a json list of dictionaries, or JSONL
+#   (see iter_json_records); the background task deletes it when it's done
 # tags is a list
-def add_bulk(db, data, tags, project_id, style_id):
-    c = db.cursor()
-    sql = """
-        INSERT INTO tasks (`type`, `status`)
-        VALUES ("bulk_upload",
-                "in_progress"
-                );
-    """
-    c.execute(sql)
-    task_id = c.lastrowid
-    db.commit()
+# The upload is queued for a worker (see worker.py), and the task's id is returned
+"""
 
-    p = multiprocessing.Process(target=add_bulk_background, args=(current_app.instance_path, current_app.config['DATABASE'], task_id, data, tags, project_id, style_id))
-    p.start()
+Bulk uploads
 
-    sql = """
-        UPDATE tasks
-        SET pid = ?
-        WHERE id = ?
-    """
-    db.execute(sql, (p.pid, task_id))
-    db.commit()
+Uploaded items are checked for duplicates by their content hash (see
+   utils.content_hash) against the prompts of the same project and style,
+   including earlier items of the same upload. duplicates says what happens to one:
+
+   skip  - it's left out if the existing prompt already has the same completion
+           (or it has none); a new completion is added to the existing prompt
+   merge - like skip, but the existing prompt also gets any tags it lacks
+   allow - it's added as a new prompt anyway
+
+The numbers of prompts added, items merged into existing prompts and items
+   skipped are recorded as the task's result.
+
+"""
+DUPLICATE_MODES = ('skip', 'merge', 'allow')
+
+def add_bulk(db, path, tags, project_id, style_id, priority=0, duplicates='skip'):
+    payload = {
+        'path': path,
+        'tags': tags,
+        'project_id': project_id,
+        'style_id': style_id,
+        'batch_size': current_app.config['IMPORT_BATCH_SIZE'],
+        'duplicates': duplicates,
+    }
+    task_id = enqueue_task(db, "bulk_upload", payload, priority)
 
     # Make session token to warn user about parallelism
     session['warn_parallelism'] = True
 
-    status = {
-        'pid': p.pid,
-        'status': 'in_progress'
-    }
-    return status
+    return task_id
+
+# NOTE: doesn't support example tags yet
+def add_bulk_background(db_path, task_id, path, tags, project_id, style_id, batch_size=5000, duplicates='skip'):
+    db = connect_db(db_path)
+    progress = ProgressReporter(db_path, task_id)
+    counts = {'added': 0, 'merged': 0, 'skipped': 0}
 
-# NOTE: doesn't support example tags yet or multiple examples per prompt
-def add_bulk_background(instance_path, old_db_path, task_id, data, tags, project_id, style_id):
-    db, new_db_path = get_tmp_db(instance_path, old_db_path)
-    
     try:
         c = db.cursor()
 
-        # Get the correct keys and note which is the completion key
-        sql = """
-            SELECT * FROM style_keys
-            WHERE style_id = ?
-        """
-        res = c.execute(sql, (style_id,))
-        style_keys = res.fetchall()
-
         # Get the style
         sql = """
             SELECT * FROM styles
             WHERE id = ?
         """
-        res = c.execute(sql, (style_id))
-        style_info = res.fetchone()
-
-        completion_key = style_info['completion_key']
-
-        prompt_values_keys = [x['name'] for x in style_keys if x['name'] != completion_key]
+        res = c.execute(sql, (style_id,))
+        plan = plan_for_style(res.fetchone())
         db.commit()
 
-        for item in data:
-
-            # Add new prompt
+        # Duplicates are found by hash, so older rows need theirs first
+        if duplicates != 'allow':
+            fill_content_hashes(db, project_id, style_id)
+
+        # The number of records isn't known until the file has been read,
+        #   so progress (and the ETA) goes by how much of the file has been read
+        progress.bytes_total = os.path.getsize(path)
+
+        # Cancelling stops the upload between batches; batches already written are kept
+        items = 0
+        batch = []
+        with open(path, 'rb') as f:
+            for item in iter_json_records(f):
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    _count_bulk_batch(counts, _add_bulk_batch(db, batch, tags, project_id, style_id, plan, duplicates))
+                    items += len(batch)
+                    batch = []
+                    progress.update(rows_done=items, bytes_done=f.tell())
+            if batch:
+                _count_bulk_batch(counts, _add_bulk_batch(db, batch, tags, project_id, style_id, plan, duplicates))
+                items += len(batch)
+            progress.update(rows_done=items, bytes_done=f.tell())
+        progress.rows_total = items
+
+        progress.close()
+        finish_task(db, task_id, 'completed', counts)
+    except TaskCancelled:
+        progress.close()
+        finish_task(db, task_id, 'cancelled', counts)
+    except Exception as e:
+        progress.close()
+        finish_task(db, task_id, 'failed', counts)
+        print(f"Error occurred in task {task_id}: {e}")
+    finally:
+        os.remove(path)
+
+    db.close()
+
+# Inserts (prompt_id, key, value) rows into prompt_values and
+#   (prompt_id, completion, content_hash) rows into examples, in the caller's transaction
+# The full-text index triggers are an order of magnitude cheaper when they fire
+#   inside one INSERT ... SELECT instead of once per executemany row,
+#   so the rows go through temp staging tables
+def insert_text_rows(db, value_rows, example_rows):
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_prompt_values (prompt_id INTEGER, key TEXT, value TEXT)")
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_examples (prompt_id INTEGER, completion TEXT, content_hash TEXT)")
+    db.executemany("INSERT INTO temp.bulk_prompt_values (prompt_id, key, value) VALUES (?, ?, ?)", value_rows)
+    db.executemany("INSERT INTO temp.bulk_examples (prompt_id, completion, content_hash) VALUES (?, ?, ?)", example_rows)
+    db.execute("INSERT INTO prompt_values (prompt_id, key, value) SELECT prompt_id, key, value FROM temp.bulk_prompt_values")
+    db.execute("INSERT INTO examples (prompt_id, completion, content_hash) SELECT prompt_id, completion, content_hash FROM temp.bulk_examples")
+    db.execute("DELETE FROM temp.bulk_prompt_values")
+    db.execute("DELETE FROM temp.bulk_examples")
+
+def _count_bulk_batch(counts, batch_counts):
+    added, merged, skipped = batch_counts
+    counts['added'] += added
+    counts['merged'] += merged
+    counts['skipped'] += skipped
+
+# Inserts one chunk of a bulk upload in a single transaction
+# Prompt ids are assigned here rather than by sqlite, so that every table can be
+#   filled with one executemany; BEGIN IMMEDIATE holds the write lock, so nobody
+#   else can take those ids in the meantime
+# Existing duplicates are looked up with one indexed query per batch, and
+#   duplicates within the batch with a dictionary
+# Returns (prompts added, items merged, items skipped)
+def _add_bulk_batch(db, items, tags, project_id, style_id, plan, duplicates='skip'):
+    completion_key = plan.completion_key
+    prompt_values_keys = frozenset(plan.prompt_keys)
+    hashes = [plan.content_hash(item) for item in items]
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        # AUTOINCREMENT never reuses ids, so start after the highest one ever handed out
+        sql = """
+            SELECT MAX(
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'prompts'), 0),
+                COALESCE((SELECT MAX(id) FROM prompts), 0)
+            ) AS last_id
+        """
+        prompt_id = db.execute(sql).fetchone()['last_id']
+        tag_ids = intern_tags(db, tags)
+
+        # content hash -> id of the prompt it already belongs to
+        existing = {}
+        # (prompt id, completion hash) and (prompt id, tag) pairs of merge targets
+        existing_examples = set()
+        existing_tags = set()
+        if duplicates != 'allow':
             sql = """
-                INSERT INTO prompts (style, project_id) VALUES (?, ?)
+                SELECT id, content_hash FROM prompts
+                WHERE project_id = ? AND style = ?
+                AND content_hash IN (SELECT value FROM json_each(?))
+                ORDER BY id DESC
             """
-            c.execute(sql, (style_id, project_id))
-            prompt_id = c.lastrowid
-
-            # Add examples and prompt values
+            for row in db.execute(sql, (project_id, style_id, json.dumps(hashes))):
+                existing[row['content_hash']] = row['id']
+            if existing:
+                ids = json.dumps(list(existing.values()))
+                sql = "SELECT prompt_id, content_hash FROM examples WHERE prompt_id IN (SELECT value FROM json_each(?))"
+                existing_examples = {(row[0], row[1]) for row in db.execute(sql, (ids,))}
+            if duplicates == 'merge' and existing:
+                sql = """
+                    SELECT tags.prompt_id, tag_names.value FROM tags
+                    JOIN tag_names ON tag_names.id = tags.tag_id
+                    WHERE tags.prompt_id IN (SELECT value FROM json_each(?))
+                """
+                existing_tags = {(row[0], row[1]) for row in db.execute(sql, (ids,))}
+
+        # Merging changes the counts of existing prompts, which are read back after writing
+        # (in skip mode too, since new completions are still added to them)
+        stats = StatsDelta()
+        targets = json.dumps(list(existing.values()))
+        if duplicates != 'allow':
+            stats.remove(db, "SELECT value FROM json_each(?)", (targets,))
+        # prompt id -> (values, completions, tags) of the prompts this batch adds
+        new_prompts = {}
+
+        prompt_rows = []
+        example_rows = []
+        value_rows = []
+        tag_rows = []
+        added = merged = skipped = 0
+        for item, item_hash in zip(items, hashes):
+            target = existing.get(item_hash)
+            if target is not None:
+                new_completion = False
+                if completion_key in item:
+                    completion_hash = content_hash([item[completion_key]])
+                    if (target, completion_hash) not in existing_examples:
+                        new_completion = True
+                        example_rows.append((target, item[completion_key], completion_hash))
+                        existing_examples.add((target, completion_hash))
+                        if target in new_prompts:
+                            new_prompts[target][1].append(item[completion_key])
+                if duplicates == 'skip':
+                    if new_completion:
+                        merged += 1
+                    else:
+                        skipped += 1
+                    continue
+                merged += 1
+                for tag in tags:
+                    if (target, tag) not in existing_tags:
+                        tag_rows.append((target, tag_ids[tag]))
+                        existing_tags.add((target, tag))
+                        if target in new_prompts:
+                            new_prompts[target][2].append(tag)
+                continue
+
+            prompt_id += 1
+            added += 1
+            if duplicates != 'allow':
+                existing[item_hash] = prompt_id
+            prompt_rows.append((prompt_id, style_id, project_id, item_hash))
+            values = []
+            completions = []
+            new_prompts[prompt_id] = (values, completions, list(tags))
             for key in item:
                 if key == completion_key:
-                    sql = """
-                        INSERT INTO examples (prompt_id, completion) VALUES (?, ?)
-                    """
-                    c.execute(sql, (prompt_id, item[key]))
-                elif key in prompt_values_keys:  # need to avoid tags, other irrelevant values
-                    sql = """
-                        INSERT INTO prompt_values (prompt_id, key, value) VALUES (?, ?, ?)
-                    """
-                    c.execute(sql, (prompt_id, key, item[key]))
-
-            # Add tags to prompt
+                    completion_hash = content_hash([item[key]])
+                    example_rows.append((prompt_id, item[key], completion_hash))
+                    existing_examples.add((prompt_id, completion_hash))
+                    completions.append(item[key])
+                elif key in prompt_values_keys:
+                    value_rows.append((prompt_id, key, item[key]))
+                    values.append((key, item[key]))
             for tag in tags:
-                sql = """
-                    INSERT INTO tags (prompt_id, value) VALUES (?, ?)
-                """
-                c.execute(sql, (prompt_id, tag))
+                tag_rows.append((prompt_id, tag_ids[tag]))
+                existing_tags.add((prompt_id, tag))
 
-            db.commit()
+        for values, completions, prompt_tags in new_prompts.values():
+            stats.prompt(project_id, style_id, values, completions, prompt_tags)
+
+        db.executemany("INSERT INTO prompts (id, style, project_id, content_hash) VALUES (?, ?, ?, ?)", prompt_rows)
+        db.executemany("INSERT INTO tags (prompt_id, tag_id) VALUES (?, ?)", tag_rows)
+
+        insert_text_rows(db, value_rows, example_rows)
+        if duplicates != 'allow':
+            stats.add(db, "SELECT value FROM json_each(?)", (targets,))
+        stats.write(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return added, merged, skipped
+
+"""
+
+Duplicates
+
+fill_content_hashes computes the hashes rows written before they existed (or
+   whose style's keys have changed since) are missing, a batch per transaction.
+
+dedupe_project collapses every set of prompts in a project with the same style and
+   content hash into the oldest one, in one transaction: the others' examples and
+   tags move to it and they're deleted. Then examples of one prompt with the same
+   completion are collapsed the same way, and the tags that end up repeated on a
+   prompt or example are removed.
+
+"""
+def fill_content_hashes(db, project_id=None, style_id=None, batch_size=5000):
+    plans = {}
+    for style in db.execute("SELECT id, template, completion_key, preview_key FROM styles").fetchall():
+        plans[style['id']] = plan_for_style(style)
 
+    filters = ""
+    args = []
+    if project_id:
+        filters += " AND prompts.project_id = ?"
+        args.append(project_id)
+    if style_id:
+        filters += " AND prompts.style = ?"
+        args.append(style_id)
+
+    filled = 0
+    last_id = 0
+    while True:
+        sql = f"""
+            SELECT prompts.id, prompts.style,
+                (
+                    SELECT json_group_object(v.key, v.value)
+                    FROM prompt_values AS v
+                    WHERE v.prompt_id = prompts.id
+                ) AS prompt_values
+            FROM prompts
+            WHERE prompts.content_hash IS NULL AND prompts.id > ? {filters}
+            ORDER BY prompts.id
+            LIMIT ?
+        """
+        rows = db.execute(sql, (last_id, *args, batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            values = json.loads(row['prompt_values'])
+            plan = plans.get(row['style'])
+            if plan is not None:
+                updates.append((plan.content_hash(values), row['id']))
+            else:
+                # Without a style there's no key order, so the keys are sorted
+                updates.append((content_hash([values[key] for key in sorted(values)]), row['id']))
+        db.executemany("UPDATE prompts SET content_hash = ? WHERE id = ?", updates)
+        db.commit()
+        filled += len(rows)
+        last_id = rows[-1]['id']
+
+    last_id = 0
+    while True:
+        sql = f"""
+            SELECT examples.id, examples.completion FROM examples
+            WHERE examples.content_hash IS NULL AND examples.id > ?
+            AND examples.prompt_id IN (SELECT prompts.id FROM prompts WHERE 1 {filters})
+            ORDER BY examples.id
+            LIMIT ?
+        """
+        rows = db.execute(sql, (last_id, *args, batch_size)).fetchall()
+        if not rows:
+            break
+        db.executemany("UPDATE examples SET content_hash = ? WHERE id = ?", [(content_hash([row['completion']]), row['id']) for row in rows])
+        db.commit()
+        filled += len(rows)
+        last_id = rows[-1]['id']
+
+    return filled
+
+
+# Returns (prompts removed, examples removed)
+def dedupe_project(db, project_id, progress=None):
+    fill_content_hashes(db, project_id)
+    if progress is not None:
+        progress.flush()
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS dedupe_prompts (prompt_id INTEGER PRIMARY KEY, keep_id INTEGER)")
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS dedupe_examples (example_id INTEGER PRIMARY KEY, keep_id INTEGER)")
         sql = """
-            UPDATE tasks
-            SET status = 'completed'
-            WHERE id = ?
+            INSERT INTO temp.dedupe_prompts (prompt_id, keep_id)
+            SELECT id, keep_id FROM (
+                SELECT id, MIN(id) OVER (PARTITION BY style, content_hash) AS keep_id
+                FROM prompts
+                WHERE project_id = ? AND content_hash IS NOT NULL
+            )
+            WHERE id != keep_id
+        """
+        prompts_removed = db.execute(sql, (project_id,)).rowcount
+        if progress is not None:
+            progress.check_cancelled()
+
+        # Statistics are recounted for every prompt that can lose or gain rows: the
+        #   duplicates, what they're merged into and prompts with repeated completions
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS dedupe_stats (prompt_id INTEGER PRIMARY KEY)")
+        sql = """
+            INSERT OR IGNORE INTO temp.dedupe_stats (prompt_id)
+            SELECT prompt_id FROM temp.dedupe_prompts
+            UNION SELECT keep_id FROM temp.dedupe_prompts
+            UNION SELECT prompt_id FROM examples
+                WHERE prompt_id IN (SELECT id FROM prompts WHERE project_id = ?) AND content_hash IS NOT NULL
+                GROUP BY prompt_id, content_hash
+                HAVING COUNT(*) > 1
+        """
+        db.execute(sql, (project_id,))
+        stats = StatsDelta()
+        stats.remove(db, "SELECT prompt_id FROM temp.dedupe_stats")
+
+        moved = "(SELECT keep_id FROM temp.dedupe_prompts WHERE dedupe_prompts.prompt_id = {column})"
+        selection = "(SELECT prompt_id FROM temp.dedupe_prompts)"
+        db.execute(f"UPDATE examples SET prompt_id = {moved.format(column='examples.prompt_id')} WHERE prompt_id IN {selection}")
+        db.execute(f"UPDATE tags SET prompt_id = {moved.format(column='tags.prompt_id')} WHERE prompt_id IN {selection}")
+        db.execute(f"DELETE FROM prompt_values WHERE prompt_id IN {selection}")
+        db.execute(f"DELETE FROM prompts WHERE id IN {selection}")
+        if progress is not None:
+            progress.check_cancelled()
+
+        sql = """
+            INSERT INTO temp.dedupe_examples (example_id, keep_id)
+            SELECT id, keep_id FROM (
+                SELECT id, MIN(id) OVER (PARTITION BY prompt_id, content_hash) AS keep_id
+                FROM examples
+                WHERE prompt_id IN (SELECT id FROM prompts WHERE project_id = ?) AND content_hash IS NOT NULL
+            )
+            WHERE id != keep_id
         """
-        db.execute(sql, (task_id,))
+        examples_removed = db.execute(sql, (project_id,)).rowcount
+        sql = """
+            UPDATE tags SET example_id = (SELECT keep_id FROM temp.dedupe_examples WHERE dedupe_examples.example_id = tags.example_id)
+            WHERE example_id IN (SELECT example_id FROM temp.dedupe_examples)
+        """
+        db.execute(sql)
+        db.execute("DELETE FROM examples WHERE id IN (SELECT example_id FROM temp.dedupe_examples)")
+
+        # Only the prompts and examples things were merged into can have new repeats
+        sql = """
+            DELETE FROM tags WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY prompt_id, example_id, tag_id ORDER BY id) AS n
+                    FROM tags
+                    WHERE prompt_id IN (SELECT keep_id FROM temp.dedupe_prompts)
+                    OR example_id IN (SELECT keep_id FROM temp.dedupe_examples)
+                )
+                WHERE n > 1
+            )
+        """
+        db.execute(sql)
+        stats.add(db, "SELECT prompt_id FROM temp.dedupe_stats")
+        stats.write(db)
+        db.execute("DELETE FROM temp.dedupe_prompts")
+        db.execute("DELETE FROM temp.dedupe_examples")
+        db.execute("DELETE FROM temp.dedupe_stats")
+        if progress is not None:
+            progress.check_cancelled()
         db.commit()
-    except:
+    except Exception:
+        db.rollback()
+        raise
+    _invalidate_counts()
+    return prompts_removed, examples_removed
+
+
+def queue_dedupe(db, project_id, priority=0):
+    task_id = enqueue_task(db, "dedupe", {'project_id': project_id}, priority)
+    session['warn_parallelism'] = True
+    return task_id
+
+
+def dedupe_background(db_path, task_id, project_id):
+    db = connect_db(db_path)
+    progress = ProgressReporter(db_path, task_id)
+    try:
+        # Removing duplicates is all or nothing, so progress is just what was removed
+        prompts_removed, examples_removed = dedupe_project(db, project_id, progress)
+        progress.update(rows_done=prompts_removed + examples_removed)
+        progress.close()
+        finish_task(db, task_id, 'completed')
+    except TaskCancelled:
+        progress.close()
+        finish_task(db, task_id, 'cancelled')
+    except Exception as e:
+        progress.close()
+        finish_task(db, task_id, 'failed')
+        print(f"Error occurred: {e}")
+
+    db.close()
+
+"""
+
+Near duplicates
+
+find_near_duplicates clusters a project's prompts whose text (values and
+   completions) is similar, though not necessarily identical, using MinHash
+   signatures (see minhash.py):
+
+   1. update_minhashes brings the minhashes table up to date, computing the
+      signatures of new and changed prompts in a pool of worker processes, each
+      reading its own id range (see minhash_partition)
+   2. cluster_near_duplicates finds candidate pairs by LSH banding, one GROUP BY
+      on a slice of the signature blobs per band, keeps the pairs whose estimated
+      similarity is at least threshold and writes the connected groups of them to
+      near_duplicates, replacing the project's earlier clusters
+
+Within a band's bucket each prompt is only compared to the bucket's lowest id, so
+   a bucket of n prompts costs n - 1 comparisons rather than n * (n - 1) / 2.
+   Pairs missed that way usually meet through the other bands or the clustering.
+
+/manifest can filter by cluster, and the keep_one bulk action deletes every prompt
+   in a selection that has an older near-duplicate.
+
+"""
+# Prompts per signature range, which bounds how many signatures a range returns at once
+MINHASH_RANGE_PROMPTS = 20000
+# Signatures loaded at a time to check candidate pairs
+MINHASH_LOAD_BATCH = 10000
+
+
+def minhash_partition(job):
+    db_path, project_id, min_id, max_id = job
+    db = connect_db(db_path)
+    try:
         sql = """
-        UPDATE tasks
-        SET status = 'failed'
-        WHERE id = ?;
+            SELECT prompts.id,
+                (
+                    SELECT json_group_array(value) FROM (
+                        SELECT value FROM prompt_values
+                        WHERE prompt_values.prompt_id = prompts.id
+                        ORDER BY key
+                    )
+                ) AS prompt_values,
+                (
+                    SELECT json_group_array(completion) FROM (
+                        SELECT completion FROM examples
+                        WHERE examples.prompt_id = prompts.id
+                        ORDER BY id
+                    )
+                ) AS completions,
+                minhashes.source_hash
+            FROM prompts
+            LEFT JOIN minhashes ON minhashes.prompt_id = prompts.id
+            WHERE prompts.project_id = ? AND prompts.id BETWEEN ? AND ?
         """
-        db.execute(sql, (task_id,))
+        read = 0
+        updates = []
+        for row in db.execute(sql, (project_id, min_id, max_id)):
+            read += 1
+            texts = json.loads(row['prompt_values']) + json.loads(row['completions'])
+            source_hash = content_hash(texts)
+            if source_hash == row['source_hash']:
+                continue
+            signature, shingles = minhash.signature(texts)
+            updates.append((row['id'], source_hash, shingles, signature))
+    finally:
+        db.close()
+    return read, updates
+
+
+# Returns the number of signatures that were (re)computed
+def update_minhashes(db, db_path, project_id, workers=1, progress=None):
+    total = db.execute("SELECT COUNT(*) AS total FROM prompts WHERE project_id = ?", (project_id,)).fetchone()['total']
+    if progress is not None:
+        progress.rows_total = total
+        progress.flush()
+    parts = max(-(-total // MINHASH_RANGE_PROMPTS), workers * 4 if total >= MINHASH_RANGE_PROMPTS else 1)
+    sql = """
+        SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM (
+            SELECT id, NTILE(?) OVER (ORDER BY id) AS part
+            FROM prompts
+            WHERE project_id = ?
+        )
+        GROUP BY part
+        ORDER BY part
+    """
+    jobs = [(db_path, project_id, row['min_id'], row['max_id']) for row in db.execute(sql, (parts, project_id)).fetchall()]
+
+    done = 0
+    updated = 0
+
+    def write(results):
+        nonlocal done, updated
+        for read, updates in results:
+            db.executemany("INSERT OR REPLACE INTO minhashes (prompt_id, source_hash, shingles, signature) VALUES (?, ?, ?, ?)", updates)
+            db.commit()
+            done += read
+            updated += len(updates)
+            if progress is not None:
+                progress.update(rows_done=done)
+
+    if workers > 1 and len(jobs) > 1:
+        with task_context.Pool(min(workers, len(jobs))) as pool:
+            write(pool.imap_unordered(minhash_partition, jobs))
+    else:
+        write(map(minhash_partition, jobs))
+    return updated
+
+
+# Returns (clusters, prompts in them)
+def cluster_near_duplicates(db, project_id, threshold, progress=None):
+    bands, rows = minhash.lsh_bands(threshold)
+    width = rows * 4
+
+    parents = {}
+
+    def find(x):
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    best = {}
+    checked = set()
+    for band in range(bands):
+        sql = """
+            SELECT group_concat(minhashes.prompt_id) AS ids
+            FROM minhashes
+            JOIN prompts ON prompts.id = minhashes.prompt_id
+            WHERE prompts.project_id = ? AND minhashes.shingles > 0
+            GROUP BY substr(minhashes.signature, ?, ?)
+            HAVING COUNT(*) > 1
+        """
+        pairs = []
+        for row in db.execute(sql, (project_id, band * width + 1, width)):
+            ids = sorted(int(x) for x in row['ids'].split(','))
+            for other in ids[1:]:
+                pair = (ids[0], other)
+                if pair not in checked:
+                    checked.add(pair)
+                    pairs.append(pair)
+
+        # Signatures are loaded for one band's pairs at a time, so memory stays
+        #   bounded by the candidates rather than the project
+        for i in range(0, len(pairs), MINHASH_LOAD_BATCH):
+            batch = pairs[i:i + MINHASH_LOAD_BATCH]
+            ids = {x for pair in batch for x in pair}
+            sql = "SELECT prompt_id, signature FROM minhashes WHERE prompt_id IN (SELECT value FROM json_each(?))"
+            signatures = {row['prompt_id']: row['signature'] for row in db.execute(sql, (json.dumps(list(ids)),))}
+            for a, b in batch:
+                value = minhash.similarity(signatures[a], signatures[b])
+                if value < threshold:
+                    continue
+                for x in (a, b):
+                    parents.setdefault(x, x)
+                    best[x] = max(best.get(x, 0), value)
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parents[max(root_a, root_b)] = min(root_a, root_b)
+        if progress is not None:
+            progress.update()
+
+    # Roots are always the lowest id of their cluster
+    rows = [(x, find(x), project_id, best[x]) for x in parents]
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("DELETE FROM near_duplicates WHERE project_id = ?", (project_id,))
+        db.executemany("INSERT INTO near_duplicates (prompt_id, cluster_id, project_id, similarity) VALUES (?, ?, ?, ?)", rows)
         db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len({row[1] for row in rows}), len(rows)
+
+
+def find_near_duplicates(db, db_path, project_id, threshold=0.8, workers=1, progress=None):
+    update_minhashes(db, db_path, project_id, workers, progress)
+    return cluster_near_duplicates(db, project_id, threshold, progress)
+
+
+def queue_near_duplicates(db, project_id, threshold, priority=0):
+    payload = {
+        'project_id': project_id,
+        'threshold': threshold,
+        'workers': current_app.config['NEAR_DUPLICATE_WORKERS'],
+    }
+    task_id = enqueue_task(db, "near_duplicates", payload, priority)
+    session['warn_parallelism'] = True
+    return task_id
 
-    shutil.copyfile(new_db_path, old_db_path)
+
+def near_duplicates_background(db_path, task_id, project_id, threshold=0.8, workers=1):
+    db = connect_db(db_path)
+    progress = ProgressReporter(db_path, task_id)
+    if minhash.numpy is None:
+        print(f"Warning: numpy isn't installed, so task {task_id} computes MinHash signatures in plain python, at about half the speed")
+    try:
+        find_near_duplicates(db, db_path, project_id, threshold, workers, progress)
+        progress.close()
+        finish_task(db, task_id, 'completed')
+    except TaskCancelled:
+        progress.close()
+        finish_task(db, task_id, 'cancelled')
+    except Exception as e:
+        progress.close()
+        finish_task(db, task_id, 'failed')
+        print(f"Error occurred: {e}")
+
+    db.close()
 
 """
 
 Will export a json file, which is a list of dictionaries with each key matching
    a named argument in the template format string.
 All named arguments are present in every dictionary.
+With render, each dictionary also has the fully formatted prompt and completion
+   under RENDERED_KEY ("text").
 Does not include tags at the moment.
 
 If filename is None or "", the filename becomes "export.json"
 
+fmt is 'json' or 'jsonl' and compress gzips the output (see writers.ExportWriter).
+The export is split into shards files of equal record counts when shards is set,
+   or into files of about shard_size bytes when that is set.
+
+With more than one worker, the matching prompts are split into id ranges that are
+   rendered in parallel (see export_partition). The output is the same either way.
+
+With sample, only a uniform random sample of that many of the matching prompts is
+   exported (see sample_prompt_ids), drawn with seed, or a new seed when that is None.
+
+With splits (a writers.ExportSplits), the prompts are divided between the splits in
+   the same pass, and each split gets its own files (and row in exports), named
+   like "export-train.json". Sharding applies to each split separately.
+
 """
-def export(db, filename, tags=[], content="", example="", project_id=None, style_id=None):
+def export(db, filename, tags=[], content="", example="", project_id=None, style_id=None, search_mode="fts", fmt="json", compress=False, shards=None, shard_size=None, workers=1, priority=0, render=False, sample=None, seed=None, splits=None):
 
     if not filename:
         filename = "export.json"
+    if sample and seed is None:
+        seed = random_seed()
+
+    payload = {
+        'exports_path': current_app.config['EXPORTS_PATH'],
+        'filename': filename,
+        'content': content,
+        'tags': tags,
+        'example': example,
+        'style_id': style_id,
+        'project_id': project_id,
+        'search_mode': search_mode,
+        'fmt': fmt,
+        'compress': compress,
+        'shards': shards,
+        'shard_size': shard_size,
+        'workers': workers,
+        'render': render,
+        'sample': sample,
+        'seed': seed,
+    }
+    if splits is not None:
+        payload.update({
+            'splits': splits.ratios,
+            'split_salt': splits.salt,
+            'split_key': splits.key,
+        })
+    task_id = enqueue_task(db, "export", payload, priority)
 
-    c = db.cursor()
-    sql = """
-        INSERT INTO tasks (`type`, `status`)
-        VALUES ("export",
-                "in_progress"
-                );
-    """
-    c.execute(sql)
-    db.commit()
+    # Make session token to warn user about parallelism
+    session['warn_parallelism'] = True
 
-    task_id = c.lastrowid
+    return task_id
 
-    p = multiprocessing.Process(target=export_background, args=(current_app.instance_path, current_app.config['DATABASE'], current_app.config['EXPORTS_PATH'], task_id, filename, content, tags, example, style_id, project_id))
-    p.start()
+def export_background(db_path, exports_path, task_id, filename, content, tags, example, style_id, project_id, search_mode="fts", fmt="json", compress=False, shards=None, shard_size=None, workers=1, render=False, sample=None, seed=None, splits=None, split_salt="", split_key="id"):
 
-    sql = """
-        UPDATE tasks SET `pid` = ?
-        WHERE id = ?
+    db = connect_db(db_path)
+    progress = ProgressReporter(db_path, task_id)
+
+    writers = []
+    try:
+        prompt_ids = None
+        if sample:
+            prompt_ids = sample_prompt_ids(db, sample, seed, content, example, tags, project_id, style_id, search_mode, require_example=True)
+        filters = (content, tags, example, style_id, project_id, search_mode, prompt_ids)
+        total = count_export_records(db, *filters)
+        progress.rows_total = total
+        progress.flush()
+
+        # One writer per split, or just one; records come with the index of theirs
+        if splits:
+            splits = ExportSplits(splits, split_salt, split_key)
+            stem, ext = shard_names(filename, fmt, compress)
+            total_ratio = sum(ratio for _, ratio in splits.ratios)
+            outputs = [(f"{stem}-{name}{ext}", ratio / total_ratio) for name, ratio in splits.ratios]
+        else:
+            splits = None
+            outputs = [(filename, 1.0)]
+        for output_name, share in outputs:
+            records_per_shard = None
+            if shards and shards > 1:
+                # Split sizes are only known at the end, so they're sharded by their expected size
+                records_per_shard = max(-(-int(total * share) // shards), 1)
+            writers.append(ExportWriter(exports_path, output_name, fmt, compress, records_per_shard, shard_size))
+
+        def update_progress():
+            progress.update(rows_done=sum(w.records for w in writers), bytes_done=sum(w.bytes_written for w in writers))
+
+        ranges = []
+        if workers > 1:
+            # A few ranges per worker keeps them all busy when some ranges have more examples,
+            #   but small exports aren't worth starting a pool for
+            ranges = get_export_ranges(db, min(workers * 4, total // EXPORT_RANGE_MIN_RECORDS), *filters)
+        if len(ranges) > 1:
+            with tempfile.TemporaryDirectory(dir=exports_path) as parts_path:
+                jobs = [(db_path, os.path.join(parts_path, f"{i:05d}.part"), fmt, filters, render, splits, min_id, max_id) for i, (min_id, max_id) in enumerate(ranges)]
+                with task_context.Pool(min(workers, len(jobs))) as pool:
+                    # imap hands back the parts in id order, as soon as each one is done
+                    for part_path in pool.imap(export_partition, jobs):
+                        for split, data in iter_export_part(part_path):
+                            writers[split].write_encoded(data)
+                            update_progress()
+                        os.remove(part_path)
+        else:
+            for split, record in _iter_split_records(db, filters, render, splits):
+                writers[split].write(record)
+                update_progress()
+
+        sql = """
+                INSERT INTO exports (`filename`, `format`, `manifest`, `num_files`, `num_records`)
+                VALUES (?, ?, ?, ?, ?);
+            """
+        for writer in writers:
+            manifest = writer.close()
+            # Single file exports are still listed (and downloaded) by that file
+            main_file = writer.shards[0]['filename'] if len(writer.shards) == 1 else manifest
+            db.execute(sql, (main_file, fmt, manifest, len(writer.shards), writer.records))
+        update_progress()
+        db.commit()
+
+        progress.close()
+        finish_task(db, task_id, 'completed')
+    except TaskCancelled:
+        for writer in writers:
+            writer.abort()
+        progress.close()
+        finish_task(db, task_id, 'cancelled')
+    except Exception as e:
+        for writer in writers:
+            writer.abort()
+        progress.close()
+        finish_task(db, task_id, 'failed')
+        print(f"Error occurred: {e}")
+
+    db.close()
+
+# The fewest records a parallel export hands to one worker at a time
+EXPORT_RANGE_MIN_RECORDS = 10000
+
+# Splits the prompts an export would include into at most parts contiguous id ranges
+#   of (about) equal prompt counts, returned as inclusive (min_id, max_id) pairs in order
+def get_export_ranges(db, parts, content="", tags=[], example="", style_id=None, project_id=None, search_mode="fts", prompt_ids=None):
+    if parts < 2:
+        return []
+    filter_sql, args = _prompt_filter_sql(content, example, tags, project_id, style_id, search_mode, require_example=True, prompt_ids=prompt_ids)
+    sql = f"""
+        SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM (
+            SELECT prompts.id AS id, NTILE(?) OVER (ORDER BY prompts.id) AS part
+            {filter_sql}
+        )
+        GROUP BY part
+        ORDER BY part
     """
-    c.execute(sql, (p.pid, task_id))
+    rows = db.execute(sql, (parts, *args)).fetchall()
+    return [(row['min_id'], row['max_id']) for row in rows]
 
-    # Make session token to warn user about parallelism
-    session['warn_parallelism'] = True
 
-    db.commit()
-    status = {
-        'pid': p.pid,
-        'status': 'in_progress'
-    }
-    return status
+"""
 
-def export_background(instance_path, old_db_path, exports_path, task_id, filename, content, tags, example, style_id, project_id):
+Renders the export records of one prompt id range into a part file, in a pool worker
 
-    db, new_db_path = get_tmp_db(instance_path, old_db_path)
+Records are encoded exactly as ExportWriter would encode them and written as
+   frames prefixed with their length and split index, so the parent only has to
+   copy them into the writers in range order (see iter_export_part), and their
+   compression and sharding see the same streams as a serial export.
 
-    # The try catch is not compehensive
-    # There should be an option for the user to check on the program itself (via its pid)
+"""
+def export_partition(job):
+    db_path, part_path, fmt, filters, render, splits, min_id, max_id = job
+    db = connect_db(db_path)
+    encoder = get_encoder(fmt)
     try:
-        if not example:
-            example = "%"
-        if not content:
-            content = "%"
-
-        args = [example]
-
-        tag_query_str = ""
-        if tags and len(tags) > 0:
-            tag_query_str = f"JOIN tags ON prompts.id = tags.prompt_id AND ("
-            for i, tag in enumerate(tags):
-                tag_query_str += f"tags.value LIKE ?"
-                args.append(tag)
-                if i < len(tags) - 1:
-                    tag_query_str += " OR "
-            tag_query_str += ")"
-
-        args.append(content)
-
-        proj_id_query = ""
-        if project_id:
-            proj_id_query = "AND prompts.project_id = ?"
-            args.append(project_id)
-
-        style_id_query = ""
-        if style_id:
-            style_id_query = "AND prompts.style = ?"
-            args.append(style_id)
+        with open(part_path, 'wb') as f:
+            for split, record in _iter_split_records(db, filters, render, splits, min_id, max_id):
+                data = encoder.encode(record).encode('utf-8')
+                f.write(struct.pack('<IH', len(data), split))
+                f.write(data)
+    finally:
+        db.close()
+    return part_path
+
+
+# Yields the (split index, encoded record) pairs of a part file written by export_partition
+def iter_export_part(part_path):
+    with open(part_path, 'rb') as f:
+        while True:
+            header = f.read(6)
+            if not header:
+                return
+            length, split = struct.unpack('<IH', header)
+            yield split, f.read(length).decode('utf-8')
+
+
+# (split index, record) pairs of an export, with every record in split 0 without splits
+def _iter_split_records(db, filters, render, splits, min_id=None, max_id=None):
+    records = iter_export_records(db, *filters, render=render, min_id=min_id, max_id=max_id, splits=splits)
+    if splits is None:
+        return ((0, record) for record in records)
+    return records
+
+
+# The number of records an export with these filters would have (one per example)
+def count_export_records(db, content="", tags=[], example="", style_id=None, project_id=None, search_mode="fts", prompt_ids=None):
+    filter_sql, args = _prompt_filter_sql(content, example, tags, project_id, style_id, search_mode, require_example=True, prompt_ids=prompt_ids)
+    sql = f"""
+        SELECT COUNT(*) AS total FROM examples
+        WHERE examples.prompt_id IN (SELECT prompts.id {filter_sql})
+    """
+    return db.execute(sql, tuple(args)).fetchone()['total']
 
-        # notice that in string, there is no option to put "LEFT" join on examples
-        # this is beacuse we really do only want prompts with examples in this case
-        sql = f"""
-            SELECT DISTINCT prompts.*, styles.template as template, styles.completion_key as completion_key
-            FROM prompts
-            JOIN prompt_values ON prompts.id = prompt_values.prompt_id
-            JOIN styles ON prompts.style = styles.id AND prompt_values.key = styles.preview_key
-            JOIN examples ON prompts.id = examples.prompt_id AND examples.completion LIKE ?
-            {tag_query_str}
-            WHERE prompt_values.value LIKE ?
-            {proj_id_query}
-            {style_id_query}
-        """
-        c = db.cursor()
-        res = c.execute(sql, tuple(args))
-        prompts = res.fetchall()
 
-        path = os.path.join(exports_path, filename)
-        fhand = open(path, 'w')
-        fhand.write('[\n')
+"""
 
-        encoder = SQLiteJSONEncoder(indent=4)
+Yields one export record per example of every prompt matching the filters
+
+Each record is a dictionary with a key for every named argument of the prompt's
+   style template, in template order, with the example's completion as the
+   completion key (which comes last); see StylePlan.record.
+With render, each record also gets a RENDERED_KEY field with the prompt and
+   completion formatted through the style's template (after the completion key,
+   replacing a template argument of the same name). Records are rendered a fetch
+   at a time, with one StylePlan.render_batch call per style in the batch.
+Everything comes from one query that walks the matching prompts in id order, with
+   each prompt's values and completions gathered into json by correlated
+   subqueries on their prompt_id indexes. Rows are streamed from the cursor, so
+   memory use doesn't depend on the size of the export.
+min_id and max_id limit the records to an inclusive range of prompt ids, and
+   prompt_ids to a list of them (see sample_prompt_ids).
+With splits (a writers.ExportSplits), (split index, record) pairs are yielded
+   instead, each prompt's records all going to the split its hash picks.
 
-        for k, prompt in enumerate(prompts):
-            sql = """
-                SELECT * FROM examples
-                WHERE prompt_id = ?
-            """
-            examples = c.execute(sql, (prompt['id'],)).fetchall()
+"""
+def iter_export_records(db, content="", tags=[], example="", style_id=None, project_id=None, search_mode="fts", prompt_ids=None, fetch_size=1000, min_id=None, max_id=None, render=False, splits=None):
 
-            sql = """
-                SELECT * FROM prompt_values
-                WHERE prompt_id = ?
-            """
-            prompt_values = c.execute(sql, (prompt['id'],)).fetchall()
-            prompt_value_kwargs = {x['key']: x['value'] for x in prompt_values}
+    plans = {}
+    for style in db.execute("SELECT id, template, completion_key, preview_key FROM styles").fetchall():
+        plans[style['id']] = plan_for_style(style)
 
-            template = prompt['template']
-            named_args = get_named_arguments(template)
+    # We really do only want prompts with examples in this case
+    filter_sql, args = _prompt_filter_sql(content, example, tags, project_id, style_id, search_mode, require_example=True, prompt_ids=prompt_ids)
 
-            kwargs = {}
-            for arg in named_args:
-                if arg in prompt_value_kwargs:
-                    kwargs[arg] = prompt_value_kwargs[arg]
-                elif arg != prompt['completion_key']:
-                    kwargs[arg] = ""
+    range_query = ""
+    if min_id is not None:
+        range_query += "AND prompts.id >= ?"
+        args.append(min_id)
+    if max_id is not None:
+        range_query += " AND prompts.id <= ?"
+        args.append(max_id)
 
-            for i, ex in enumerate(examples):
-                kwargs[prompt['completion_key']] = ex['completion']
-            
-                json_data = encoder.encode(kwargs)
+    sql = f"""
+        SELECT prompts.id AS prompt_id, prompts.style AS style,
+            (
+                SELECT json_group_object(v.key, v.value)
+                FROM prompt_values AS v
+                WHERE v.prompt_id = prompts.id
+            ) AS prompt_values,
+            (
+                SELECT json_group_array(completion) FROM (
+                    SELECT e.completion FROM examples AS e
+                    WHERE e.prompt_id = prompts.id
+                    ORDER BY e.id
+                )
+            ) AS completions
+        {filter_sql}
+        {range_query}
+        ORDER BY prompts.id
+    """
+    cursor = db.execute(sql, tuple(args))
 
-                fhand.write(json_data)
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+        batch = []
+        for row in rows:
+            plan = plans[row['style']]
+            values = json.loads(row['prompt_values'])
+            kwargs = plan.record(values)
+            split = splits.assign(row['prompt_id'], plan, values) if splits is not None else None
 
-                if i < len(examples) - 1:
-                    fhand.write(",\n")
-            
-            if k < len(prompts) - 1:
-                fhand.write(",\n")
+            for completion in json.loads(row['completions']):
+                record = dict(kwargs)
+                record[plan.completion_key] = completion
+                batch.append((plan, record, split))
 
-        fhand.write(']')
-        fhand.close()
+        if render:
+            # Consecutive prompts mostly share a style, so most batches are one call
+            for plan, group in itertools.groupby(batch, key=itemgetter(0)):
+                records = [record for _, record, _ in group]
+                for record, text in zip(records, plan.render_batch(records)):
+                    record[RENDERED_KEY] = text
 
-        sql = """
-                INSERT INTO exports (`filename`)
-                VALUES (?);
-            """
-        db.execute(sql, (filename,))
+        for _, record, split in batch:
+            yield record if splits is None else (split, record)
 
-        sql = """
-                    UPDATE tasks
-                    SET status = 'completed'
-                    WHERE id = ?;
-                """
-        db.execute(sql, (task_id,))
-        db.commit()
-    except Exception as e:
-        sql = """
-            UPDATE tasks
-            SET status = 'failed'
-            WHERE pid = ?;
-        """
-        db.execute(sql, (os.getpid(),))
-        db.commit()
-        print(f"Error occurred: {e}")
 
-    shutil.copyfile(new_db_path, old_db_path)
+# The field rendered text goes in, in exports and from render_examples
+RENDERED_KEY = "text"
 
-def search_prompts(db, limit=None, offset=None, content_arg=None, example_arg=None, tags_arg=None, project_id=None, style_id=None):
-    
-    offset = 0 if not offset else offset
-    limit = 100 if not limit else limit
-    content_arg = "%" if not content_arg else "%" + content_arg + "%"
-    
-    x = "" if example_arg else "LEFT"
-    example_arg = "%" if not example_arg else "%" + example_arg + "%"
 
-    args = [example_arg]
+"""
+
+Renders every example of the given prompts through its style's template
+
+Returns a list of {prompt_id, example_id, text} dictionaries, in prompt id and
+   then example id order. Prompts without examples (and ids that don't exist)
+   are left out.
 
-    tag_query_str = ""
-    if tags_arg and len(tags_arg) > 0:
-        tag_query_str = f"JOIN tags ON prompts.id = tags.prompt_id AND ("
-        for i, tag in enumerate(tags_arg):
-            tag_query_str += f"tags.value LIKE ?"
-            args.append(tag)
-            if i < len(tags_arg) - 1:
-                tag_query_str += " OR "
-        tag_query_str += ")"
+"""
+def render_examples(db, prompt_ids):
 
-    args.extend([content_arg])
+    plans = {}
+    for style in db.execute("SELECT id, template, completion_key, preview_key FROM styles").fetchall():
+        plans[style['id']] = plan_for_style(style)
+
+    sql = """
+        SELECT prompts.id AS prompt_id, prompts.style AS style,
+            (
+                SELECT json_group_object(v.key, v.value)
+                FROM prompt_values AS v
+                WHERE v.prompt_id = prompts.id
+            ) AS prompt_values,
+            (
+                SELECT json_group_array(json_array(id, completion)) FROM (
+                    SELECT e.id, e.completion FROM examples AS e
+                    WHERE e.prompt_id = prompts.id
+                    ORDER BY e.id
+                )
+            ) AS examples
+        FROM prompts
+        WHERE prompts.id IN (SELECT value FROM json_each(?))
+        ORDER BY prompts.id
+    """
+    rendered = []
+    for row in db.execute(sql, (json.dumps([int(x) for x in prompt_ids]),)).fetchall():
+        plan = plans[row['style']]
+        values = json.loads(row['prompt_values'])
+        examples = json.loads(row['examples'])
+        records = []
+        for _, completion in examples:
+            record = dict(values)
+            record[plan.completion_key] = completion
+            records.append(record)
+        for (example_id, _), text in zip(examples, plan.render_batch(records)):
+            rendered.append({'prompt_id': row['prompt_id'], 'example_id': example_id, RENDERED_KEY: text})
+    return rendered
+
+
+# Builds a substring filter on a text column, returning the sql and its args
+# In 'fts' mode, the filter is a MATCH against the column's trigram index
+#   (see migrations/0001_fts.sql), otherwise it is a LIKE scan over every row
+# Trigrams need at least three characters, so shorter terms always use LIKE
+def _text_filter(id_column, text_column, fts_table, term, search_mode="fts"):
+    if not term:
+        return "1", []
+    if _uses_fts(term, search_mode):
+        # Quoting the term as a phrase keeps FTS5 query syntax out of user input
+        phrase = '"' + term.replace('"', '""') + '"'
+        return f"{id_column} IN (SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH ?)", [phrase]
+    return f"{text_column} LIKE ?", ["%" + term + "%"]
+
+
+# Builds the tag filter on prompts, returning the sql (to AND onto a WHERE) and its args
+# Plain terms match prompts with any of them, "+tag" terms prompts that also have
+#   every one of those, and "-tag" terms prompts that have none of those
+# Terms are LIKE patterns (so case-insensitive) resolved against tag_names first,
+#   which leaves each term a lookup in the (tag_id, prompt_id) index
+# per_prompt checks each prompt's own tags instead, for when there are few prompts
+#   to check and gathering every prompt with a tag would cost more
+def _tag_filter(tags_arg, per_prompt=False):
+    any_of = []
+    all_of = []
+    none_of = []
+    for term in tags_arg or ():
+        group = any_of
+        if term.startswith("+"):
+            group, term = all_of, term[1:]
+        elif term.startswith("-"):
+            group, term = none_of, term[1:]
+        if term:
+            group.append(term)
+
+    def tag_ids(terms):
+        return "(SELECT id FROM tag_names WHERE " + " OR ".join(["tag_names.value LIKE ?"] * len(terms)) + ")"
+
+    def has_tag(terms):
+        if per_prompt:
+            return f"EXISTS (SELECT 1 FROM tags WHERE tags.prompt_id = prompts.id AND tags.tag_id IN {tag_ids(terms)})"
+        return f"prompts.id IN (SELECT prompt_id FROM tags WHERE tag_id IN {tag_ids(terms)})"
+
+    queries = []
+    args = []
+    if any_of:
+        queries.append(f"AND {has_tag(any_of)}")
+        args.extend(any_of)
+    for term in all_of:
+        queries.append(f"AND {has_tag([term])}")
+        args.append(term)
+    if none_of:
+        queries.append(f"AND NOT EXISTS (SELECT 1 FROM tags WHERE tags.prompt_id = prompts.id AND tags.tag_id IN {tag_ids(none_of)})")
+        args.extend(none_of)
+    return "\n".join(queries), args
+
+
+def _uses_fts(term, search_mode="fts"):
+    return bool(term) and search_mode == "fts" and len(term) >= 3
+
+
+# Returns the FROM/WHERE clause shared by the prompt search, its count and exports
+# Each prompt appears once, joined to the prompt value under its style's preview key
+# Example and tag filters are EXISTS and IN semi-joins, so they never duplicate prompts
+# cluster_arg is 'all' for every prompt in a near-duplicate cluster, or a cluster's id
+# prompt_ids, when given, limits the prompts to a list of ids (like a sample's)
+# The other filters are then checked prompt by prompt, with LIKE and each prompt's own
+#   tags, since gathering every match from the full-text and tag indexes first
+#   would cost more than checking the listed prompts
+def _prompt_filter_sql(content_arg=None, example_arg=None, tags_arg=None, project_id=None, style_id=None, search_mode="fts", require_example=False, cluster_arg=None, prompt_ids=None):
+
+    if prompt_ids is not None:
+        search_mode = "like"
+
+    content_query, args = _text_filter("prompt_values.id", "prompt_values.value", "prompt_values_fts", content_arg, search_mode)
+
+    example_query = ""
+    if example_arg or require_example:
+        example_match, example_args = _text_filter("examples.id", "examples.completion", "examples_fts", example_arg, search_mode)
+        if _uses_fts(example_arg, search_mode):
+            # A semi-join runs the full-text lookup once, where a correlated EXISTS
+            #   would run it again for every prompt
+            example_query = f"AND prompts.id IN (SELECT prompt_id FROM examples WHERE {example_match})"
+        else:
+            example_query = f"AND EXISTS (SELECT 1 FROM examples WHERE examples.prompt_id = prompts.id AND {example_match})"
+        args.extend(example_args)
+
+    tag_query, tag_args = _tag_filter(tags_arg, per_prompt=prompt_ids is not None)
+    args.extend(tag_args)
 
     proj_id_query = ""
     if project_id:
@@ -429,70 +1484,551 @@ def search_prompts(db, limit=None, offset=None, content_arg=None, example_arg=No
         style_id_query = "AND prompts.style = ?"
         args.append(style_id)
 
-    args.extend([limit, offset])
+    cluster_query = ""
+    if cluster_arg == 'all':
+        cluster_query = "AND prompts.id IN (SELECT prompt_id FROM near_duplicates)"
+    elif cluster_arg:
+        cluster_query = "AND prompts.id IN (SELECT prompt_id FROM near_duplicates WHERE cluster_id = ?)"
+        args.append(cluster_arg)
+
+    ids_query = ""
+    if prompt_ids is not None:
+        ids_query = "AND prompts.id IN (SELECT value FROM json_each(?))"
+        args.append(json.dumps([int(x) for x in prompt_ids]))
 
     sql = f"""
-        WITH main_search AS
-        (
-            SELECT DISTINCT prompts.*, prompt_values.*
-            FROM prompts
-            JOIN prompt_values ON prompts.id = prompt_values.prompt_id
-            JOIN styles ON prompts.style = styles.id AND prompt_values.key = styles.preview_key
-            {x} JOIN examples ON prompts.id = examples.prompt_id AND examples.completion LIKE ?
-            {tag_query_str}
-            WHERE prompt_values.value LIKE ?
-            {proj_id_query}
-            {style_id_query}
-        )
-        SELECT main_search.*, GROUP_CONCAT(t.value) AS tags, COUNT(*) OVER() AS total_results
-        FROM main_search
-        LEFT JOIN tags t ON main_search.prompt_id = t.prompt_id
-        GROUP BY main_search.id
+        FROM prompts
+        JOIN styles ON prompts.style = styles.id
+        JOIN prompt_values ON prompts.id = prompt_values.prompt_id AND prompt_values.key = styles.preview_key
+        WHERE {content_query}
+        {example_query}
+        {tag_query}
+        {proj_id_query}
+        {style_id_query}
+        {cluster_query}
+        {ids_query}
+    """
+    return sql, args
+
+
+# The columns of the prompt rows that search_prompts and sample_prompts return
+_PROMPT_COLUMNS = """
+    prompts.id AS prompt_id, prompts.style, prompts.project_id, prompts.created_at,
+    prompt_values.key, prompt_values.value,
+    (
+        SELECT GROUP_CONCAT(tag_names.value) FROM tags
+        JOIN tag_names ON tag_names.id = tags.tag_id
+        WHERE tags.prompt_id = prompts.id
+    ) AS tags,
+    (SELECT cluster_id FROM near_duplicates WHERE near_duplicates.prompt_id = prompts.id) AS cluster_id
+"""
+
+
+"""
+
+Keyset pagination over prompts.id
+
+cursor is a token from encode_cursor (or None for the first page). Returns the page
+   of results along with the tokens for the next and previous pages, which are None
+   when there is nothing further in that direction.
+Each page costs one index range scan, no matter how deep it is.
+
+"""
+def search_prompts(db, limit=None, cursor=None, content_arg=None, example_arg=None, tags_arg=None, project_id=None, style_id=None, search_mode="fts", cluster_arg=None):
+
+    limit = 100 if not limit else limit
+    direction, cursor_id = decode_cursor(cursor)
+
+    filter_sql, args = _prompt_filter_sql(content_arg, example_arg, tags_arg, project_id, style_id, search_mode, cluster_arg=cluster_arg)
+
+    cursor_query = ""
+    order = "ASC"
+    if direction == "next":
+        cursor_query = "AND prompts.id > ?"
+        args.append(cursor_id)
+    elif direction == "prev":
+        cursor_query = "AND prompts.id < ?"
+        args.append(cursor_id)
+    if direction in ("prev", "last"):
+        order = "DESC"
+
+    # One extra row tells us whether there is another page after this one
+    args.append(limit + 1)
+
+    sql = f"""
+        SELECT {_PROMPT_COLUMNS}
+        {filter_sql}
+        {cursor_query}
+        ORDER BY prompts.id {order}
         LIMIT ?
-        OFFSET ?
     """
 
-    results = db.execute(sql, tuple(args))
-    fetched = results.fetchall()
-    total_results = 0 if len(fetched) == 0 else fetched[0]['total_results']
-    return fetched, total_results
+    fetched = db.execute(sql, tuple(args)).fetchall()
+    has_more = len(fetched) > limit
+    fetched = fetched[:limit]
+
+    if order == "DESC":
+        fetched.reverse()
+        has_next = direction == "prev"
+        has_prev = has_more
+    else:
+        has_next = has_more
+        has_prev = direction == "next"
+
+    next_cursor = encode_cursor("next", fetched[-1]['prompt_id']) if fetched and has_next else None
+    prev_cursor = encode_cursor("prev", fetched[0]['prompt_id']) if fetched and has_prev else None
+    return fetched, next_cursor, prev_cursor
+
+
+# Total result counts, cached per filter signature
+# Counting has to visit every matching row, so the count is only recomputed when
+#   the cached one is older than COUNT_CACHE_TTL or a write in this process cleared it
+_count_cache = {}
+_COUNT_CACHE_SIZE = 256
+
+def _invalidate_counts():
+    _count_cache.clear()
+
+def count_prompts(db, content_arg=None, example_arg=None, tags_arg=None, project_id=None, style_id=None, search_mode="fts", ttl=30, cluster_arg=None):
+
+    signature = (content_arg or "", example_arg or "", tuple(tags_arg or ()), str(project_id or ""), str(style_id or ""), search_mode, str(cluster_arg or ""))
+    cached = _count_cache.get(signature)
+    if cached and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+
+    filter_sql, args = _prompt_filter_sql(content_arg, example_arg, tags_arg, project_id, style_id, search_mode, cluster_arg=cluster_arg)
+    total = db.execute(f"SELECT COUNT(*) AS total {filter_sql}", tuple(args)).fetchone()['total']
+
+    if len(_count_cache) >= _COUNT_CACHE_SIZE:
+        _count_cache.clear()
+    _count_cache[signature] = (time.monotonic(), total)
+    return total
+
+
+"""
+
+Uniform random samples of the prompts matching search_prompts' filters
+
+Ids are drawn from random.Random(seed), so the same seed on the same data always
+   gives the same sample.
+Ids are first drawn uniformly from the range of prompt ids and kept when they belong
+   to a prompt that matches the filters, checking each round of draws with one
+   query of rowid lookups. That only touches about n / (fraction of ids matching)
+   prompts, so small samples are fast whatever the size of the table. When so few
+   ids match that rejection would need more than SAMPLE_MAX_DRAWS of the id range,
+   the matching ids are streamed through a reservoir sample instead.
+Either way every set of n matching prompts is equally likely.
+
+"""
+SAMPLE_MAX_DRAWS = 0.25
+
+
+def sample_prompt_ids(db, n, seed=None, content_arg=None, example_arg=None, tags_arg=None, project_id=None, style_id=None, search_mode="fts", cluster_arg=None, require_example=False):
+    rng = random.Random(seed)
+    filters = (content_arg, example_arg, tags_arg, project_id, style_id, search_mode, require_example, cluster_arg)
+    if n <= 0:
+        return []
+
+    # Separate subqueries, since sqlite only answers a lone MIN or MAX from the index
+    row = db.execute("SELECT (SELECT MIN(id) FROM prompts) AS min_id, (SELECT MAX(id) FROM prompts) AS max_id").fetchone()
+    if row['min_id'] is None:
+        return []
+    low, high = row['min_id'], row['max_id']
+    budget = int((high - low + 1) * SAMPLE_MAX_DRAWS)
+
+    sample = []
+    drawn = set()
+    hit_rate = 1.0
+    while len(sample) < n:
+        # A little more than the expected number of draws, to usually finish in one round
+        wanted = n - len(sample)
+        size = int(wanted / hit_rate * 1.2) + 8
+        if len(drawn) + size > budget:
+            return _reservoir_sample_ids(db, n, rng, filters)
+        candidates = []
+        for _ in range(size):
+            x = rng.randint(low, high)
+            if x not in drawn:
+                drawn.add(x)
+                candidates.append(x)
+        filter_sql, args = _prompt_filter_sql(*filters, prompt_ids=candidates)
+        found = {row[0] for row in db.execute(f"SELECT prompts.id {filter_sql}", tuple(args))}
+        # Keeping hits in the order they were drawn keeps the sample uniform
+        sample.extend([x for x in candidates if x in found][:wanted])
+        hit_rate = max(len(sample), 1) / len(drawn)
+    return sorted(sample)
+
+
+# Algorithm R over every matching id
+def _reservoir_sample_ids(db, n, rng, filters):
+    filter_sql, args = _prompt_filter_sql(*filters)
+    sample = []
+    for i, row in enumerate(db.execute(f"SELECT prompts.id {filter_sql} ORDER BY prompts.id", tuple(args))):
+        if i < n:
+            sample.append(row[0])
+        else:
+            j = rng.randrange(i + 1)
+            if j < n:
+                sample[j] = row[0]
+    return sorted(sample)
+
+
+# The rows of a sample, as search_prompts returns them, in id order
+def sample_prompts(db, n, seed=None, content_arg=None, example_arg=None, tags_arg=None, project_id=None, style_id=None, search_mode="fts", cluster_arg=None):
+    prompt_ids = sample_prompt_ids(db, n, seed, content_arg, example_arg, tags_arg, project_id, style_id, search_mode, cluster_arg)
+    filter_sql, args = _prompt_filter_sql(content_arg, example_arg, tags_arg, project_id, style_id, search_mode, cluster_arg=cluster_arg, prompt_ids=prompt_ids)
+    sql = f"""
+        SELECT {_PROMPT_COLUMNS}
+        {filter_sql}
+        ORDER BY prompts.id
+    """
+    return db.execute(sql, tuple(args)).fetchall()
+
+
+"""
+
+Dataset statistics
+
+dataset_stats holds counts per project and style, each under a metric, a key and
+   a bucket (see migrations/0008_dataset_stats.sql):
+
+   prompts, examples              - row counts
+   value_chars, value_tokens      - histograms of each prompt key's values, by
+                                    characters and by whitespace separated tokens
+   completion_chars, completion_tokens
+                                  - the same for completions
+   value_empty, completion_empty  - values and completions that are only whitespace
+   completions_per_prompt         - prompts by their number of completions (bucket)
+   tag                            - prompts with each tag (key)
 
+Length buckets are powers of two: bucket b counts lengths from 2 ** (b - 1) up to
+   2 ** b - 1, and bucket 0 counts empty ones.
 
+The write paths keep the table current without rescanning anything. Each one
+   takes the counts of the prompts it touches out before writing (StatsDelta.remove)
+   and puts their new counts back afterwards (StatsDelta.add), in the same
+   transaction, so the cost follows the rows written. rebuild_stats recounts a
+   project from scratch, for databases from before the table and as a repair.
+
+"""
+STATS_METRICS = ('prompts', 'examples', 'value_chars', 'value_tokens', 'value_empty', 'completion_chars', 'completion_tokens', 'completion_empty', 'completions_per_prompt', 'tag')
+
+
+class StatsDelta:
+
+    def __init__(self):
+        self.counts = {}
+
+    def _count(self, project_id, style_id, metric, key, bucket, amount):
+        index = (project_id, style_id or 0, metric, key, bucket)
+        self.counts[index] = self.counts.get(index, 0) + amount
+
+    def _text(self, project_id, style_id, prefix, key, text, sign):
+        text = text or ""
+        self._count(project_id, style_id, prefix + '_chars', key, len(text).bit_length(), sign)
+        self._count(project_id, style_id, prefix + '_tokens', key, len(text.split()).bit_length(), sign)
+        if not text.strip():
+            self._count(project_id, style_id, prefix + '_empty', key, 0, sign)
+
+    # values are (key, value) pairs, completions and tags are lists of text
+    def prompt(self, project_id, style_id, values, completions, tags, sign=1):
+        self._count(project_id, style_id, 'prompts', '', 0, sign)
+        for key, value in values:
+            self._text(project_id, style_id, 'value', key, value, sign)
+        for completion in completions:
+            self._count(project_id, style_id, 'examples', '', 0, sign)
+            self._text(project_id, style_id, 'completion', '', completion, sign)
+        self._count(project_id, style_id, 'completions_per_prompt', '', len(completions), sign)
+        for tag in tags:
+            self._count(project_id, style_id, 'tag', tag, 0, sign)
+
+    # Counts the prompts (as they are now) whose ids selection returns
+    def add(self, db, selection, args=(), sign=1):
+        prompts = {}
+        sql = f"SELECT id, project_id, style FROM prompts WHERE id IN ({selection})"
+        for row in db.execute(sql, args):
+            prompts[row['id']] = (row['project_id'], row['style'], [], [], [])
+        if not prompts:
+            return
+        ids = json.dumps(list(prompts))
+        for row in db.execute("SELECT prompt_id, key, value FROM prompt_values WHERE prompt_id IN (SELECT value FROM json_each(?))", (ids,)):
+            prompts[row['prompt_id']][2].append((row['key'], row['value']))
+        for row in db.execute("SELECT prompt_id, completion FROM examples WHERE prompt_id IN (SELECT value FROM json_each(?))", (ids,)):
+            prompts[row['prompt_id']][3].append(row['completion'])
+        sql = """
+            SELECT tags.prompt_id, tag_names.value FROM tags
+            JOIN tag_names ON tag_names.id = tags.tag_id
+            WHERE tags.prompt_id IN (SELECT value FROM json_each(?))
+        """
+        for row in db.execute(sql, (ids,)):
+            prompts[row['prompt_id']][4].append(row['value'])
+        for project_id, style_id, values, completions, tags in prompts.values():
+            self.prompt(project_id, style_id, values, completions, tags, sign)
+
+    def remove(self, db, selection, args=()):
+        self.add(db, selection, args, sign=-1)
+
+    # Doesn't commit
+    def write(self, db):
+        rows = [index + (amount,) for index, amount in self.counts.items() if amount]
+        sql = """
+            INSERT INTO dataset_stats (project_id, style_id, metric, key, bucket, count)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (project_id, style_id, metric, key, bucket) DO UPDATE SET count = count + excluded.count
+        """
+        db.executemany(sql, rows)
+        projects = json.dumps(list({row[0] for row in rows}))
+        db.execute("DELETE FROM dataset_stats WHERE project_id IN (SELECT value FROM json_each(?)) AND count = 0", (projects,))
+        self.counts = {}
+
+
+# Recounts a project's statistics in one transaction, returning the prompts counted
+def rebuild_stats(db, project_id, batch_size=5000, progress=None):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("DELETE FROM dataset_stats WHERE project_id = ?", (project_id,))
+        counted = 0
+        last_id = 0
+        while True:
+            ids = [row['id'] for row in db.execute("SELECT id FROM prompts WHERE project_id = ? AND id > ? ORDER BY id LIMIT ?", (project_id, last_id, batch_size))]
+            if not ids:
+                break
+            delta = StatsDelta()
+            delta.add(db, "SELECT value FROM json_each(?)", (json.dumps(ids),))
+            delta.write(db)
+            counted += len(ids)
+            last_id = ids[-1]
+            if progress is not None:
+                progress.check_cancelled()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return counted
+
+
+def queue_rebuild_stats(db, project_id, priority=0):
+    task_id = enqueue_task(db, "rebuild_stats", {'project_id': project_id}, priority)
+    session['warn_parallelism'] = True
+    return task_id
+
+
+def rebuild_stats_background(db_path, task_id, project_id):
+    db = connect_db(db_path)
+    progress = ProgressReporter(db_path, task_id)
+    try:
+        progress.rows_total = db.execute("SELECT COUNT(*) AS total FROM prompts WHERE project_id = ?", (project_id,)).fetchone()['total']
+        progress.flush()
+        # The recount holds the write lock, so progress is only written once it's done
+        progress.update(rows_done=rebuild_stats(db, project_id, progress=progress))
+        progress.close()
+        finish_task(db, task_id, 'completed')
+    except TaskCancelled:
+        progress.close()
+        finish_task(db, task_id, 'cancelled')
+    except Exception as e:
+        progress.close()
+        finish_task(db, task_id, 'failed')
+        print(f"Error occurred: {e}")
+
+    db.close()
+
+
+# The statistics of a project, or of one of its styles, as
+#   {metric: {key: {bucket: count}}}
+def get_stats(db, project_id, style_id=None):
+    sql = """
+        SELECT metric, key, bucket, SUM(count) AS count FROM dataset_stats
+        WHERE project_id = ? AND (? IS NULL OR style_id = ?)
+        GROUP BY metric, key, bucket
+        ORDER BY metric, key, bucket
+    """
+    stats = {metric: {} for metric in STATS_METRICS}
+    for row in db.execute(sql, (project_id, style_id, style_id)):
+        stats.setdefault(row['metric'], {}).setdefault(row['key'], {})[row['bucket']] = row['count']
+    return stats
+
+
+"""
+
+Task queue
+
+Bulk uploads and exports are rows in the tasks table, run by the workers in
+   worker.py. A task starts out 'queued', is claimed by one worker ('in_progress')
+   and ends up 'completed', 'failed' or 'cancelled'.
+payload holds the keyword arguments of the task's function (see worker.TASK_FUNCTIONS).
+
+"""
+class TaskCancelled(Exception):
+    pass
+
+
+TASKS_QUEUED = counter('praetor_tasks_queued_total', 'Tasks queued by this process.', ('type',))
+
+def enqueue_task(db, task_type, payload, priority=0):
+    sql = """
+        INSERT INTO tasks (`type`, `status`, `priority`, `payload`)
+        VALUES (?, 'queued', ?, ?)
+    """
+    c = db.execute(sql, (task_type, priority, json.dumps(payload)))
+    db.commit()
+    TASKS_QUEUED.inc(task_type)
+    return c.lastrowid
+
+
+# Marks the next queued task as being run by the process pid, and returns it
+# Returns None when nothing is queued
+# Claiming is a single UPDATE, so two workers can never claim the same task
+def claim_task(db, pid):
+    sql = """
+        UPDATE tasks
+        SET status = 'in_progress', pid = ?, started_at = CURRENT_TIMESTAMP
+        WHERE id = (
+            SELECT id FROM tasks
+            WHERE status = 'queued'
+            ORDER BY priority DESC, id
+            LIMIT 1
+        )
+        RETURNING *
+    """
+    task = db.execute(sql, (pid,)).fetchone()
+    db.commit()
+    return task
+
+
+# result is an optional summary of what the task did, stored as json
+def finish_task(db, task_id, status, result=None):
+    sql = """
+        UPDATE tasks
+        SET status = ?, finished_at = CURRENT_TIMESTAMP, result = ?
+        WHERE id = ?
+    """
+    db.execute(sql, (status, json.dumps(result) if result is not None else None, task_id))
+    db.commit()
+
+
+"""
+
+Records the progress of a running task in its row of the tasks table
+
+Task functions call update() as often as they like (it only costs a clock read),
+   and the row is written at most once every interval seconds, along with a
+   heartbeat time that shows the task hasn't stalled.
+Each write also picks up cancel requests, raising TaskCancelled in the task, so
+   tasks should only call update() at points where stopping is safe.
+It has its own connection, because a task's own connection may be partway through
+   reading a query, and couldn't start writing without risking a busy error.
+
+"""
+class ProgressReporter:
+
+    def __init__(self, db_path, task_id, interval=1.0, rows_total=None, bytes_total=None):
+        self.db = connect_db(db_path)
+        self.task_id = task_id
+        self.interval = interval
+        self.rows_done = 0
+        self.rows_total = rows_total
+        self.bytes_done = 0
+        self.bytes_total = bytes_total
+        self._last_write = time.monotonic()
+
+    def update(self, rows_done=None, bytes_done=None):
+        if rows_done is not None:
+            self.rows_done = rows_done
+        if bytes_done is not None:
+            self.bytes_done = bytes_done
+        if time.monotonic() - self._last_write >= self.interval:
+            self.flush()
+
+    def _write(self):
+        sql = """
+            UPDATE tasks
+            SET rows_done = ?, rows_total = ?, bytes_done = ?, bytes_total = ?, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            RETURNING cancel_requested
+        """
+        task = self.db.execute(sql, (self.rows_done, self.rows_total, self.bytes_done, self.bytes_total, self.task_id)).fetchone()
+        self.db.commit()
+        self._last_write = time.monotonic()
+        return task
+
+    def flush(self):
+        task = self._write()
+        if task and task['cancel_requested']:
+            raise TaskCancelled()
+
+    # Like flush, but only reads, so it can be called while the task's own
+    #   connection holds the write lock
+    def check_cancelled(self):
+        task = self.db.execute("SELECT cancel_requested FROM tasks WHERE id = ?", (self.task_id,)).fetchone()
+        if task and task['cancel_requested']:
+            raise TaskCancelled()
+
+    # Writes the final numbers, whether or not the task was cancelled
+    def close(self):
+        self._write()
+        self.db.close()
+
+
+# A queued task is cancelled straight away; a running one is asked to stop,
+#   and is marked cancelled by its worker once it has
+# Returns the task's status afterwards
+def cancel_task(db, task_id):
+    sql = """
+        UPDATE tasks
+        SET status = 'cancelled', cancel_requested = 1, finished_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'queued'
+        RETURNING type, payload
+    """
+    task = db.execute(sql, (task_id,)).fetchone()
+    db.commit()
+    if task:
+        # The upload would otherwise have been deleted by the task itself
+        if task['type'] == 'bulk_upload':
+            path = json.loads(task['payload'])['path']
+            if os.path.exists(path):
+                os.remove(path)
+        return 'cancelled'
+
+    sql = """
+        UPDATE tasks
+        SET cancel_requested = 1
+        WHERE id = ? AND status = 'in_progress'
+    """
+    db.execute(sql, (task_id,))
+    db.commit()
+    task = db.execute("SELECT status FROM tasks WHERE id = ?", (task_id,)).fetchone()
+    return task['status'] if task else None
+
+
+# Fails the running tasks whose worker process has died
+def recover_tasks(db):
+    sql = """
+        SELECT id, pid FROM tasks
+        WHERE status = 'in_progress'
+    """
+    for task in db.execute(sql).fetchall():
+        if task['pid'] is None or not psutil.pid_exists(task['pid']):
+            finish_task(db, task['id'], 'failed')
+
+
+# Whether any task is queued or running (after failing any whose worker died)
 def check_running(db):
-    tasks = get_tasks(db)
-    has_oustanding = False
-    for task in tasks:
-        if task['status'] == 'in_progress':
-            task_id = task['id']
-            pid = task['pid']
-
-            def update_records(task_id):
-                sql = """
-                    UPDATE tasks
-                    SET status = 'failed'
-                    WHERE id = ?;
-                """
-                db.execute(sql, (task_id,))
-                db.commit()
-            try:
-                process = psutil.Process(pid)
-                # Check if process with pid exists
-                if process.is_running() and process.ppid() == os.getpid():
-                    # is still in progress, nothing to do
-                    has_oustanding = True
-                else:
-                    update_records(task_id)
-            except psutil.NoSuchProcess:
-                update_records(task_id)
-    if not has_oustanding:
+    recover_tasks(db)
+    sql = """
+        SELECT COUNT(*) AS outstanding FROM tasks
+        WHERE status IN ('queued', 'in_progress')
+    """
+    has_outstanding = db.execute(sql).fetchone()['outstanding'] > 0
+    if not has_outstanding:
         session['warn_parallelism'] = False
 
-    return has_oustanding
+    return has_outstanding
 
 
 def get_tasks(db):
     sql = """
-        SELECT * FROM tasks ORDER BY created_at DESC
+        SELECT * FROM tasks ORDER BY created_at DESC, id DESC
     """
     tasks = db.execute(sql)
     return tasks.fetchall()
@@ -508,7 +2044,7 @@ def get_export_by_id(db, id):
     sql = """
         SELECT * FROM exports WHERE id = ?
     """
-    export = db.execute(sql, id)
+    export = db.execute(sql, (id,))
     return export.fetchone()
 
 def get_prompt_by_id(db, id):
@@ -521,9 +2057,10 @@ def get_prompt_by_id(db, id):
 def get_examples_by_prompt_id(db, prompt_id, with_tags=True):
     if with_tags:
         sql = """
-        SELECT e.*, GROUP_CONCAT(t.value) AS tags
+        SELECT e.*, GROUP_CONCAT(n.value) AS tags
         FROM examples e
         LEFT JOIN tags t ON e.id = t.example_id
+        LEFT JOIN tag_names n ON n.id = t.tag_id
         WHERE e.prompt_id = ?
         GROUP BY e.id
         """
@@ -534,6 +2071,66 @@ def get_examples_by_prompt_id(db, prompt_id, with_tags=True):
     examples = db.execute(sql, (prompt_id,))
     return examples.fetchall()
 
+"""
+
+Metadata cache
+
+Projects, styles and style keys are read on almost every page but hardly ever
+   change, so the getters below keep their results in a bounded LRU cache, and
+   callers get their own copy of a cached list.
+The cache is cleared by this module's writes to those tables, and whenever
+   PRAGMA data_version shows that some other connection (another request, a
+   worker, the flask CLI) has committed since the connection in hand last looked.
+   That also clears it for unrelated writes, but checking costs no table reads.
+
+"""
+METADATA_CACHE_SIZE = 256
+
+_metadata_cache = OrderedDict()
+_metadata_lock = threading.Lock()
+# The data_version each connection saw when it last used the cache
+_data_versions = weakref.WeakKeyDictionary()
+
+
+def _invalidate_metadata():
+    with _metadata_lock:
+        _metadata_cache.clear()
+
+
+def _metadata_is_current(db):
+    version = db.execute("PRAGMA data_version").fetchone()[0]
+    # A connection we haven't seen before can't tell what changed before it opened
+    try:
+        current = _data_versions.get(db) == version
+        _data_versions[db] = version
+    except TypeError:
+        # Not from connect_db, so it can't be tracked
+        return False
+    return current
+
+
+def _cached_metadata(function):
+    @functools.wraps(function)
+    def wrapper(db, *args):
+        key = (function.__name__, *(str(x) for x in args))
+        with _metadata_lock:
+            if not _metadata_is_current(db):
+                _metadata_cache.clear()
+            if key in _metadata_cache:
+                _metadata_cache.move_to_end(key)
+                result = _metadata_cache[key]
+                return list(result) if isinstance(result, list) else result
+
+        result = function(db, *args)
+
+        with _metadata_lock:
+            _metadata_cache[key] = result
+            if len(_metadata_cache) > METADATA_CACHE_SIZE:
+                _metadata_cache.popitem(last=False)
+        return list(result) if isinstance(result, list) else result
+    return wrapper
+
+@_cached_metadata
 def get_projects(db):
     sql = """
         SELECT * FROM projects ORDER BY created_at DESC
@@ -541,6 +2138,7 @@ def get_projects(db):
     examples = db.execute(sql)
     return examples.fetchall()
 
+@_cached_metadata
 def get_project_by_id(db, id):
     sql = """
         SELECT * FROM projects WHERE id = ?
@@ -548,6 +2146,7 @@ def get_project_by_id(db, id):
     examples = db.execute(sql, (id,))
     return examples.fetchone()
 
+@_cached_metadata
 def get_styles_by_project_id(db, id):
     sql = """
         SELECT * FROM styles WHERE project_id = ?
@@ -555,6 +2154,7 @@ def get_styles_by_project_id(db, id):
     examples = db.execute(sql, (id,))
     return examples.fetchall()
 
+@_cached_metadata
 def get_styles(db):
     sql = """
         SELECT * FROM styles ORDER BY created_at DESC
@@ -562,6 +2162,7 @@ def get_styles(db):
     styles = db.execute(sql)
     return styles.fetchall()
 
+@_cached_metadata
 def get_style_by_id(db, id):
     sql = """
         SELECT * FROM styles WHERE id = ?
@@ -569,6 +2170,7 @@ def get_style_by_id(db, id):
     style = db.execute(sql, (id,))
     return style.fetchone()
 
+@_cached_metadata
 def get_keys_by_style_id(db, id):
     sql = """
         SELECT * FROM style_keys WHERE style_id = ?
@@ -578,7 +2180,10 @@ def get_keys_by_style_id(db, id):
 
 def get_tags_by_prompt_id(db, prompt_id):
     sql = """
-        SELECT * FROM tags WHERE prompt_id = ?
+        SELECT tags.*, tag_names.value
+        FROM tags
+        JOIN tag_names ON tag_names.id = tags.tag_id
+        WHERE tags.prompt_id = ?
     """
     tags = db.execute(sql, (prompt_id,))
     return tags.fetchall()
@@ -600,6 +2205,7 @@ def add_project(db, name, description):
     c.execute(sql, (name, description))
     proj_id = c.lastrowid
     db.commit()
+    _invalidate_metadata()
     return proj_id
 
 def add_style(db, idtext, format_string, completion_key, preview_key, project_id, style_keys):
@@ -620,6 +2226,7 @@ def add_style(db, idtext, format_string, completion_key, preview_key, project_id
         """
         c.execute(sql, (key, style_id))
     db.commit()
+    _invalidate_metadata()
 
     return style_id
 
@@ -637,6 +2244,7 @@ def delete_project(db, project_id):
 
     # Remove all associated prompts
     c.execute("DELETE FROM prompts WHERE project_id = ?", (project_id,))
+    c.execute("DELETE FROM dataset_stats WHERE project_id = ?", (project_id,))
 
     # Remove all associated styles
     c.execute("DELETE FROM styles WHERE project_id = ?", (project_id,))
@@ -645,6 +2253,8 @@ def delete_project(db, project_id):
     c.execute("DELETE FROM projects WHERE id = ?", (project_id,))
 
     db.commit()
+    _invalidate_counts()
+    _invalidate_metadata()
 
 def update_project(db, project_id, description, name):
     c = db.cursor()
@@ -655,17 +2265,24 @@ def update_project(db, project_id, description, name):
         c.execute("UPDATE projects SET name = ? WHERE id = ?", (name, project_id))
 
     db.commit()
+    _invalidate_metadata()
 
 def update_style(db, style_id, id_text, template, completion_key, preview_key):
     c = db.cursor()
 
-    new_keys = get_named_arguments(template)
+    old_style = c.execute("SELECT * FROM styles WHERE id = ?", (style_id,)).fetchone()
+    new_keys = get_style_plan(template).keys
     c.execute("SELECT * FROM style_keys WHERE style_id = ?", (style_id,))
     old_keys = c.fetchall()
 
     missing_keys = [x['name'] for x in old_keys if x['name'] not in new_keys]
     added_keys = [x for x in new_keys if x not in [y['name'] for y in old_keys]]
 
+    # Removed keys take their values (and so their value counts) with them
+    stats = StatsDelta()
+    if missing_keys:
+        stats.remove(db, "SELECT id FROM prompts WHERE style = ?", (style_id,))
+
     for key in missing_keys:
         c.execute("DELETE FROM style_keys WHERE name LIKE ? AND style_id = ?", (key, style_id))
         # Also we delete all the prompt values associated with the removed key
@@ -679,6 +2296,10 @@ def update_style(db, style_id, id_text, template, completion_key, preview_key):
             )
             """, (key, style_id))
 
+    if missing_keys:
+        stats.add(db, "SELECT id FROM prompts WHERE style = ?", (style_id,))
+        stats.write(db)
+
     for key in added_keys:
         sql = """
             INSERT INTO style_keys (name, style_id)
@@ -695,7 +2316,16 @@ def update_style(db, style_id, id_text, template, completion_key, preview_key):
     if preview_key:
         c.execute("UPDATE styles SET preview_key = ? WHERE id = ?", (preview_key, style_id))
 
+    # Prompt hashes cover the prompt keys in template order, so they're recomputed
+    #   (when next needed, see fill_content_hashes) if those have changed
+    if old_style is not None:
+        new_plan = get_style_plan(template or old_style['template'], completion_key or old_style['completion_key'])
+        if plan_for_style(old_style).prompt_keys != new_plan.prompt_keys:
+            c.execute("UPDATE prompts SET content_hash = NULL WHERE style = ?", (style_id,))
+
     db.commit()
+    _invalidate_counts()
+    _invalidate_metadata()
 
 
 def delete_style(db, style_id):
@@ -712,9 +2342,12 @@ def delete_style(db, style_id):
 
     # Remove all associated prompts
     c.execute("DELETE FROM prompts WHERE style = ?", (style_id,))
+    c.execute("DELETE FROM dataset_stats WHERE style_id = ?", (style_id,))
 
     # Remove the style
     c.execute("DELETE FROM styles WHERE id = ?", (style_id,))
 
     db.commit()
+    _invalidate_counts()
+    _invalidate_metadata()
 
@@ -1,6 +1,7 @@
 import os
 from flask import (
     Blueprint,
+    abort,
     redirect,
     render_template,
     request,
@@ -9,8 +10,10 @@ from flask import (
     session
 )
 from app.db import get_db
-from app.db_wrappers import export, get_exports, get_export_by_id, get_styles, get_projects, check_running
+from app.db_wrappers import export, get_exports, render_examples, get_export_by_id, get_styles, get_projects
 from app.utils import tag_string_to_list
+from app.writers import FORMATS, SPLIT_KEYS, ExportSplits, read_manifest
+from werkzeug.utils import secure_filename
 
 bp = Blueprint('exporting', __name__)
 
@@ -19,10 +22,14 @@ def exp():
     db = get_db()
     if request.method == "POST":
 
-        if check_running(db):
-            return render_template('export.html', styles=get_styles(db), projects=get_projects(db), error="Cannot create new export while current task is incomplete.")
-
         filename = request.form.get('filename') if request.form.get('filename') else "export.json"
+        filename = secure_filename(filename) or "export.json"
+
+        fmt = request.form.get('format') if request.form.get('format') in FORMATS else "json"
+        compress = request.form.get('compress') == "gzip"
+        shards = request.form.get('shards', type=int)
+        shard_size_mb = request.form.get('shard_size_mb', type=float)
+        shard_size = int(shard_size_mb * 1e6) if shard_size_mb else None
 
         tags = request.form.get('tags')
         tags = tag_string_to_list(tags)
@@ -31,21 +38,71 @@ def exp():
         style_id = request.form.get('style_id')
         project_id = request.form.get('project_id')
         example = request.form.get('example')
+        priority = request.form.get('priority', 0, type=int)
+        render = request.form.get('render') == "text"
+        # Exports only a random sample of this many of the matching prompts
+        sample = request.form.get('sample', type=int)
+        if sample is not None and sample < 1:
+            sample = None
+        seed = request.form.get('seed', type=int)
+
+        # Splits like "train=0.8,validation=0.1,test=0.1" (see writers.ExportSplits)
+        splits = None
+        if request.form.get('splits'):
+            split_key = request.form.get('split_key') if request.form.get('split_key') in SPLIT_KEYS else "id"
+            try:
+                splits = ExportSplits.parse(request.form.get('splits'), request.form.get('split_salt', ""), split_key)
+            except ValueError as e:
+                return render_template('export.html', styles=get_styles(db), projects=get_projects(db), error=str(e))
 
-        export(db, filename=filename, tags=tags, content=content, example=example, project_id=project_id, style_id=style_id)
+        export(db, filename=filename, tags=tags, content=content, example=example, project_id=project_id, style_id=style_id, search_mode=current_app.config['SEARCH_MODE'], fmt=fmt, compress=compress, shards=shards, shard_size=shard_size, workers=current_app.config['EXPORT_WORKERS'], priority=priority, render=render, sample=sample, seed=seed, splits=splits)
         return redirect("/tasks")
 
     return render_template('export.html', styles=get_styles(db), projects=get_projects(db))
 
+# Renders the examples of a list of prompts through their styles' templates
+# Takes {"prompt_ids": [...]} and returns {"rendered": [{prompt_id, example_id, text}, ...]}
+@bp.route('/render.json', methods=('POST',))
+def render_json():
+    form_data = request.get_json(silent=True) or {}
+    prompt_ids = form_data.get('prompt_ids')
+    if not isinstance(prompt_ids, list):
+        abort(400)
+    try:
+        prompt_ids = [int(x) for x in prompt_ids]
+    except (TypeError, ValueError):
+        abort(400)
+    return {'rendered': render_examples(get_db(), prompt_ids)}
+
 @bp.route('/exports', methods=('GET',))
 def exps():
     download_id = request.args.get('download_id')
     db = get_db()
+    exports_path = current_app.config.get('EXPORTS_PATH')
     if download_id:
         row = get_export_by_id(db, download_id)
-        path = os.path.join(current_app.config.get('EXPORTS_PATH'), row['filename'])
+        if row is None:
+            abort(404)
+        filename = row['filename']
+        # Shards of a multi-file export are downloaded one at a time
+        shard = request.args.get('file')
+        if shard:
+            if not row['manifest']:
+                abort(404)
+            manifest = read_manifest(exports_path, row['manifest'])
+            if shard not in [x['filename'] for x in manifest['shards']] + [row['manifest']]:
+                abort(404)
+            filename = shard
+        path = os.path.join(exports_path, filename)
         return send_file(path, as_attachment=True)
 
     exports = get_exports(db)
-    
-    return render_template('exports.html', exports=exports)
+    shards = {}
+    for row in exports:
+        if row['manifest'] and row['num_files'] and row['num_files'] > 1:
+            try:
+                shards[row['id']] = read_manifest(exports_path, row['manifest'])['shards']
+            except OSError:
+                shards[row['id']] = []
+
+    return render_template('exports.html', exports=exports, shards=shards)
@@ -1,11 +1,15 @@
 from flask import (
     Blueprint,
+    abort,
+    current_app,
+    redirect,
     render_template,
-    request
+    request,
+    url_for
 )
 from app.db import get_db
-from app.db_wrappers import delete_project, get_projects, search_prompts, get_styles, delete_prompt
-from app.utils import tag_string_to_list
+from app.db_wrappers import delete_project, get_projects, search_prompts, count_prompts, sample_prompts, get_styles, bulk_action, queue_bulk_action, BULK_ACTIONS
+from app.utils import tag_string_to_list, encode_cursor, random_seed
 import json
 
 bp = Blueprint('home', __name__)
@@ -22,21 +26,48 @@ def manifest():
 
     # When a user selects prompts via check box and clicks a button
     # This will trigger a special json response, not the web page
+    # The action applies to prompt_ids, or to every prompt matching filters when
+    #   those are given instead (see db_wrappers.bulk_action)
     if request.method == 'POST':
         form_data = request.json
-        selected_prompts = form_data['prompt_ids']
         action = form_data['action']
-        if action == 'delete':
-            # One day, this should probably be batched
-            for prompt_id in selected_prompts:
-                delete_prompt(db, prompt_id)
-        response_text = json.dumps({'response': 'success', 'prompts_affected': selected_prompts, 'action': action})
+        if action not in BULK_ACTIONS:
+            abort(400)
+        tag = form_data.get('tag') or None
+        if action in ('add_tag', 'remove_tag') and not tag:
+            abort(400)
+        project_id = form_data.get('project_id') or None
+        style_id = form_data.get('style_id') or None
+        if action == 'move' and not (project_id or style_id):
+            abort(400)
+
+        search_mode = current_app.config['SEARCH_MODE']
+        filters = form_data.get('filters')
+        prompt_ids = None
+        if filters is not None:
+            filters = {
+                'content_arg': filters.get('content') or None,
+                'example_arg': filters.get('example') or None,
+                'tags_arg': tag_string_to_list(filters.get('tags')),
+                'project_id': filters.get('project_id') or None,
+                'style_id': filters.get('style_id') or None,
+                'cluster_arg': filters.get('near_duplicates') or None,
+            }
+            selected = count_prompts(db, **filters, search_mode=search_mode, ttl=0)
+        else:
+            prompt_ids = [int(x) for x in form_data['prompt_ids']]
+            selected = len(prompt_ids)
+
+        task_id = None
+        if selected > current_app.config['BULK_ACTION_INLINE_LIMIT']:
+            task_id = queue_bulk_action(db, action, prompt_ids, filters, tag, project_id, style_id, search_mode)
+        else:
+            selected = bulk_action(db, action, prompt_ids, filters, tag, project_id, style_id, search_mode)
+        response_text = json.dumps({'response': 'success', 'prompts_affected': selected, 'action': action, 'task_id': task_id})
         return response_text
 
     limit = 100
-    offset = request.args.get('offset')
-    if not offset:
-        offset = 0
+    cursor = request.args.get('cursor')
 
     content_arg = request.args.get("content")
     example_arg = request.args.get("example")
@@ -48,10 +79,58 @@ def manifest():
     style_id_arg = request.args.get("style_id")
     if style_id_arg == "":
         style_id_arg = None
+    # 'all' or a cluster id (see db_wrappers.find_near_duplicates)
+    cluster_arg = request.args.get("near_duplicates") or None
+
+    # sample shows a random sample of that many results instead of a page
+    # Samples without a seed get one, so that the page can be reloaded and exported
+    sample = _sample_size()
+    seed = request.args.get("seed", type=int)
+    if sample and seed is None:
+        params = request.args.to_dict()
+        params['seed'] = random_seed()
+        return redirect(url_for(request.endpoint, **params))
 
     projects = get_projects(db)
     styles = get_styles(db)
 
-    prompts, total_results = search_prompts(db, limit, offset, content_arg, example_arg, tags_arg, project_id_arg, style_id_arg)
+    search_mode = current_app.config['SEARCH_MODE']
+    if sample:
+        prompts = sample_prompts(db, sample, seed, content_arg, example_arg, tags_arg, project_id_arg, style_id_arg, search_mode=search_mode, cluster_arg=cluster_arg)
+        next_cursor = prev_cursor = None
+    else:
+        prompts, next_cursor, prev_cursor = search_prompts(db, limit, cursor, content_arg, example_arg, tags_arg, project_id_arg, style_id_arg, search_mode=search_mode, cluster_arg=cluster_arg)
+    total_results = count_prompts(db, content_arg, example_arg, tags_arg, project_id_arg, style_id_arg, search_mode=search_mode, ttl=current_app.config['COUNT_CACHE_TTL'], cluster_arg=cluster_arg)
+
+    return render_template('manifest.html', prompts=prompts, page_size=limit, total_results=total_results, next_cursor=next_cursor, prev_cursor=prev_cursor, last_cursor=encode_cursor("last"), projects=projects, styles=styles, sample=sample, seed=seed)
+
+
+# A uniform random sample of the prompts matching the same filters as /manifest
+# Takes n (the sample size, at most MAX_SAMPLE_SIZE) and an optional seed,
+#   and returns {"seed": seed, "prompts": [...]} with the rows in id order
+@bp.route('/sample.json', methods=('GET',))
+def sample_json():
+    n = _sample_size("n")
+    if not n:
+        abort(400)
+    seed = request.args.get("seed", type=int)
+    if seed is None:
+        seed = random_seed()
+    prompts = sample_prompts(
+        get_db(), n, seed,
+        content_arg=request.args.get("content") or None,
+        example_arg=request.args.get("example") or None,
+        tags_arg=tag_string_to_list(request.args.get("tags")),
+        project_id=request.args.get("project_id") or None,
+        style_id=request.args.get("style_id") or None,
+        search_mode=current_app.config['SEARCH_MODE'],
+        cluster_arg=request.args.get("near_duplicates") or None,
+    )
+    return {'seed': seed, 'prompts': [dict(row) for row in prompts]}
+
 
-    return render_template('manifest.html', prompts=prompts, page_size=limit, total_results=total_results, projects=projects, styles=styles)
+def _sample_size(arg="sample"):
+    size = request.args.get(arg, type=int)
+    if not size or size < 1:
+        return None
+    return min(size, current_app.config['MAX_SAMPLE_SIZE'])
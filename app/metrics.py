@@ -0,0 +1,300 @@
+import bisect
+import os
+import threading
+import time
+
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    g,
+    request
+)
+from app.db import get_db
+
+"""
+
+Metrics
+
+A registry of counters and histograms that any module can report to, served with
+   a few gauges read from the database at /metrics in the Prometheus text format.
+
+   counter(name, help, labels)            - a Counter, with .inc(*label_values, amount=1)
+   histogram(name, help, labels, buckets) - a Histogram, with .observe(value, *label_values)
+   gauge(name, help, labels, collect)     - collect() is called on each scrape (in its
+                                            request) and returns (label_values, value) pairs
+
+Updates are lock free: each thread adds to its own shard of values, and a scrape
+   sums the shards, so reporting a metric never waits on another thread. The
+   only lock is taken the first time a thread reports anything, when the shards
+   of threads that have finished are folded together.
+Values are per process, so with several server processes each one is scraped
+   separately. Background tasks run in worker processes, so task metrics are read
+   from the tasks table (which their ProgressReporters keep up to date) instead.
+
+"""
+
+bp = Blueprint('metrics', __name__)
+
+# Seconds, from a fast cached page to a slow search
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_local = threading.local()
+# (thread, values) for every thread that has reported something
+_shards = []
+# What threads that have since finished reported
+_retired = {}
+_shards_lock = threading.Lock()
+_metrics = {}
+
+
+def _merge(into, values):
+    for key, value in values.items():
+        if isinstance(value, list):
+            total = into.setdefault(key, [0] * len(value))
+            for i, x in enumerate(value):
+                total[i] += x
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+# Folds the shards of finished threads into _retired, so servers that start a
+#   thread per request don't collect shards forever
+# Called with _shards_lock held
+def _retire_shards():
+    live = []
+    for thread, values in _shards:
+        if thread.is_alive():
+            live.append((thread, values))
+        else:
+            _merge(_retired, values)
+    _shards[:] = live
+
+
+def _shard():
+    try:
+        return _local.values
+    except AttributeError:
+        values = _local.values = {}
+        with _shards_lock:
+            _retire_shards()
+            _shards.append((threading.current_thread(), values))
+        return values
+
+
+def _snapshot():
+    with _shards_lock:
+        _retire_shards()
+        # dict.copy doesn't let other threads in part way through
+        return [_retired.copy()] + [values.copy() for _, values in _shards]
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def inc(self, *label_values, amount=1):
+        values = _shard()
+        key = (self.name, label_values)
+        values[key] = values.get(key, 0) + amount
+
+    def samples(self, shards):
+        totals = {}
+        for shard in shards:
+            for (name, label_values), value in shard.items():
+                if name == self.name:
+                    totals[label_values] = totals.get(label_values, 0) + value
+        for label_values, value in sorted(totals.items()):
+            yield self.name + _labels(self.labels, label_values), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+    # Each series is a list of per-bucket counts (the last for +Inf), the sum and the count
+    def observe(self, value, *label_values):
+        values = _shard()
+        key = (self.name, label_values)
+        series = values.get(key)
+        if series is None:
+            series = values[key] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self, shards):
+        totals = {}
+        for shard in shards:
+            for (name, label_values), series in shard.items():
+                if name == self.name:
+                    total = totals.setdefault(label_values, [0] * len(series))
+                    for i, value in enumerate(list(series)):
+                        total[i] += value
+        names = self.labels + ('le',)
+        for label_values, series in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                yield self.name + '_bucket' + _labels(names, label_values + (_number(bound),)), cumulative
+            yield self.name + '_sum' + _labels(self.labels, label_values), series[-2]
+            yield self.name + '_count' + _labels(self.labels, label_values), series[-1]
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None, type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.type = type
+
+    def samples(self, shards):
+        for label_values, value in self.collect():
+            yield self.name + _labels(self.labels, label_values), value
+
+
+def _register(metric):
+    existing = _metrics.get(metric.name)
+    if existing is not None:
+        return existing
+    _metrics[metric.name] = metric
+    return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+# type can be 'counter' for totals that only go up but are read from elsewhere
+def gauge(name, help, labels=(), collect=None, type='gauge'):
+    return _register(Gauge(name, help, labels, collect, type))
+
+
+def render():
+    shards = _snapshot()
+    lines = []
+    for metric in _metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, value in metric.samples(shards):
+            lines.append(f"{name} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = histogram('praetor_request_seconds', 'Time to handle a request.', ('endpoint', 'method', 'status'))
+REQUEST_DB_SECONDS = histogram('praetor_request_db_seconds', 'Time a request spent in sql (only with SQL_PROFILING).', ('endpoint',))
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+
+
+def record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+# Runs after every after_request function, so SQL profiling has finished with the request
+def finish_request(e=None):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint or 'none'
+    status = g.pop('metrics_status', 500 if e is not None else 200)
+    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, request.method, status)
+    sql_seconds = g.pop('sql_seconds', None)
+    if sql_seconds is not None:
+        REQUEST_DB_SECONDS.observe(sql_seconds, endpoint)
+
+
+"""
+
+Metrics read from the database on each scrape
+
+Task rates are left to Prometheus: rate(praetor_task_rows_total[5m]) is rows per
+   second across every task of a type, and praetor_task_rows_total divided by
+   praetor_task_seconds_total is the average rate of one task while it runs.
+
+"""
+def _task_counts():
+    rows = get_db().execute("SELECT `type`, `status`, COUNT(*) AS tasks FROM tasks GROUP BY `type`, `status`").fetchall()
+    return [((row['type'], row['status']), row['tasks']) for row in rows]
+
+
+def _task_work(column):
+    sql = """
+        SELECT `type`,
+            SUM(COALESCE(rows_done, 0)) AS rows_done,
+            SUM(COALESCE(bytes_done, 0)) AS bytes_done,
+            SUM((julianday(COALESCE(finished_at, heartbeat_at, started_at)) - julianday(started_at)) * 86400) AS seconds
+        FROM tasks
+        WHERE started_at IS NOT NULL
+        GROUP BY `type`
+    """
+    return lambda: [((row['type'],), row[column] or 0) for row in get_db().execute(sql).fetchall()]
+
+
+def _database_sizes():
+    path = current_app.config['DATABASE']
+    sizes = []
+    for name, suffix in (('db', ''), ('wal', '-wal'), ('shm', '-shm')):
+        try:
+            sizes.append(((name,), os.path.getsize(path + suffix)))
+        except OSError:
+            pass
+    return sizes
+
+
+gauge('praetor_tasks', 'Tasks by type and status (queued ones are the queue depth).', ('type', 'status'), _task_counts)
+gauge('praetor_task_rows_total', 'Rows processed by tasks that have started.', ('type',), _task_work('rows_done'), type='counter')
+gauge('praetor_task_bytes_total', 'Bytes processed by tasks that have started.', ('type',), _task_work('bytes_done'), type='counter')
+gauge('praetor_task_seconds_total', 'Seconds tasks have spent running.', ('type',), _task_work('seconds'), type='counter')
+gauge('praetor_database_bytes', 'Size of the database and its WAL files.', ('file',), _database_sizes)
+
+
+@bp.route('/metrics', methods=('GET',))
+def metrics():
+    if not current_app.config['METRICS']:
+        abort(404)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if not app.config['METRICS']:
+        return
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
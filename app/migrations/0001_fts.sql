@@ -0,0 +1,54 @@
+/*
+    Full-text indexes over prompt values and completions.
+
+    Both tables are external-content FTS5 tables, so the text itself is only
+    stored once (in prompt_values / examples). The triggers keep them in sync
+    with every write, and the final 'rebuild' statements backfill any rows
+    that were written before the indexes existed.
+
+    The trigram tokenizer makes MATCH behave like a case-insensitive
+    substring search, which is what the old LIKE '%term%' filters did.
+*/
+
+CREATE VIRTUAL TABLE IF NOT EXISTS prompt_values_fts USING fts5(
+    `value`,
+    content='prompt_values',
+    content_rowid='id',
+    tokenize='trigram'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS examples_fts USING fts5(
+    `completion`,
+    content='examples',
+    content_rowid='id',
+    tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS prompt_values_fts_insert AFTER INSERT ON prompt_values BEGIN
+    INSERT INTO prompt_values_fts (rowid, `value`) VALUES (new.id, new.value);
+END;
+
+CREATE TRIGGER IF NOT EXISTS prompt_values_fts_delete AFTER DELETE ON prompt_values BEGIN
+    INSERT INTO prompt_values_fts (prompt_values_fts, rowid, `value`) VALUES ('delete', old.id, old.value);
+END;
+
+CREATE TRIGGER IF NOT EXISTS prompt_values_fts_update AFTER UPDATE OF `value` ON prompt_values BEGIN
+    INSERT INTO prompt_values_fts (prompt_values_fts, rowid, `value`) VALUES ('delete', old.id, old.value);
+    INSERT INTO prompt_values_fts (rowid, `value`) VALUES (new.id, new.value);
+END;
+
+CREATE TRIGGER IF NOT EXISTS examples_fts_insert AFTER INSERT ON examples BEGIN
+    INSERT INTO examples_fts (rowid, `completion`) VALUES (new.id, new.completion);
+END;
+
+CREATE TRIGGER IF NOT EXISTS examples_fts_delete AFTER DELETE ON examples BEGIN
+    INSERT INTO examples_fts (examples_fts, rowid, `completion`) VALUES ('delete', old.id, old.completion);
+END;
+
+CREATE TRIGGER IF NOT EXISTS examples_fts_update AFTER UPDATE OF `completion` ON examples BEGIN
+    INSERT INTO examples_fts (examples_fts, rowid, `completion`) VALUES ('delete', old.id, old.completion);
+    INSERT INTO examples_fts (rowid, `completion`) VALUES (new.id, new.completion);
+END;
+
+INSERT INTO prompt_values_fts (prompt_values_fts) VALUES ('rebuild');
+INSERT INTO examples_fts (examples_fts) VALUES ('rebuild');
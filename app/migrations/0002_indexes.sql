@@ -0,0 +1,18 @@
+/*
+    Indexes for the joins on the hot paths: the prompt search and its count,
+    exports, the prompt view and prompt/project/style deletes.
+
+    The single-column prompts indexes keep rowid order within each project
+    or style, so keyset pages on prompts.id never need a sort.
+*/
+
+CREATE INDEX IF NOT EXISTS idx_prompt_values_prompt_id_key ON prompt_values (prompt_id, `key`);
+CREATE INDEX IF NOT EXISTS idx_examples_prompt_id ON examples (prompt_id);
+CREATE INDEX IF NOT EXISTS idx_tags_prompt_id_value ON tags (prompt_id, `value`);
+CREATE INDEX IF NOT EXISTS idx_tags_example_id ON tags (example_id);
+CREATE INDEX IF NOT EXISTS idx_prompts_project_id ON prompts (project_id);
+CREATE INDEX IF NOT EXISTS idx_prompts_style ON prompts (style);
+CREATE INDEX IF NOT EXISTS idx_style_keys_style_id ON style_keys (style_id);
+CREATE INDEX IF NOT EXISTS idx_styles_project_id ON styles (project_id);
+
+ANALYZE;
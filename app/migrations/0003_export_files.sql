@@ -0,0 +1,10 @@
+/*
+    Exports can be made of several files (shards), which are listed in a
+    manifest file written next to them. Older exports have no manifest and a
+    single file in `filename`.
+*/
+
+ALTER TABLE exports ADD COLUMN `format` TEXT;
+ALTER TABLE exports ADD COLUMN `manifest` TEXT;
+ALTER TABLE exports ADD COLUMN `num_files` INTEGER;
+ALTER TABLE exports ADD COLUMN `num_records` INTEGER;
@@ -0,0 +1,14 @@
+/*
+    Tasks are a job queue drained by long-lived workers (see worker.py).
+    A task waits as 'queued' until a worker claims it, highest priority first,
+    then oldest first. payload is the json keyword arguments of the task's
+    function, and cancel_requested asks the worker running it to stop.
+*/
+
+ALTER TABLE tasks ADD COLUMN `priority` INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE tasks ADD COLUMN `payload` TEXT;
+ALTER TABLE tasks ADD COLUMN `started_at` TIMESTAMP;
+ALTER TABLE tasks ADD COLUMN `finished_at` TIMESTAMP;
+ALTER TABLE tasks ADD COLUMN `cancel_requested` INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_tasks_status_priority ON tasks (`status`, `priority` DESC, `id`);
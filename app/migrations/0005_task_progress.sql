@@ -0,0 +1,11 @@
+/*
+    Progress of running tasks, written every second or so by the task itself
+    (see db_wrappers.ProgressReporter). The totals are NULL when they aren't
+    known up front, like the number of records in an uploaded file.
+*/
+
+ALTER TABLE tasks ADD COLUMN `rows_done` INTEGER;
+ALTER TABLE tasks ADD COLUMN `rows_total` INTEGER;
+ALTER TABLE tasks ADD COLUMN `bytes_done` INTEGER;
+ALTER TABLE tasks ADD COLUMN `bytes_total` INTEGER;
+ALTER TABLE tasks ADD COLUMN `heartbeat_at` TIMESTAMP;
@@ -0,0 +1,16 @@
+/*
+    Content hashes for duplicate detection (see utils.content_hash).
+
+    A prompt's hash covers its values in its style's key order, and an
+    example's covers its completion. Imports look prompts up by project, style
+    and hash, and the dedupe task groups examples by prompt and hash.
+
+    Rows written before this migration get their hashes the first time an
+    import or dedupe needs them (see db_wrappers.fill_content_hashes).
+*/
+
+ALTER TABLE prompts ADD COLUMN `content_hash` TEXT;
+ALTER TABLE examples ADD COLUMN `content_hash` TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_prompts_content_hash ON prompts (project_id, style, content_hash);
+CREATE INDEX IF NOT EXISTS idx_examples_prompt_id_content_hash ON examples (prompt_id, content_hash);
@@ -0,0 +1,36 @@
+/*
+    Near-duplicate detection (see minhash.py and db_wrappers.find_near_duplicates).
+
+    minhashes holds each prompt's MinHash signature, a blob of little-endian
+    uint32s, along with the hash of the text it was made from (source_hash), so
+    later runs only redo prompts whose values or completions have changed.
+    shingles is 0 for prompts without any words, which are never clustered.
+
+    near_duplicates lists the prompts of each cluster found by the last run on a
+    project. cluster_id is the lowest prompt id in the cluster, and similarity is
+    the highest estimated Jaccard similarity to another member.
+
+    Both follow their prompts out of the database through the trigger.
+*/
+
+CREATE TABLE IF NOT EXISTS minhashes (
+    `prompt_id` INTEGER PRIMARY KEY,
+    `source_hash` TEXT,
+    `shingles` INTEGER,
+    `signature` BLOB
+);
+
+CREATE TABLE IF NOT EXISTS near_duplicates (
+    `prompt_id` INTEGER PRIMARY KEY,
+    `cluster_id` INTEGER,
+    `project_id` INTEGER,
+    `similarity` REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_near_duplicates_cluster_id ON near_duplicates (cluster_id, prompt_id);
+CREATE INDEX IF NOT EXISTS idx_near_duplicates_project_id ON near_duplicates (project_id);
+
+CREATE TRIGGER IF NOT EXISTS prompts_near_duplicates_delete AFTER DELETE ON prompts BEGIN
+    DELETE FROM minhashes WHERE prompt_id = old.id;
+    DELETE FROM near_duplicates WHERE prompt_id = old.id;
+END;
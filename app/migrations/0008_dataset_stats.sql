@@ -0,0 +1,19 @@
+/*
+    Dataset statistics per project and style (see db_wrappers.StatsDelta).
+
+    Each row is one count: of a metric (like 'value_chars'), for a key (a prompt
+    key, a tag, or '' when the metric has none), in a bucket (a power of two
+    length bucket, a completion count, or 0). style_id is 0 for prompts without
+    a style. The write paths keep the counts current; databases from before
+    this migration start out empty and are filled by a rebuild.
+*/
+
+CREATE TABLE IF NOT EXISTS dataset_stats (
+    `project_id` INTEGER NOT NULL,
+    `style_id` INTEGER NOT NULL,
+    `metric` TEXT NOT NULL,
+    `key` TEXT NOT NULL,
+    `bucket` INTEGER NOT NULL,
+    `count` INTEGER NOT NULL,
+    PRIMARY KEY (project_id, style_id, metric, key, bucket)
+) WITHOUT ROWID;
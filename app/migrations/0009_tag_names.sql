@@ -0,0 +1,26 @@
+/*
+    Interned tags (see db_wrappers.intern_tags).
+
+    Each distinct tag text is stored once in tag_names, and tags rows refer to
+    it by tag_id instead of repeating the text. Tag filters look names up in
+    the dictionary first, through the NOCASE index so that LIKE (which ignores
+    case) can use it, and then find the prompts through (tag_id, prompt_id).
+*/
+
+CREATE TABLE IF NOT EXISTS tag_names (
+    `id` INTEGER PRIMARY KEY,
+    `value` TEXT NOT NULL UNIQUE
+);
+
+CREATE INDEX IF NOT EXISTS idx_tag_names_value_nocase ON tag_names (`value` COLLATE NOCASE);
+
+INSERT OR IGNORE INTO tag_names (`value`) SELECT `value` FROM tags WHERE `value` IS NOT NULL ORDER BY id;
+
+ALTER TABLE tags ADD COLUMN `tag_id` INTEGER;
+UPDATE tags SET tag_id = (SELECT id FROM tag_names WHERE tag_names.value = tags.value);
+
+DROP INDEX IF EXISTS idx_tags_prompt_id_value;
+ALTER TABLE tags DROP COLUMN `value`;
+
+CREATE INDEX IF NOT EXISTS idx_tags_tag_id_prompt_id ON tags (tag_id, prompt_id);
+CREATE INDEX IF NOT EXISTS idx_tags_prompt_id_tag_id ON tags (prompt_id, tag_id);
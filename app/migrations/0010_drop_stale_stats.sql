@@ -0,0 +1,16 @@
+/*
+    Forgets the planner statistics 0002_indexes.sql recorded with ANALYZE.
+
+    On a fresh database they describe the single sample row of each table,
+    which leads the planner into full scans once the tables fill up. Only
+    those rows (a row count of 1) are deleted; statistics from a database that
+    already held data when it was migrated are kept. Tables without
+    statistics fall back to the planner's defaults, which favour the indexes.
+
+    ANALYZE of one small table makes sure sqlite_stat1 exists, and
+    ANALYZE sqlite_schema has this connection reload the remaining statistics.
+*/
+
+ANALYZE style_keys;
+DELETE FROM sqlite_stat1 WHERE stat = '1' OR stat LIKE '1 %';
+ANALYZE sqlite_schema;
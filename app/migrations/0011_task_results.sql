@@ -0,0 +1,6 @@
+/*
+    A json summary of what a finished task did, such as the numbers of prompts
+    a bulk upload added, merged and skipped (see db_wrappers.finish_task).
+*/
+
+ALTER TABLE tasks ADD COLUMN `result` TEXT;
@@ -0,0 +1,106 @@
+import hashlib
+import re
+import sys
+from array import array
+
+from app.utils import normalize_text
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+
+MinHash signatures for near-duplicate detection
+
+A prompt's text (its values and completions) is lowercased, split into words and
+   shingled into overlapping runs of SHINGLE_SIZE words. Its signature holds, for
+   each of NUM_PERM hash functions, the smallest hash of any of its shingles. Two
+   signatures agree at a position with probability equal to the Jaccard similarity
+   of the two shingle sets, so the fraction of positions that agree (similarity)
+   estimates it.
+
+Signatures are stored as NUM_PERM little-endian uint32s (4 bytes each), the same
+   bytes numpy.ndarray.tobytes() gives for dtype '<u4'. With numpy installed the
+   minimums are taken with it, otherwise in plain python (at about half the
+   speed); the signatures are identical either way.
+
+The NUM_PERM hash functions are the consecutive 4 byte words of each shingle's
+   shake_128 digest, so one hashlib call hashes a shingle all NUM_PERM ways, and
+   signatures stay comparable between runs, processes and machines.
+
+LSH banding (see lsh_bands) splits signatures into bands of rows positions each;
+   two signatures that match exactly in any band are candidates, which is likely
+   when their similarity is above about (1 / bands) ** (1 / rows).
+
+"""
+
+NUM_PERM = 128
+SHINGLE_SIZE = 3
+
+_EMPTY = [0xffffffff] * NUM_PERM
+
+_WORD = re.compile(r'\w+')
+
+
+# The distinct shingles of a list of texts, as utf-8
+def shingles(texts):
+    words = _WORD.findall(normalize_text("\n".join(texts)).lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words).encode('utf-8')} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]).encode('utf-8') for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _digests(shingles):
+    return [hashlib.shake_128(shingle).digest(4 * NUM_PERM) for shingle in shingles]
+
+
+if numpy is not None:
+    def _signature(shingles):
+        return numpy.frombuffer(b"".join(_digests(shingles)), dtype='<u4').reshape(-1, NUM_PERM).min(axis=0).tobytes()
+else:
+    def _signature(shingles):
+        rows = [_unpack(digest) for digest in _digests(shingles)]
+        return _pack(map(min, zip(*rows)))
+
+
+# Returns (signature, number of shingles) for a list of texts
+# Texts without any words have no shingles, and an all-0xffffffff signature
+def signature(texts):
+    found = shingles(texts)
+    if not found:
+        return _pack(_EMPTY), 0
+    return _signature(found), len(found)
+
+
+def _pack(values):
+    values = array('I', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpack(data):
+    values = array('I')
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+# The estimated Jaccard similarity of the texts two signatures were made from
+def similarity(a, b):
+    if numpy is not None:
+        return float((numpy.frombuffer(a, dtype='<u4') == numpy.frombuffer(b, dtype='<u4')).mean())
+    return sum(x == y for x, y in zip(_unpack(a), _unpack(b))) / NUM_PERM
+
+
+# (bands, rows) for a similarity threshold: the split of NUM_PERM with the highest
+#   candidate threshold (1 / bands) ** (1 / rows) that's still below it
+# Candidates are checked against the threshold anyway, so erring low only costs
+#   some extra checks, while erring high would miss pairs
+def lsh_bands(threshold):
+    splits = [(NUM_PERM // rows, rows) for rows in range(1, NUM_PERM + 1) if NUM_PERM % rows == 0]
+    below = [split for split in splits if (1 / split[0]) ** (1 / split[1]) <= threshold]
+    return max(below, key=lambda split: split[1]) if below else splits[0]
@@ -0,0 +1,176 @@
+import collections
+import re
+import sqlite3
+import time
+
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    g,
+    render_template,
+    request
+)
+from app.db import ProfiledConnection
+
+"""
+
+Per-request SQL profiling
+
+With SQL_PROFILING set, every request gets a QueryProfile that its connection
+   (a db.ProfiledConnection) reports each statement to. When the request is done:
+
+   - the response gets X-SQL-Queries (statements run through the connection),
+     X-SQL-Statements (everything sqlite ran, including trigger bodies and
+     transaction control), X-SQL-Time-Ms and a Server-Timing entry that browser
+     developer tools show
+   - queries that took at least SLOW_QUERY_MS are logged as warnings along with
+     their EXPLAIN QUERY PLAN
+   - a summary with the slowest queries is kept for /debug/sql, with each query's
+     bound parameters reduced to their types (its shape)
+
+Without SQL_PROFILING none of the hooks are installed, and the app's connections
+   are plain db.Connections.
+
+"""
+
+bp = Blueprint('profiling', __name__)
+
+# The slowest queries kept in each request's summary
+TOP_QUERIES = 10
+
+_requests = collections.deque(maxlen=50)
+_slow_queries = collections.deque(maxlen=50)
+
+
+class QueryProfile:
+
+    def __init__(self):
+        self.queries = []
+        self.statements = 0
+        self.started = time.perf_counter()
+
+    def record(self, sql, parameters, seconds):
+        query = {'sql': sql, 'parameters': parameters, 'seconds': seconds}
+        self.queries.append(query)
+        return query
+
+    def trace(self, statement):
+        self.statements += 1
+
+    @property
+    def seconds(self):
+        return sum(query['seconds'] for query in self.queries)
+
+
+def _normalize(sql):
+    return " ".join(sql.split())
+
+
+# The types of a statement's parameters, with runs of one type collapsed
+#   like "(int x 250, str)", so long IN lists stay readable
+def parameter_shape(parameters):
+    if parameters is None:
+        return "many"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    runs = []
+    for value in parameters:
+        name = type(value).__name__
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += 1
+        else:
+            runs.append([name, 1])
+    return "(" + ", ".join(name if count == 1 else f"{name} x {count}" for name, count in runs) + ")"
+
+
+_EXPLAINABLE = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+
+# EXPLAIN QUERY PLAN output as an indented tree, like the sqlite3 shell prints it
+def explain(db, sql, parameters):
+    if parameters is None or not _EXPLAINABLE.match(sql):
+        return None
+    try:
+        rows = db.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return f"(no plan: {e})"
+    depth = {0: -1}
+    lines = []
+    for row in rows:
+        depth[row[0]] = depth.get(row[1], -1) + 1
+        lines.append("   " * depth[row[0]] + row[3])
+    return "\n".join(lines)
+
+
+def start_profile():
+    g.sql_profile = QueryProfile()
+
+
+def finish_profile(response):
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+
+    db = g.get('db')
+    if isinstance(db, ProfiledConnection):
+        # The plans below aren't part of the request
+        db.attach(None)
+
+    config = current_app.config
+    path = f"{request.method} {request.full_path.rstrip('?')}"
+    seconds = profile.seconds
+    slowest = sorted(profile.queries, key=lambda query: query['seconds'], reverse=True)
+    for query in slowest:
+        if query['seconds'] * 1000 < config['SLOW_QUERY_MS']:
+            break
+        entry = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'path': path,
+            'sql': _normalize(query['sql']),
+            'shape': parameter_shape(query['parameters']),
+            'ms': query['seconds'] * 1000,
+            'plan': explain(db, query['sql'], query['parameters']) if db is not None else None,
+        }
+        _slow_queries.appendleft(entry)
+        current_app.logger.warning("Slow query (%.1f ms) on %s: %s %s\n%s", entry['ms'], entry['path'], entry['sql'], entry['shape'], entry['plan'] or "")
+
+    _requests.appendleft({
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'path': path,
+        'status': response.status_code,
+        'queries': len(profile.queries),
+        'statements': profile.statements,
+        'sql_ms': seconds * 1000,
+        'request_ms': (time.perf_counter() - profile.started) * 1000,
+        'slowest': [
+            {'sql': _normalize(query['sql']), 'shape': parameter_shape(query['parameters']), 'ms': query['seconds'] * 1000}
+            for query in slowest[:TOP_QUERIES]
+        ],
+    })
+
+    # For the request's metrics (see metrics.finish_request)
+    g.sql_seconds = seconds
+
+    response.headers['X-SQL-Queries'] = str(len(profile.queries))
+    response.headers['X-SQL-Statements'] = str(profile.statements)
+    response.headers['X-SQL-Time-Ms'] = f"{seconds * 1000:.2f}"
+    response.headers.add('Server-Timing', f'sql;dur={seconds * 1000:.2f};desc="{len(profile.queries)} queries"')
+    return response
+
+
+@bp.route('/debug/sql', methods=('GET',))
+def debug_sql():
+    if not current_app.config['SQL_PROFILING']:
+        abort(404)
+    return render_template('debug_sql.html', requests=list(_requests), slow_queries=list(_slow_queries), slow_query_ms=current_app.config['SLOW_QUERY_MS'])
+
+
+def init_app(app):
+    if not app.config['SQL_PROFILING']:
+        return
+    global _requests, _slow_queries
+    _requests = collections.deque(maxlen=app.config['SQL_PROFILE_HISTORY'])
+    _slow_queries = collections.deque(maxlen=app.config['SQL_PROFILE_HISTORY'])
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
@@ -1,12 +1,13 @@
 from flask import (
     Blueprint,
+    current_app,
     render_template,
     request,
     redirect
 )
 from app.db import get_db
-from app.db_wrappers import delete_project, get_projects, get_project_by_id, get_styles_by_project_id, add_project, add_style, delete_project, update_project
-from app.utils import get_named_arguments
+from app.db_wrappers import delete_project, get_projects, get_project_by_id, get_styles_by_project_id, add_project, add_style, delete_project, update_project, queue_dedupe, queue_near_duplicates
+from app.style_plans import get_style_plan
 
 bp = Blueprint('projects', __name__)
 
@@ -40,6 +41,15 @@ def project():
             name = request.form.get('name')
             description = request.form.get('description')
             update_project(db, project_id, description, name)
+        elif form_type == 'dedupe':
+            if project_id:
+                queue_dedupe(db, project_id)
+                return redirect('/tasks')
+        elif form_type == 'near_duplicates':
+            if project_id:
+                threshold = request.form.get('threshold', current_app.config['NEAR_DUPLICATE_THRESHOLD'], type=float)
+                queue_near_duplicates(db, project_id, min(max(threshold, 0.1), 1.0))
+                return redirect('/tasks')
         else:  # form_type might be null
             # Add style
 
@@ -48,7 +58,7 @@ def project():
             completion_key = request.form.get('completion_key')
             preview_key = request.form.get('preview_key')
 
-            style_keys = get_named_arguments(format_string)
+            style_keys = get_style_plan(format_string).keys
 
             # In the future, should throw errors when completion/preview key not in style_keys
             if completion_key not in style_keys:
@@ -65,4 +75,4 @@ def project():
 
     project = get_project_by_id(get_db(), project_id)
     styles = get_styles_by_project_id(get_db(), project_id)
-    return render_template('project.html', project=project, styles=styles, errors=errors)
+    return render_template('project.html', project=project, styles=styles, errors=errors, near_duplicate_threshold=current_app.config['NEAR_DUPLICATE_THRESHOLD'])
@@ -1,3 +1,5 @@
+PRAGMA user_version = 0;
+
 DROP TABLE IF EXISTS examples;
 DROP TABLE IF EXISTS prompts;
 DROP TABLE IF EXISTS metrics;
@@ -8,6 +10,12 @@ DROP TABLE IF EXISTS projects;
 DROP TABLE IF EXISTS tags;
 DROP TABLE IF EXISTS prompt_values;
 DROP TABLE IF EXISTS style_keys;
+DROP TABLE IF EXISTS prompt_values_fts;
+DROP TABLE IF EXISTS examples_fts;
+DROP TABLE IF EXISTS minhashes;
+DROP TABLE IF EXISTS near_duplicates;
+DROP TABLE IF EXISTS dataset_stats;
+DROP TABLE IF EXISTS tag_names;
 
 CREATE TABLE examples (
   `id` INTEGER PRIMARY KEY AUTOINCREMENT,
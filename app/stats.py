@@ -0,0 +1,76 @@
+from flask import (
+    Blueprint,
+    abort,
+    render_template,
+    request,
+    redirect
+)
+from app.db import get_db
+from app.db_wrappers import get_stats, get_project_by_id, get_styles_by_project_id, queue_rebuild_stats
+
+bp = Blueprint('stats', __name__)
+
+# Tags shown on the page, most frequent first
+TOP_TAGS = 100
+
+
+def _bucket_label(bucket):
+    if bucket == 0:
+        return "0"
+    low, high = 2 ** (bucket - 1), 2 ** bucket - 1
+    return str(low) if low == high else f"{low:,d} - {high:,d}"
+
+
+# Rows of (label, count, share of the largest count) for a {bucket: count} histogram
+def _histogram(buckets, label=_bucket_label):
+    top = max(buckets.values(), default=0)
+    return [(label(bucket), count, count / top if top else 0) for bucket, count in sorted(buckets.items())]
+
+
+@bp.route('/stats', methods=('GET', 'POST'))
+def stats():
+    db = get_db()
+
+    project_id = request.values.get('project_id', type=int)
+    if not project_id:
+        abort(404)
+
+    if request.method == 'POST':
+        queue_rebuild_stats(db, project_id)
+        return redirect('/tasks')
+
+    project = get_project_by_id(db, project_id)
+    if project is None:
+        abort(404)
+    style_id = request.args.get('style_id', type=int)
+
+    counts = get_stats(db, project_id, style_id)
+    prompts = counts['prompts'].get('', {}).get(0, 0)
+    examples = counts['examples'].get('', {}).get(0, 0)
+    # An index lookup, to tell a project that was never counted from an empty one
+    missing = prompts == 0 and db.execute("SELECT 1 FROM prompts WHERE project_id = ? LIMIT 1", (project_id,)).fetchone() is not None
+
+    keys = []
+    for key in sorted(counts['value_chars']):
+        chars = counts['value_chars'][key]
+        keys.append({
+            'key': key,
+            'values': sum(chars.values()),
+            'empty': counts['value_empty'].get(key, {}).get(0, 0),
+            'chars': _histogram(chars),
+            'tokens': _histogram(counts['value_tokens'].get(key, {})),
+        })
+    completions = {
+        'values': examples,
+        'empty': counts['completion_empty'].get('', {}).get(0, 0),
+        'chars': _histogram(counts['completion_chars'].get('', {})),
+        'tokens': _histogram(counts['completion_tokens'].get('', {})),
+    }
+    per_prompt = _histogram(counts['completions_per_prompt'].get('', {}), label=str)
+    tags = sorted(((tag, buckets.get(0, 0)) for tag, buckets in counts['tag'].items()), key=lambda x: (-x[1], x[0]))
+
+    return render_template(
+        'stats.html', project=project, styles=get_styles_by_project_id(db, project_id), style_id=style_id,
+        prompts=prompts, examples=examples, missing=missing, keys=keys, completions=completions,
+        per_prompt=per_prompt, tags=tags[:TOP_TAGS], total_tags=len(tags)
+    )
@@ -6,7 +6,7 @@ from flask import (
 )
 from app.db import get_db
 from app.db_wrappers import delete_style, get_project_by_id, get_style_by_id, get_keys_by_style_id, update_style
-from app.utils import get_named_arguments
+from app.style_plans import get_style_plan
 import json
 
 bp = Blueprint('style', __name__)
@@ -26,7 +26,7 @@ def style():
             completion_key = request.form.get('completion_key')
             preview_key = request.form.get('preview_key')
 
-            keys = get_named_arguments(template)
+            keys = get_style_plan(template).keys
             if preview_key not in keys:
                 errors.append("Preview key must be in template")
             if completion_key not in keys:
@@ -0,0 +1,110 @@
+import functools
+import re
+import string
+
+from app.utils import content_hash
+
+"""
+
+Style plans
+
+A StylePlan is a style's template parsed once, with everything the app needs to
+   know about it:
+
+   keys            - the template's named arguments, in order of first appearance
+   prompt_keys     - the keys a prompt fills in (all but the completion key)
+   completion_key  - where the completion goes
+   preview_key     - the key shown in prompt tables
+   render(values)  - the template filled in with values (missing keys become "")
+   render_batch    - render for a list of values, for exports and /render.json
+   record(values)  - values laid out as an export record (see db_wrappers.iter_export_records)
+   content_hash    - the hash duplicate prompts are found by (see utils.content_hash)
+
+Templates are python format strings, so doubled braces ("{{" and "}}") are
+   literal braces rather than arguments. Values are always inserted as text, so
+   conversions and format specs in a template are ignored.
+Plans are cached by their template and keys, so get_style_plan can be called
+   for every prompt without parsing anything twice.
+Rendering goes through one precompiled format string with a positional field
+   per key, so each render is a single str.format call with no parsing.
+
+"""
+
+# Only used for templates that str.format can't parse, like ones with a lone brace
+_LEGACY_ARGUMENT = re.compile(r'{(?P<name>\w+)}')
+
+
+def _escape(literal):
+    return literal.replace("{", "{{").replace("}", "}}")
+
+
+class StylePlan:
+
+    def __init__(self, template, completion_key=None, preview_key=None):
+        self.template = template or ""
+        self.completion_key = completion_key
+        self.preview_key = preview_key
+        self.error = None
+
+        # Each part is (literal text, key or None)
+        parts = []
+        keys = []
+        try:
+            for literal, field, conversion, spec in string.Formatter().parse(self.template):
+                if field is None:
+                    parts.append((literal, None))
+                elif field.isidentifier():
+                    keys.append(field)
+                    parts.append((literal, field))
+                else:
+                    # Positional and attribute fields aren't arguments, so they're kept as text
+                    text = "{" + field + ("!" + conversion if conversion else "") + (":" + spec if spec else "") + "}"
+                    parts.append((literal + text, None))
+        except ValueError as e:
+            # Fall back to substituting whatever looks like an argument
+            self.error = str(e)
+            parts = []
+            last = 0
+            for match in _LEGACY_ARGUMENT.finditer(self.template):
+                keys.append(match.group('name'))
+                parts.append((self.template[last:match.start()], match.group('name')))
+                last = match.end()
+            parts.append((self.template[last:], None))
+
+        self.keys = tuple(dict.fromkeys(keys))
+        self.prompt_keys = tuple(key for key in self.keys if key != completion_key)
+
+        # The template with each key replaced by its position in self.keys
+        positions = {key: i for i, key in enumerate(self.keys)}
+        compiled = []
+        for literal, key in parts:
+            compiled.append(_escape(literal))
+            if key is not None:
+                compiled.append("{%d}" % positions[key])
+        self._format = "".join(compiled).format
+
+    def render(self, values):
+        return self._format(*[values.get(key, "") for key in self.keys])
+
+    def render_batch(self, values_list):
+        fmt = self._format
+        keys = self.keys
+        return [fmt(*[values.get(key, "") for key in keys]) for values in values_list]
+
+    # An export record: every prompt key in template order, with "" for missing values
+    # The completion key is left out, for the caller to add (last) per completion
+    def record(self, values):
+        return {key: values.get(key, "") for key in self.prompt_keys}
+
+    def content_hash(self, values):
+        return content_hash([values.get(key, "") for key in self.prompt_keys])
+
+
+@functools.lru_cache(maxsize=256)
+def get_style_plan(template, completion_key=None, preview_key=None):
+    return StylePlan(template, completion_key, preview_key)
+
+
+# The plan for a row of the styles table
+def plan_for_style(style):
+    return get_style_plan(style['template'], style['completion_key'], style['preview_key'])
@@ -0,0 +1,157 @@
+import itertools
+import random
+
+import click
+
+from app.db import get_db, init_db
+from app.db_wrappers import add_project, add_style, insert_text_rows, intern_tags, StatsDelta, _invalidate_counts
+from app.style_plans import get_style_plan
+from app.utils import content_hash
+
+"""
+
+Synthetic datasets
+
+generate_data fills a database with made up projects, styles, prompts, completions
+   and tags, for benchmarks (see benchmarks/suite.py) and for trying the app out on
+   a large dataset. The same arguments and seed always produce the same rows.
+
+   projects      - projects to create
+   styles        - styles per project, each with two to four prompt keys
+   prompts       - prompts, spread evenly over every style
+   completions   - the mean number of completions per prompt (each prompt gets
+                   between 0 and twice as many, uniformly)
+   tags          - the size of the tag vocabulary
+   tags_per_prompt
+                 - the mean number of tags per prompt, chosen the same way
+   tag_skew      - tags are drawn with weights 1 / rank ** tag_skew, so 0 is
+                   uniform and larger values concentrate on the first few tags
+   words         - the mean number of words in a prompt value or completion
+
+progress, when given, is called with the number of prompts written after each batch.
+
+Rows are written a batch at a time, and their text through the same staging tables
+   as bulk uploads (see db_wrappers.insert_text_rows), so the full-text indexes stay in sync.
+
+"""
+
+WORDS = [
+    "alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa",
+    "lambda", "mu", "nu", "xi", "omicron", "pi", "rho", "sigma", "tau", "upsilon",
+    "phi", "chi", "psi", "omega", "write", "explain", "list", "summarize", "translate", "python",
+    "function", "poem", "story", "question", "answer", "table", "data", "model", "prompt", "river",
+]
+
+PROMPT_KEYS = ["instruction", "input", "context", "system"]
+
+
+def _text(rng, words):
+    return " ".join(rng.choices(WORDS, k=rng.randint(1, 2 * words)))
+
+
+def generate_data(db, projects=1, styles=2, prompts=10000, completions=2, tags=50, tags_per_prompt=2, tag_skew=1.0, words=12, seed=0, batch_size=10000, progress=None):
+    rng = random.Random(seed)
+
+    style_ids = []
+    for p in range(projects):
+        project_id = add_project(db, f"Synthetic project {p + 1}", f"Generated with seed {seed}")
+        for s in range(styles):
+            keys = PROMPT_KEYS[:2 + (s % 3)]
+            template = "\n".join(f"{key.title()}: {{{key}}}" for key in keys) + "\nOutput: {output}"
+            style_id = add_style(db, f"synthetic-{p + 1}-{s + 1}", template, "output", keys[0], project_id, keys + ["output"])
+            style_ids.append((project_id, style_id, keys, get_style_plan(template, "output", keys[0])))
+
+    vocabulary = [f"tag-{i:04d}" for i in range(tags)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** tag_skew for rank in range(tags)))
+
+    # Counts are drawn uniformly from 0 to twice the mean
+    max_completions = round(2 * completions)
+    max_tags = round(2 * tags_per_prompt)
+
+    written = 0
+    while written < prompts:
+        size = min(batch_size, prompts - written)
+        _write_batch(db, rng, size, written, style_ids, vocabulary, cum_weights, max_completions, max_tags, words)
+        written += size
+        if progress:
+            progress(written)
+    _invalidate_counts()
+    return written
+
+
+def _write_batch(db, rng, size, offset, style_ids, vocabulary, cum_weights, max_completions, max_tags, words):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        # AUTOINCREMENT never reuses ids, so start after the highest one ever handed out
+        sql = """
+            SELECT MAX(
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'prompts'), 0),
+                COALESCE((SELECT MAX(id) FROM prompts), 0)
+            ) AS last_id
+        """
+        prompt_id = db.execute(sql).fetchone()['last_id']
+
+        prompt_rows = []
+        value_rows = []
+        example_rows = []
+        tag_rows = []
+        stats = StatsDelta()
+        for i in range(offset, offset + size):
+            prompt_id += 1
+            project_id, style_id, keys, plan = style_ids[i % len(style_ids)]
+            values = {key: _text(rng, words) for key in keys}
+            prompt_rows.append((prompt_id, style_id, project_id, plan.content_hash(values)))
+            for key in keys:
+                value_rows.append((prompt_id, key, values[key]))
+            completions = [_text(rng, words) for _ in range(rng.randint(0, max_completions))]
+            for completion in completions:
+                example_rows.append((prompt_id, completion, content_hash([completion])))
+            tags = []
+            if vocabulary:
+                # dict.fromkeys drops repeats in the order drawn, where a set's order
+                #   would depend on the hash seed
+                tags = list(dict.fromkeys(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(0, max_tags))))
+                for tag in tags:
+                    tag_rows.append((prompt_id, tag))
+            stats.prompt(project_id, style_id, values.items(), completions, tags)
+
+        db.executemany("INSERT INTO prompts (id, style, project_id, content_hash) VALUES (?, ?, ?, ?)", prompt_rows)
+        tag_ids = intern_tags(db, [tag for _, tag in tag_rows])
+        db.executemany("INSERT INTO tags (prompt_id, tag_id) VALUES (?, ?)", [(prompt_id, tag_ids[tag]) for prompt_id, tag in tag_rows])
+
+        insert_text_rows(db, value_rows, example_rows)
+        stats.write(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+@click.command('gen-data')
+@click.option('--projects', type=int, default=1, help='Projects to create.')
+@click.option('--styles', type=int, default=2, help='Styles per project.')
+@click.option('--prompts', type=int, default=10000, help='Prompts to create.')
+@click.option('--completions', type=float, default=2, help='Mean completions per prompt.')
+@click.option('--tags', type=int, default=50, help='Size of the tag vocabulary.')
+@click.option('--tags-per-prompt', type=float, default=2, help='Mean tags per prompt.')
+@click.option('--tag-skew', type=float, default=1.0, help='Zipf exponent of tag frequencies (0 is uniform).')
+@click.option('--words', type=int, default=12, help='Mean words per prompt value or completion.')
+@click.option('--seed', type=int, default=0, help='Random seed.')
+@click.option('--reset', is_flag=True, help='Clear the database first (like init-db).')
+def gen_data_command(projects, styles, prompts, completions, tags, tags_per_prompt, tag_skew, words, seed, reset):
+    """Fill the database with reproducible synthetic data."""
+    if reset:
+        init_db()
+    with click.progressbar(length=prompts, label='Generating prompts') as bar:
+        done = [0]
+
+        def progress(written):
+            bar.update(written - done[0])
+            done[0] = written
+
+        written = generate_data(get_db(), projects, styles, prompts, completions, tags, tags_per_prompt, tag_skew, words, seed, progress=progress)
+    click.echo(f'Generated {written} prompts.')
+
+
+def init_app(app):
+    app.cli.add_command(gen_data_command)
@@ -1,16 +1,146 @@
 from flask import (
     Blueprint,
+    Response,
+    current_app,
     render_template,
-    request
+    request,
+    redirect
 )
-from app.db import get_db
-from app.db_wrappers import get_tasks, check_running
+from app.db import get_db, connect_db
+from app.db_wrappers import get_tasks, check_running, cancel_task
+from datetime import datetime, timezone
+import json
+import time
 
 bp = Blueprint('tasks', __name__)
 
+# Seconds between updates on the /tasks/stream event stream
+STREAM_INTERVAL = 1.0
+# Seconds before a stream is closed; the browser reconnects by itself
+STREAM_LIFETIME = 300
+# Seconds without a heartbeat before a running task is reported as stalled
+STALLED_AFTER = 30
+
+
+def _timestamp(value):
+    return value.isoformat(sep=' ') if value else None
+
+
+# Like "1,200 added, 3 merged, 40 skipped" for a task's json result
+def result_text(result):
+    if not result:
+        return ""
+    return ", ".join(f"{value:,} {key}" for key, value in json.loads(result).items())
+
+
+# Summarizes a row of the tasks table for /tasks.json and /tasks/stream
+# Throughput is averaged over the time the task has been running, and the ETA
+#   goes by rows when their total is known, or otherwise by bytes
+def task_progress(task, now):
+    status = task['status']
+    if status == 'in_progress' and task['cancel_requested']:
+        status = 'cancelling'
+
+    progress = {
+        'id': task['id'],
+        'type': task['type'],
+        'status': status,
+        'priority': task['priority'],
+        'created_at': _timestamp(task['created_at']),
+        'started_at': _timestamp(task['started_at']),
+        'finished_at': _timestamp(task['finished_at']),
+        'heartbeat_at': _timestamp(task['heartbeat_at']),
+        'rows_done': task['rows_done'],
+        'rows_total': task['rows_total'],
+        'bytes_done': task['bytes_done'],
+        'bytes_total': task['bytes_total'],
+        'result': json.loads(task['result']) if task['result'] else None,
+        'result_text': result_text(task['result']),
+        'percent': None,
+        'rows_per_second': None,
+        'bytes_per_second': None,
+        'eta_seconds': None,
+        'stalled': False,
+    }
+
+    if task['rows_total']:
+        progress['percent'] = 100 * (task['rows_done'] or 0) / task['rows_total']
+    elif task['bytes_total']:
+        progress['percent'] = 100 * (task['bytes_done'] or 0) / task['bytes_total']
+
+    if not task['started_at']:
+        return progress
+
+    end = task['finished_at'] or task['heartbeat_at']
+    elapsed = (end - task['started_at']).total_seconds() if end else 0
+    if elapsed > 0:
+        if task['rows_done'] is not None:
+            progress['rows_per_second'] = task['rows_done'] / elapsed
+        if task['bytes_done'] is not None:
+            progress['bytes_per_second'] = task['bytes_done'] / elapsed
+
+    if task['status'] == 'in_progress':
+        if task['rows_total'] and progress['rows_per_second']:
+            progress['eta_seconds'] = (task['rows_total'] - task['rows_done']) / progress['rows_per_second']
+        elif task['bytes_total'] and progress['bytes_per_second']:
+            progress['eta_seconds'] = (task['bytes_total'] - task['bytes_done']) / progress['bytes_per_second']
+
+        last_seen = task['heartbeat_at'] or task['started_at']
+        progress['stalled'] = (now - last_seen).total_seconds() > STALLED_AFTER
+
+    return progress
+
+
+def get_task_progress(db):
+    # Timestamps from CURRENT_TIMESTAMP are in UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return [task_progress(task, now) for task in get_tasks(db)]
+
+
 @bp.route('/tasks', methods=('GET',))
 def tasks():
     db = get_db()
     check_running(db)
     tasks = get_tasks(db)
-    return render_template('tasks.html', tasks=tasks)
+    results = {task['id']: result_text(task['result']) for task in tasks}
+    return render_template('tasks.html', tasks=tasks, results=results)
+
+@bp.route('/tasks.json', methods=('GET',))
+def tasks_json():
+    db = get_db()
+    check_running(db)
+    return {'tasks': get_task_progress(db)}
+
+# Server-sent events with the same data as /tasks.json, sent whenever it changes
+@bp.route('/tasks/stream', methods=('GET',))
+def tasks_stream():
+    db_path = current_app.config['DATABASE']
+    timeout = current_app.config['DB_TIMEOUT']
+
+    def events():
+        # The request's connection is closed once the response starts streaming
+        db = connect_db(db_path, timeout)
+        try:
+            last = None
+            started = time.monotonic()
+            while time.monotonic() - started < STREAM_LIFETIME:
+                data = json.dumps({'tasks': get_task_progress(db)})
+                if data != last:
+                    yield f"data: {data}\n\n"
+                    last = data
+                else:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                time.sleep(STREAM_INTERVAL)
+        finally:
+            db.close()
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@bp.route('/tasks/cancel', methods=('POST',))
+def cancel():
+    db = get_db()
+    task_id = request.form.get('task_id', type=int)
+    if task_id:
+        cancel_task(db, task_id)
+    return redirect("/tasks")
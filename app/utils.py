@@ -1,4 +1,10 @@
-import re
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import unicodedata
 
 """
 
@@ -12,8 +18,148 @@ def tag_string_to_list(tags):
     return [tag for tag in tags.replace(" ", "").split(",") if tag]
 
 
-# NOTE: the named arguments can be escaped
-def get_named_arguments(fmt_string):
-    pattern = re.compile(r'{(?P<name>\w+)}')
-    return pattern.findall(fmt_string)
+# Pagination cursors are opaque tokens like "next:123", base64 encoded
+# direction is "next" (rows after the id), "prev" (rows before it) or "last"
+def encode_cursor(direction, prompt_id=None):
+    raw = direction if prompt_id is None else f"{direction}:{prompt_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
 
+
+# Returns (direction, prompt_id), with (None, None) for the first page or a bad token
+def decode_cursor(token):
+    if not token:
+        return None, None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    except ValueError:
+        return None, None
+    direction, _, prompt_id = raw.partition(":")
+    if direction == "last":
+        return direction, None
+    if direction in ("next", "prev") and prompt_id.isdigit():
+        return direction, int(prompt_id)
+    return None, None
+
+
+# Seeds for random samples, small enough to read back and type in again
+def random_seed():
+    return random.randrange(2 ** 31)
+
+
+"""
+
+Streams the records of a bulk upload file, one at a time
+
+The file can either be a json array of objects, or JSONL (one object per line).
+Only one record (plus a read buffer) is held in memory at once, no matter how
+   large the file is.
+file is a path, or a file already open in binary mode (whose tell() then says
+   how far through it the records have got).
+
+"""
+def iter_json_records(file, chunk_size=1 << 16):
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with open(file, 'rb') as binary:
+            yield from iter_json_records(binary, chunk_size)
+        return
+
+    f = io.TextIOWrapper(file, encoding='utf-8-sig')
+    try:
+        head = f.read(chunk_size)
+        stripped = head.lstrip()
+        if stripped.startswith('['):
+            yield from _iter_json_array(f, stripped[1:], chunk_size)
+        else:
+            yield from _iter_json_lines(f, head)
+    finally:
+        # The caller still owns the binary file
+        f.detach()
+
+
+def _iter_json_lines(f, head):
+    # Finish the partial line left over from sniffing the format
+    first_lines = (head + f.readline()).splitlines()
+    for line in first_lines:
+        if line.strip():
+            yield json.loads(line)
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _iter_json_array(f, buf, chunk_size):
+    decoder = json.JSONDecoder()
+    pos = 0
+    eof = False
+    expect_item = True
+    after_comma = False
+
+    def read_more():
+        # Read at least as much as is buffered so huge records cost amortized linear time
+        nonlocal buf, pos, eof
+        buf = buf[pos:]
+        pos = 0
+        more = f.read(max(chunk_size, len(buf)))
+        if not more:
+            eof = True
+        buf += more
+
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("Unexpected end of file in json array")
+            read_more()
+            continue
+
+        # Values have to be separated by exactly one comma, with none after the last
+        if buf[pos] == ']':
+            if expect_item and after_comma:
+                raise ValueError("Trailing comma in json array")
+            return
+        if buf[pos] == ',':
+            if expect_item:
+                raise ValueError("Unexpected comma in json array")
+            expect_item = True
+            after_comma = True
+            pos += 1
+            continue
+        if not expect_item:
+            raise ValueError("Missing comma between values in json array")
+
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()
+            continue
+        if end == len(buf) and not eof:
+            # A number could continue past the end of the buffer
+            read_more()
+            continue
+
+        yield item
+        pos = end
+        expect_item = False
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+
+# Text as it's compared for duplicates: NFC unicode, unix line endings, and no
+#   whitespace at the ends of lines or of the text
+def normalize_text(value):
+    if value is None:
+        return ""
+    text = unicodedata.normalize('NFC', str(value)).replace("\r\n", "\n")
+    return "\n".join(line.rstrip() for line in text.split("\n")).strip()
+
+
+# A 32 character hex digest of a list of texts, after normalize_text
+# Prompts hash their values in style key order (see StylePlan.content_hash), and
+#   examples hash [completion]
+def content_hash(values):
+    data = json.dumps([normalize_text(value) for value in values], ensure_ascii=False)
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
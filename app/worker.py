@@ -0,0 +1,130 @@
+import atexit
+import json
+import os
+import threading
+
+import click
+from flask import current_app
+
+from app.db import connect_db, get_db
+from app.db_wrappers import task_context, claim_task, finish_task, recover_tasks, add_bulk_background, export_background, bulk_action_background, dedupe_background, near_duplicates_background, rebuild_stats_background
+
+"""
+
+Task workers
+
+Each worker is a long-lived process that claims queued tasks from the tasks table
+   (see db_wrappers.claim_task) and runs them one at a time, so TASK_WORKERS
+   workers run up to that many tasks at once and the rest wait their turn.
+
+Workers are started either by `flask worker`, or by the app itself on its first
+   request when EMBEDDED_WORKERS is set. They aren't daemons, because an export
+   starts a process pool of its own (see db_wrappers.export_background).
+
+"""
+
+# The function that runs each type of task, called with the database path, the
+#   task's id and its payload as keyword arguments
+TASK_FUNCTIONS = {
+    'bulk_upload': add_bulk_background,
+    'export': export_background,
+    'bulk_action': bulk_action_background,
+    'dedupe': dedupe_background,
+    'near_duplicates': near_duplicates_background,
+    'rebuild_stats': rebuild_stats_background,
+}
+
+
+def run_task(db, db_path, task):
+    function = TASK_FUNCTIONS.get(task['type'])
+    if function is None:
+        finish_task(db, task['id'], 'failed')
+        return
+    kwargs = json.loads(task['payload']) if task['payload'] else {}
+    try:
+        function(db_path, task_id=task['id'], **kwargs)
+    except Exception as e:
+        # Task functions record their own failures; this catches the ones they miss
+        finish_task(db, task['id'], 'failed')
+        print(f"Task {task['id']} failed: {e}")
+
+
+def run_worker(db_path, stop, poll_interval=1.0, timeout=30):
+    db = connect_db(db_path, timeout)
+    try:
+        while not stop.is_set():
+            task = claim_task(db, os.getpid())
+            if task is None:
+                stop.wait(poll_interval)
+                continue
+            run_task(db, db_path, task)
+    except KeyboardInterrupt:
+        # Whatever was running is failed by recover_tasks once this process is gone
+        pass
+    finally:
+        db.close()
+
+
+# Starts count workers, returning them along with the event that stops them
+def start_workers(db_path, count, poll_interval=1.0, timeout=30):
+    # Tasks left running by workers that died with the last server are failed,
+    #   rather than waiting forever
+    recover_tasks(get_db())
+
+    stop = task_context.Event()
+    workers = []
+    for _ in range(count):
+        p = task_context.Process(target=run_worker, args=(db_path, stop, poll_interval, timeout))
+        p.start()
+        workers.append(p)
+    return workers, stop
+
+
+# Lets each worker finish the task it's on, for up to timeout seconds, then kills it
+def stop_workers(workers, stop, timeout=5):
+    stop.set()
+    for p in workers:
+        p.join(timeout)
+        if p.is_alive():
+            p.terminate()
+            p.join()
+
+
+_embedded = None
+_embedded_lock = threading.Lock()
+
+# Runs before every request, which a threaded server handles concurrently, so the
+#   check is repeated under the lock to start the workers only once
+def start_embedded_workers():
+    global _embedded
+    if _embedded is not None:
+        return
+    with _embedded_lock:
+        if _embedded is not None:
+            return
+        app = current_app._get_current_object()
+        workers, stop = start_workers(app.config['DATABASE'], app.config['TASK_WORKERS'], app.config['WORKER_POLL_INTERVAL'], app.config['DB_TIMEOUT'])
+        _embedded = (workers, stop)
+        atexit.register(stop_workers, workers, stop)
+
+
+@click.command('worker')
+@click.option('--workers', type=int, default=None, help='Number of worker processes (defaults to TASK_WORKERS).')
+def worker_command(workers):
+    """Run queued bulk uploads and exports."""
+    config = current_app.config
+    count = workers if workers is not None else config['TASK_WORKERS']
+    processes, stop = start_workers(config['DATABASE'], count, config['WORKER_POLL_INTERVAL'], config['DB_TIMEOUT'])
+    click.echo(f'Started {count} workers. Press Ctrl+C to stop.')
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        click.echo('Stopping workers.')
+        stop_workers(processes, stop)
+
+
+def init_app(app):
+    app.cli.add_command(worker_command)
+    if app.config['EMBEDDED_WORKERS']:
+        app.before_request(start_embedded_workers)
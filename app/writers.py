@@ -0,0 +1,266 @@
+import bisect
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+
+from app.db import SQLiteJSONEncoder
+
+"""
+
+Export file writers
+
+An ExportWriter takes export records and writes them to one or more shard files,
+   then writes a manifest listing every shard with its record count, size and
+   sha256 checksum.
+
+Formats:
+   json  - each shard is a json array (pretty printed, like the original exports)
+   jsonl - one compact json object per line
+
+Shards can be gzipped as they are written, and a new shard can be started either
+   after a fixed number of records (to split an export into N files) or once a
+   shard reaches a size in bytes.
+
+"""
+
+FORMATS = ('json', 'jsonl')
+
+
+def get_encoder(fmt):
+    if fmt == 'jsonl':
+        return SQLiteJSONEncoder(separators=(',', ':'))
+    return SQLiteJSONEncoder(indent=4)
+
+
+# Splits a user supplied export filename into a stem and the extension its shards get
+def shard_names(filename, fmt, compress):
+    stem = filename
+    for ext in ('.gz', '.json', '.jsonl'):
+        if stem.endswith(ext):
+            stem = stem[:-len(ext)]
+    ext = '.' + fmt + ('.gz' if compress else '')
+    return stem, ext
+
+
+# Wraps a binary file, keeping a running checksum and byte count of what goes through it
+class _HashingFile(io.RawIOBase):
+
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.sha256.update(b)
+        self.size += len(b)
+        return self.f.write(b)
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        super().close()
+
+
+class ExportWriter:
+
+    def __init__(self, exports_path, filename, fmt='json', compress=False, records_per_shard=None, shard_bytes=None):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format {fmt}")
+        self.exports_path = exports_path
+        self.fmt = fmt
+        self.compress = compress
+        self.records_per_shard = records_per_shard
+        self.shard_bytes = shard_bytes
+        self.stem, self.ext = shard_names(filename, fmt, compress)
+        self.sharded = bool(records_per_shard or shard_bytes)
+        self.encoder = get_encoder(fmt)
+
+        self.shards = []
+        self.records = 0
+        self._raw = None
+        self._out = None
+        self._shard_records = 0
+
+    def _open_shard(self):
+        if self.sharded:
+            name = f"{self.stem}-{len(self.shards):05d}{self.ext}"
+        else:
+            name = self.stem + self.ext
+        self._raw = _HashingFile(os.path.join(self.exports_path, name))
+        binary = self._raw
+        if self.compress:
+            # mtime=0 keeps the output identical between runs
+            binary = gzip.GzipFile(filename='', mode='wb', fileobj=self._raw, mtime=0)
+        self._out = io.TextIOWrapper(binary, encoding='utf-8', newline='\n')
+        self._shard_records = 0
+        self.shards.append({'filename': name})
+        if self.fmt == 'json':
+            self._out.write('[\n')
+
+    def _close_shard(self):
+        if self.fmt == 'json':
+            self._out.write(']')
+        # Closing the gzip stream writes its trailer, but leaves the file under it open
+        binary = self._out.detach()
+        if self.compress:
+            binary.close()
+        self._raw.close()
+        self.shards[-1].update({
+            'records': self._shard_records,
+            'bytes': self._raw.size,
+            'sha256': self._raw.sha256.hexdigest(),
+        })
+        self._out = None
+
+    # Bytes written to disk so far, across every shard (after compression)
+    @property
+    def bytes_written(self):
+        total = sum(shard.get('bytes', 0) for shard in self.shards)
+        if self._out is not None:
+            total += self._raw.size
+        return total
+
+    def _shard_full(self):
+        if self.records_per_shard and self._shard_records >= self.records_per_shard:
+            return True
+        if self.shard_bytes and self._raw.size >= self.shard_bytes:
+            return True
+        return False
+
+    def write(self, record):
+        self.write_encoded(self.encoder.encode(record))
+
+    # Takes a record that has already been through get_encoder(fmt)
+    def write_encoded(self, data):
+        if self._out is None:
+            self._open_shard()
+        elif self._shard_full():
+            self._close_shard()
+            self._open_shard()
+
+        if self.fmt == 'json':
+            if self._shard_records > 0:
+                self._out.write(",\n")
+            self._out.write(data)
+        else:
+            self._out.write(data)
+            self._out.write("\n")
+        self._shard_records += 1
+        self.records += 1
+        if self.shard_bytes:
+            self._out.flush()
+
+    # Finishes the last shard and writes the manifest, returning the manifest's filename
+    def close(self):
+        # An empty export still gets one (empty) file
+        if self._out is None:
+            self._open_shard()
+        self._close_shard()
+
+        manifest = {
+            'format': self.fmt,
+            'compression': 'gzip' if self.compress else None,
+            'records': self.records,
+            'shards': self.shards,
+        }
+        # The extension keeps exports that differ only in format or compression apart
+        manifest_name = f"{self.stem}{self.ext}.manifest.json"
+        with open(os.path.join(self.exports_path, manifest_name), 'w') as f:
+            json.dump(manifest, f, indent=4)
+        return manifest_name
+
+    # Stops writing and deletes every shard written so far
+    def abort(self):
+        if self._out is not None:
+            self._out.detach()
+            self._raw.close()
+            self._out = None
+        for shard in self.shards:
+            path = os.path.join(self.exports_path, shard['filename'])
+            if os.path.exists(path):
+                os.remove(path)
+        self.shards = []
+
+
+def read_manifest(exports_path, manifest_name):
+    with open(os.path.join(exports_path, manifest_name)) as f:
+        return json.load(f)
+
+
+"""
+
+Deterministic splits of an export, like train/validation/test
+
+Every prompt (with all its completions) goes to one split, picked by a salted hash
+   of its id, or of its content (see StylePlan.content_hash) so that duplicate
+   prompts always land in the same split. A prompt's hash never changes, so rows
+   added later never move the ones already assigned, and the same ratios and salt
+   give the same assignment on every export.
+Ratios are weights normalized by their sum, so "train=8,test=2" is the same as
+   "train=0.8,test=0.2". Each split is written to its own files, named after it.
+
+"""
+SPLIT_KEYS = ('id', 'content')
+
+
+class ExportSplits:
+
+    def __init__(self, ratios, salt="", key="id"):
+        if key not in SPLIT_KEYS:
+            raise ValueError(f"Unknown split key {key}")
+        if not ratios:
+            raise ValueError("No splits given")
+        names = [name for name, _ in ratios]
+        if len(set(names)) != len(names):
+            raise ValueError("Split names must be different")
+        for name, ratio in ratios:
+            if not re.fullmatch(r"[A-Za-z0-9_]+", name):
+                raise ValueError(f"Split names can only have letters, digits and underscores, not {name!r}")
+            if not ratio > 0:
+                raise ValueError(f"The ratio of split {name} must be positive")
+        self.ratios = [(name, float(ratio)) for name, ratio in ratios]
+        self.names = names
+        self.salt = salt
+        self.key = key
+
+        # Cumulative upper bounds on [0, 1), the last one exactly 1
+        total = sum(ratio for _, ratio in self.ratios)
+        bounds = []
+        running = 0.0
+        for _, ratio in self.ratios:
+            running += ratio
+            bounds.append(running / total)
+        bounds[-1] = 1.0
+        self.bounds = bounds
+
+    # Reads "name=ratio,name=ratio,..."
+    @classmethod
+    def parse(cls, text, salt="", key="id"):
+        ratios = []
+        for part in text.replace(" ", "").split(","):
+            if not part:
+                continue
+            name, _, ratio = part.partition("=")
+            try:
+                ratios.append((name, float(ratio)))
+            except ValueError:
+                raise ValueError(f"Splits look like train=0.8,test=0.2, not {part!r}")
+        return cls(ratios, salt, key)
+
+    # The index of the split a prompt goes to
+    # values are its prompt values, which plan hashes when splitting by content
+    def assign(self, prompt_id, plan, values):
+        if self.key == 'content':
+            source = plan.content_hash(values)
+        else:
+            source = str(prompt_id)
+        digest = hashlib.blake2b(f"{self.salt}\0{source}".encode('utf-8'), digest_size=8).digest()
+        # 53 bits, so that the float is exact and always below 1
+        position = (int.from_bytes(digest, 'big') >> 11) / 2 ** 53
+        return bisect.bisect_right(self.bounds, position)
@@ -0,0 +1,80 @@
+"""
+
+Export benchmark
+
+Loads a synthetic dataset with add_bulk_background (see bench_import), then times
+   export_background over it once per worker count, checking that every run writes
+   the same bytes as the serial one. Reports records per second for each.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_export --rows 200000 --workers 1 2 4
+
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from app import create_app
+from app.db import get_db, init_db
+from app.db_wrappers import add_bulk_background, export_background
+from benchmarks.bench_import import write_synthetic_file
+
+
+def new_task(app, task_type):
+    with app.app_context():
+        db = get_db()
+        c = db.cursor()
+        c.execute("INSERT INTO tasks (`type`, `status`) VALUES (?, 'in_progress')", (task_type,))
+        db.commit()
+        return c.lastrowid
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--format', default='jsonl', choices=['json', 'jsonl'])
+    args = parser.parse_args()
+
+    instance_path = tempfile.mkdtemp(prefix='praetor-bench-')
+    db_path = os.path.join(instance_path, 'app.sqlite')
+    app = create_app({'DATABASE': db_path, 'EXPORTS_PATH': instance_path, 'UPLOADS_PATH': instance_path})
+
+    with app.app_context():
+        init_db()
+
+    data_path = os.path.join(instance_path, 'data.jsonl')
+    write_synthetic_file(data_path, args.rows)
+    add_bulk_background(db_path, new_task(app, 'bulk_upload'), data_path, ['bench'], 1, 1)
+
+    print(f"rows:    {args.rows:,d}")
+    print(f"format:  {args.format}")
+    serial_hash = None
+    for workers in args.workers:
+        filename = f"export-{workers}.{args.format}"
+        task_id = new_task(app, 'export')
+
+        start = time.perf_counter()
+        export_background(db_path, instance_path, task_id, filename, "", [], "", None, None, fmt=args.format, workers=workers)
+        elapsed = time.perf_counter() - start
+
+        digest = file_sha256(os.path.join(instance_path, filename))
+        if serial_hash is None:
+            serial_hash = digest
+        same = "identical" if digest == serial_hash else "DIFFERENT"
+        print(f"workers {workers:>3d}: {elapsed:8,.2f} s  {args.rows / elapsed:10,.0f} records/sec  output {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+
+Bulk import benchmark
+
+Writes a synthetic JSONL file, then times add_bulk_background loading it into a
+   fresh database in a temporary instance folder. Reports items (uploaded json
+   objects) and database rows written per second.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_import --rows 1000000
+
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from app import create_app
+from app.db import get_db, init_db
+from app.db_wrappers import add_bulk_background
+
+
+def write_synthetic_file(path, rows, seed=0):
+    rng = random.Random(seed)
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa"]
+    with open(path, 'w') as f:
+        for i in range(rows):
+            item = {
+                'instruction': f"{i} " + " ".join(rng.choices(words, k=12)),
+                'input': " ".join(rng.choices(words, k=6)),
+                'output': " ".join(rng.choices(words, k=24)),
+            }
+            f.write(json.dumps(item) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    instance_path = tempfile.mkdtemp(prefix='praetor-bench-')
+    db_path = os.path.join(instance_path, 'app.sqlite')
+    app = create_app({'DATABASE': db_path, 'EXPORTS_PATH': instance_path, 'UPLOADS_PATH': instance_path})
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        c = db.cursor()
+        c.execute("INSERT INTO tasks (`type`, `status`) VALUES ('bulk_upload', 'in_progress')")
+        task_id = c.lastrowid
+        db.commit()
+
+    data_path = os.path.join(instance_path, 'data.jsonl')
+    write_synthetic_file(data_path, args.rows)
+    size = os.path.getsize(data_path)
+
+    # Project 1 and style 1 both come from schema.sql
+    start = time.perf_counter()
+    add_bulk_background(db_path, task_id, data_path, ['bench'], 1, 1, args.batch_size)
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        db = get_db()
+        status = db.execute("SELECT status FROM tasks WHERE id = ?", (task_id,)).fetchone()['status']
+        # Every item becomes a prompt, two prompt values, an example and a tag
+        table_rows = 0
+        for table in ('prompts', 'prompt_values', 'examples', 'tags'):
+            table_rows += db.execute(f"SELECT COUNT(*) AS n FROM {table}").fetchone()['n']
+
+    print(f"rows:       {args.rows:,d}")
+    print(f"file size:  {size / 1e6:,.1f} MB")
+    print(f"batch size: {args.batch_size:,d}")
+    print(f"status:     {status}")
+    print(f"elapsed:    {elapsed:,.2f} s")
+    print(f"items/sec:  {args.rows / elapsed:,.0f}")
+    print(f"rows/sec:   {table_rows / elapsed:,.0f} (across prompts, prompt_values, examples and tags)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+
+Near-duplicate detection benchmark
+
+Fills a fresh database with synthetic prompts (see app/synthetic.py), then times
+   the two stages of find_near_duplicates: computing every MinHash signature with
+   --workers processes, and clustering them by LSH banding. A second signature
+   pass shows the cost of a rerun, when nothing has changed.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_near_duplicates --rows 1000000 --workers 8
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from app import create_app
+from app.db import get_db, init_db
+from app.db_wrappers import cluster_near_duplicates, update_minhashes
+from app.minhash import numpy
+from app.synthetic import generate_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threshold', type=float, default=0.8)
+    args = parser.parse_args()
+
+    instance_path = tempfile.mkdtemp(prefix='praetor-bench-')
+    db_path = os.path.join(instance_path, 'app.sqlite')
+    app = create_app({'DATABASE': db_path, 'EXPORTS_PATH': instance_path, 'UPLOADS_PATH': instance_path, 'EMBEDDED_WORKERS': False})
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        generate_data(db, projects=1, styles=2, prompts=args.rows)
+        project_id = db.execute("SELECT MAX(id) AS id FROM projects").fetchone()['id']
+
+        print(f"numpy: {'yes' if numpy is not None else 'no'}, workers: {args.workers}")
+        for label in ("signatures", "signatures (rerun)"):
+            start = time.perf_counter()
+            updated = update_minhashes(db, db_path, project_id, args.workers)
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {updated:,d} computed in {elapsed:.2f}s ({args.rows / elapsed:,.0f} prompts/s)")
+
+        start = time.perf_counter()
+        clusters, prompts = cluster_near_duplicates(db, project_id, args.threshold)
+        elapsed = time.perf_counter() - start
+        print(f"clustering: {clusters:,d} clusters of {prompts:,d} prompts in {elapsed:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
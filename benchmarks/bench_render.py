@@ -0,0 +1,81 @@
+"""
+
+Template rendering benchmark
+
+Times StylePlan.render_batch on in-memory records, then loads a synthetic dataset
+   (see bench_import) and times iter_export_records with and without render, so
+   the cost of rendering can be told apart from the cost of reading the records.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_render --rows 200000
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from app import create_app
+from app.db import get_db, init_db, connect_db
+from app.db_wrappers import add_bulk_background, iter_export_records
+from app.style_plans import get_style_plan
+from benchmarks.bench_import import write_synthetic_file
+
+TEMPLATE = "### Instruction:\n{instruction}\n\n### Input:\n{input}\n\n### Response:\n{output}"
+
+
+def time_render_batch(rows, batch_size):
+    plan = get_style_plan(TEMPLATE, 'output', 'instruction')
+    records = [{'instruction': f"{i} write a short poem", 'input': "about the sea", 'output': "waves " * 20} for i in range(batch_size)]
+    start = time.perf_counter()
+    done = 0
+    while done < rows:
+        plan.render_batch(records)
+        done += batch_size
+    return done, time.perf_counter() - start
+
+
+def time_export(db_path, render):
+    db = connect_db(db_path)
+    start = time.perf_counter()
+    count = 0
+    for _ in iter_export_records(db, render=render):
+        count += 1
+    elapsed = time.perf_counter() - start
+    db.close()
+    return count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    done, elapsed = time_render_batch(args.rows, args.batch_size)
+    print(f"render_batch: {done:,d} records in {elapsed:.2f}s ({done / elapsed:,.0f} records/s)")
+
+    instance_path = tempfile.mkdtemp(prefix='praetor-bench-')
+    db_path = os.path.join(instance_path, 'app.sqlite')
+    app = create_app({'DATABASE': db_path, 'EXPORTS_PATH': instance_path, 'UPLOADS_PATH': instance_path, 'EMBEDDED_WORKERS': False})
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        c = db.cursor()
+        c.execute("INSERT INTO tasks (`type`, `status`) VALUES ('bulk_upload', 'in_progress')")
+        task_id = c.lastrowid
+        db.commit()
+
+    data_path = os.path.join(instance_path, 'data.jsonl')
+    write_synthetic_file(data_path, args.rows)
+    add_bulk_background(db_path, task_id, data_path, ['bench'], 1, 1)
+
+    for render in (False, True):
+        count, elapsed = time_export(db_path, render)
+        print(f"export records (render={render}): {count:,d} in {elapsed:.2f}s ({count / elapsed:,.0f} records/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+
+Per-request database overhead benchmark
+
+Loads a synthetic dataset (see bench_import), then times a few pages through the
+   Flask test client under two configurations:
+
+   unpooled - a new connection for every request, with sqlite's default
+              synchronous, cache_size, mmap_size and temp_store
+   pooled   - connections reused from the pool, with db.DEFAULT_PRAGMAS
+
+It also times fetching the same rows with a python dictionary row factory (what
+   connections used before) and with sqlite3.Row.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_requests --rows 20000 --requests 500
+
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from app import create_app
+from app.db import get_db, init_db, connect_db
+from app.db_wrappers import add_bulk_background
+from benchmarks.bench_import import write_synthetic_file
+
+CONFIGURATIONS = {
+    'unpooled': {
+        'DB_POOL_SIZE': 0,
+        'SQLITE_PRAGMAS': {'synchronous': 'FULL', 'cache_size': -2000, 'mmap_size': 0, 'temp_store': 'DEFAULT'},
+    },
+    'pooled': {},
+}
+
+PAGES = [
+    '/manifest',
+    '/manifest?content=alpha+beta',
+    '/view?prompt_id={prompt_id}',
+    '/tasks.json',
+]
+
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+def time_row_factories(db_path, rounds=5):
+    results = {}
+    for name, factory in (('dict_factory', dict_factory), ('sqlite3.Row', sqlite3.Row)):
+        db = connect_db(db_path)
+        db.row_factory = factory
+        start = time.perf_counter()
+        for _ in range(rounds):
+            rows = db.execute("SELECT * FROM prompt_values").fetchall()
+        results[name] = (len(rows), (time.perf_counter() - start) / rounds)
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20_000)
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    instance_path = tempfile.mkdtemp(prefix='praetor-bench-')
+    db_path = os.path.join(instance_path, 'app.sqlite')
+    base_config = {'DATABASE': db_path, 'EXPORTS_PATH': instance_path, 'UPLOADS_PATH': instance_path, 'EMBEDDED_WORKERS': False}
+    app = create_app(base_config)
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        c = db.cursor()
+        c.execute("INSERT INTO tasks (`type`, `status`) VALUES ('bulk_upload', 'in_progress')")
+        task_id = c.lastrowid
+        db.commit()
+
+    data_path = os.path.join(instance_path, 'data.jsonl')
+    write_synthetic_file(data_path, args.rows)
+    add_bulk_background(db_path, task_id, data_path, ['bench'], 1, 1)
+    prompt_id = args.rows // 2
+
+    print(f"rows:     {args.rows:,d}")
+    print(f"requests: {args.requests:,d} per page")
+    for name, overrides in CONFIGURATIONS.items():
+        client = create_app(dict(base_config, **overrides)).test_client()
+        print(f"\n{name}")
+        for page in PAGES:
+            url = page.format(prompt_id=prompt_id)
+            # The first request pays for opening the pool's connection
+            client.get(url)
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                response = client.get(url)
+                assert response.status_code == 200, (url, response.status_code)
+            elapsed = time.perf_counter() - start
+            print(f"  {url:<32s} {1000 * elapsed / args.requests:8.3f} ms/request")
+
+    print("\nfetching every prompt_values row")
+    for name, (count, elapsed) in time_row_factories(db_path).items():
+        print(f"  {name:<14s} {count:,d} rows in {1000 * elapsed:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+
+Benchmark suite for db_wrappers
+
+Builds a synthetic database at each scale (see app/synthetic.py), times the
+   wrappers below on it and writes the results as json, so runs from before and
+   after a change can be compared:
+
+   search_*        - search_prompts, the first page of /manifest, with each filter
+   count_content   - count_prompts with a content filter (uncached)
+   sample_*        - sample_prompts drawing 100 prompts, unfiltered and with a tag filter
+   add_bulk        - add_bulk_background loading scale / 10 uploaded items
+   export          - export_background writing every example to one jsonl file
+   delete_project  - delete_project on a project of scale / 10 prompts
+
+Each benchmark runs --repeat times; results keep every time along with the min
+   and median, in seconds.
+
+Usage (from the repository root):
+
+    python -m benchmarks.suite --scales 1000,10000,100000 --output results.json
+    python -m benchmarks.suite --scales 1000,10000,100000 --compare results.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from app import create_app
+from app.db import get_db, init_db, connect_db
+from app.db_wrappers import add_bulk_background, count_prompts, delete_project, export_background, sample_prompts, search_prompts
+from app.synthetic import generate_data
+from benchmarks.bench_import import write_synthetic_file
+
+SEARCHES = {
+    'search_all': {},
+    'search_content': {'content_arg': 'omega river'},
+    'search_example': {'example_arg': 'poem story'},
+    'search_tag': {'tags_arg': ['tag-0003']},
+    'search_style': {'style_id': 2},
+}
+
+
+def _new_task(db_path, type):
+    db = connect_db(db_path)
+    c = db.cursor()
+    c.execute("INSERT INTO tasks (`type`, `status`) VALUES (?, 'in_progress')", (type,))
+    task_id = c.lastrowid
+    db.commit()
+    db.close()
+    return task_id
+
+
+def _time(function, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_scale(scale, repeat, seed):
+    instance_path = tempfile.mkdtemp(prefix='praetor-suite-')
+    db_path = os.path.join(instance_path, 'app.sqlite')
+    app = create_app({'DATABASE': db_path, 'EXPORTS_PATH': instance_path, 'UPLOADS_PATH': instance_path, 'EMBEDDED_WORKERS': False})
+
+    results = {}
+    with app.app_context():
+        init_db()
+        db = get_db()
+        start = time.perf_counter()
+        generate_data(db, projects=1, styles=2, prompts=scale, seed=seed)
+        results['generate'] = [time.perf_counter() - start]
+
+        for name, filters in SEARCHES.items():
+            results[name] = _time(lambda: search_prompts(db, 100, **filters), repeat)
+        results['count_content'] = _time(lambda: count_prompts(db, content_arg='omega river', ttl=0), repeat)
+        results['sample_all'] = _time(lambda: sample_prompts(db, 100, seed), repeat)
+        results['sample_tag'] = _time(lambda: sample_prompts(db, 100, seed, **SEARCHES['search_tag']), repeat)
+
+        # Bulk uploads delete their file once it's loaded
+        upload_path = os.path.join(instance_path, 'upload.jsonl')
+
+        def new_upload():
+            write_synthetic_file(upload_path, max(scale // 10, 1), seed=seed)
+            return (_new_task(db_path, 'bulk_upload'),)
+        results['add_bulk'] = _time(
+            lambda task_id: add_bulk_background(db_path, task_id, upload_path, ['bench'], 1, 1),
+            repeat, setup=new_upload
+        )
+
+        results['export'] = _time(
+            lambda task_id: export_background(db_path, instance_path, task_id, 'suite.jsonl', "", [], "", None, None, fmt='jsonl'),
+            repeat, setup=lambda: (_new_task(db_path, 'export'),)
+        )
+
+        def new_project():
+            generate_data(db, projects=1, styles=1, prompts=max(scale // 10, 1), seed=seed)
+            return (db.execute("SELECT MAX(id) AS id FROM projects").fetchone()['id'],)
+        results['delete_project'] = _time(lambda project_id: delete_project(db, project_id), repeat, setup=new_project)
+
+    return [
+        {'name': name, 'scale': scale, 'times': times, 'min': min(times), 'median': statistics.median(times)}
+        for name, times in results.items()
+    ]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    previous = {(x['name'], x['scale']): x for x in baseline['results']}
+    print(f"\n{'benchmark':<16s} {'scale':>10s} {'before':>10s} {'after':>10s} {'change':>8s}")
+    for result in results:
+        before = previous.get((result['name'], result['scale']))
+        if before is None:
+            continue
+        change = result['median'] / before['median'] if before['median'] else float('inf')
+        print(f"{result['name']:<16s} {result['scale']:>10,d} {before['median']:>10.4f} {result['median']:>10.4f} {change:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1000,10000,100000', help='comma separated prompt counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='compare against the results in this json file')
+    args = parser.parse_args()
+
+    results = []
+    for scale in [int(x) for x in args.scales.split(',')]:
+        scale_results = run_scale(scale, args.repeat, args.seed)
+        for result in scale_results:
+            print(f"{result['name']:<16s} {scale:>10,d} {result['median']:>10.4f}s (min {result['min']:.4f}s)")
+        results.extend(scale_results)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
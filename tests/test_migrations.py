@@ -0,0 +1,54 @@
+import pytest
+
+from app import create_app
+from app.db import get_db, get_migrations, get_schema_version, init_db
+from app.db_wrappers import _PROMPT_COLUMNS, _prompt_filter_sql
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'app.sqlite'),
+        'EXPORTS_PATH': str(tmp_path),
+        'EMBEDDED_WORKERS': False,
+    })
+    with app.app_context():
+        init_db()
+    return app
+
+
+# The query search_prompts runs for the first page
+def search_plan(db, **filters):
+    filter_sql, args = _prompt_filter_sql(**filters)
+    sql = f"""
+        EXPLAIN QUERY PLAN
+        SELECT {_PROMPT_COLUMNS}
+        {filter_sql}
+        ORDER BY prompts.id ASC
+        LIMIT ?
+    """
+    return [row['detail'] for row in db.execute(sql, (*args, 101))]
+
+
+def test_migrations_reach_latest_version(app):
+    with app.app_context():
+        db = get_db()
+        assert get_schema_version(db) == get_migrations()[-1][0]
+
+
+# 0002 ran ANALYZE on the single sample row of each table; with those statistics
+#   the planner scans styles and prompt_values instead of using their indexes
+@pytest.mark.parametrize('filters', [
+    {'project_id': 1},
+    {'project_id': 1, 'style_id': 1},
+    {'project_id': 1, 'tags_arg': 'a'},
+    {'project_id': 1, 'content_arg': 'abc'},
+    {'project_id': 1, 'example_arg': 'abc'},
+])
+def test_search_prompts_uses_indexes(app, filters):
+    with app.app_context():
+        plan = search_plan(get_db(), **filters)
+        assert any(line.startswith("SEARCH prompts USING INDEX") for line in plan), plan
+        # Full-text matches show up as scans of the virtual table
+        assert all("VIRTUAL TABLE" in line for line in plan if line.startswith("SCAN")), plan